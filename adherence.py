@@ -0,0 +1,182 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Adherence metrics for one or many patients, computed in a single vectorized
+# pass over the medications rows of a trailing window. Results are a dict of
+# equal-length NumPy arrays aligned on 'user_id', so callers can index a
+# single patient, build a DataFrame for a panel, or write it to an export.
+#
+# Each patient is observed from the later of the window start and their first
+# ever dose, so a patient who started last week is not penalised for the
+# weeks before they joined.
+#
+#   pdc                  proportion of days covered (days with >= 1 dose / days observed)
+#   mpr                  medication possession ratio (doses logged / doses expected)
+#   dose_count           doses logged in the window
+#   days_covered         distinct days with at least one dose
+#   timing_deviation     mean absolute minutes between each dose and the patient's
+#                        median time for that medication (NaN without time data)
+#   longest_missed_run   longest run of consecutive days without a dose
+#   missed_runs          number of separate runs of missed days
+#   current_missed_run   days since the last covered day (window length if none)
+
+METRICS = ("pdc", "mpr", "dose_count", "days_covered", "timing_deviation",
+           "longest_missed_run", "missed_runs", "current_missed_run")
+
+
+# Larger patient lists fall back to a full grouped scan
+MAX_IN_LIST = 900
+
+
+def window_bounds(days, end=None):
+    # Inclusive [start, end] window of `days` calendar days ending at `end`
+    end = end or date.today()
+    return end - timedelta(days=days - 1), end
+
+
+def _missed_runs(covered, observed):
+    # Run lengths of unobserved-excluded zeros per row of a (patients x days)
+    # boolean matrix
+    n_users, n_days = covered.shape
+    missed = np.zeros((n_users, n_days + 2), dtype=np.int8)
+    missed[:, 1:-1] = observed & ~covered
+    edges = np.diff(missed, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)
+    lengths = end_cols - start_cols
+
+    longest = np.zeros(n_users, dtype=np.int64)
+    np.maximum.at(longest, start_rows, lengths)
+    runs = np.bincount(start_rows, minlength=n_users)
+
+    last_covered = np.where(covered.any(axis=1),
+                            n_days - 1 - np.argmax(covered[:, ::-1], axis=1), -1)
+    current = n_days - 1 - last_covered
+    return longest, runs, current
+
+
+def compute_adherence(user_ids, dose_users, day_offsets, minutes, n_days,
+                      expected_daily_doses=1, first_offsets=None, dose_meds=None):
+    # user_ids: patients to report on. The dose_* arrays hold one entry per
+    # medications row: its patient, its day index within the n_days window,
+    # its time of day in minutes (NaN when unknown) and optionally its
+    # medication name. first_offsets optionally gives, per patient, the window
+    # day index their observation starts at.
+    user_ids = np.asarray(list(dict.fromkeys(user_ids)), dtype=object)
+    n_users = len(user_ids)
+    if first_offsets is None:
+        first_offsets = np.zeros(n_users, dtype=np.int64)
+    first_offsets = np.clip(np.asarray(first_offsets, dtype=np.int64), 0, n_days - 1)
+    observed = np.arange(n_days) >= first_offsets[:, None]
+    observed_days = observed.sum(axis=1)
+
+    rows = pd.Index(user_ids).get_indexer(pd.Index(np.asarray(dose_users, dtype=object)))
+    day_offsets = np.asarray(day_offsets, dtype=float)
+    minutes = np.asarray(minutes, dtype=float)
+
+    med_codes = np.zeros(len(rows), dtype=np.int64)
+    if dose_meds is not None:
+        med_codes = pd.factorize(pd.Series(dose_meds, dtype=object))[0]
+
+    keep = (rows >= 0) & (day_offsets >= 0) & (day_offsets < n_days)
+    rows = rows[keep]
+    day_offsets = day_offsets[keep].astype(np.int64)
+    minutes = minutes[keep]
+    med_codes = med_codes[keep]
+
+    covered = np.zeros((n_users, n_days), dtype=bool)
+    covered[rows, day_offsets] = True
+
+    dose_count = np.bincount(rows, minlength=n_users)
+    days_covered = covered.sum(axis=1)
+
+    # Median dose time per patient and medication, then the mean absolute
+    # deviation of every dose from its median
+    timed = ~np.isnan(minutes)
+    deviation = np.full(n_users, np.nan)
+    if timed.any():
+        groups = rows[timed] * (med_codes.max(initial=0) + 1) + med_codes[timed]
+        medians = pd.Series(minutes[timed]).groupby(groups).transform('median').to_numpy()
+        offsets = np.abs(minutes[timed] - medians)
+        totals = np.bincount(rows[timed], weights=offsets, minlength=n_users)
+        counts = np.bincount(rows[timed], minlength=n_users)
+        np.divide(totals, counts, out=deviation, where=counts > 0)
+
+    longest, runs, current = _missed_runs(covered, observed)
+
+    return {
+        "user_id": user_ids,
+        "pdc": days_covered / observed_days,
+        "mpr": dose_count / (expected_daily_doses * observed_days),
+        "dose_count": dose_count,
+        "days_covered": days_covered,
+        "timing_deviation": deviation,
+        "longest_missed_run": longest,
+        "missed_runs": runs,
+        "current_missed_run": current,
+    }
+
+
+def load_adherence(conn, user_ids=None, days=30, end=None, expected_daily_doses=1):
+    # One query for the whole window; user_ids=None reports every patient with
+    # doses in the window. Day offsets and minutes are derived in SQL so no
+    # per-row string parsing happens in Python. time_taken holds 'HH:MM:SS'
+    # from log_medication and full timestamps in older rows.
+    start, end = window_bounds(days, end)
+    sql = """
+        SELECT user_id,
+               CAST(julianday(date) - julianday(?) AS INTEGER),
+               CASE WHEN instr(time_taken, ':') > 2 THEN
+                   CAST(substr(time_taken, instr(time_taken, ':') - 2, 2) AS INTEGER) * 60
+                   + CAST(substr(time_taken, instr(time_taken, ':') + 1, 2) AS INTEGER)
+               END,
+               med_name
+        FROM medications
+        WHERE date >= ? AND date < ?
+    """
+    params = [start.isoformat(), start.isoformat(), (end + timedelta(days=1)).isoformat()]
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return compute_adherence([], [], [], [], days, expected_daily_doses)
+        sql += f" AND user_id IN ({', '.join('?' * len(user_ids))})"
+        params.extend(user_ids)
+
+    rows = conn.execute(sql, params).fetchall()
+    dose_users = [row[0] for row in rows]
+    if user_ids is None:
+        user_ids = list(dict.fromkeys(dose_users))
+
+    # First dose per patient, served from the (user_id, date) index
+    first_sql = "SELECT user_id, CAST(julianday(MIN(date)) - julianday(?) AS INTEGER) FROM medications"
+    first_params = [start.isoformat()]
+    if len(user_ids) <= MAX_IN_LIST:
+        first_sql += f" WHERE user_id IN ({', '.join('?' * len(user_ids))})"
+        first_params.extend(user_ids)
+    first_dose = dict(conn.execute(first_sql + " GROUP BY user_id", first_params).fetchall())
+
+    return compute_adherence(user_ids, dose_users,
+                             [np.nan if row[1] is None else row[1] for row in rows],
+                             [np.nan if row[2] is None else row[2] for row in rows],
+                             days, expected_daily_doses,
+                             [first_dose.get(user_id) or 0 for user_id in dict.fromkeys(user_ids)],
+                             [row[3] for row in rows])
+
+
+def patient_adherence(summary, user_id):
+    # Metrics for a single patient out of a summary, as plain Python values
+    matches = np.nonzero(summary["user_id"] == user_id)[0]
+    if not len(matches):
+        return None
+    return {metric: summary[metric][matches[0]].item() for metric in METRICS}
+
+
+def summary_frame(summary):
+    return pd.DataFrame({key: summary[key] for key in ("user_id",) + METRICS})
+
+
+def load_patient_adherence(conn, user_id, days=30, end=None):
+    # Single-patient convenience wrapper returning plain values
+    return patient_adherence(load_adherence(conn, [user_id], days, end), user_id)
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import date
+
+import numpy as np
+
+from migrations import migrate
+from queries import load_calendar_days, month_window
+
+# Benchmark for the medication calendar query. Builds a synthetic medication
+# log of --rows doses spread over --users users and three years, then times
+# one user's month through load_calendar_days() against the
+# strftime('%Y-%m', date) = ? filter it replaced, which has to look at
+# every dose the user ever logged.
+#
+#   python calendar_benchmark.py                  # 10M rows, 1000 users
+#   python calendar_benchmark.py --rows 1000000
+
+NAMES = np.array(["Metformin", "Insulin", "Lisinopril", "Atorvastatin"])
+
+
+def best_of(fn, runs=20):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def seed(conn, rows, users):
+    # Triggers dropped: the streak and stats rollups play no part in the query
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    rng = np.random.default_rng(0)
+    first = np.datetime64(date.today(), "D") - 3 * 365
+    per_user = rows // users
+    with conn:
+        for user_id in range(1, users + 1):
+            days = np.sort(first + rng.integers(0, 3 * 365, per_user))
+            seconds = rng.integers(6 * 3600, 23 * 3600, per_user)
+            taken = np.datetime_as_string(days.astype("datetime64[s]") + seconds).astype("U19")
+            conn.executemany(
+                "INSERT INTO medications (user_id, med_name, dosage, time_taken, date) VALUES (?, ?, ?, ?, ?)",
+                zip([user_id] * per_user, NAMES[rng.integers(0, len(NAMES), per_user)].tolist(),
+                    [500.0] * per_user, np.char.replace(taken, "T", " ").tolist(),
+                    np.datetime_as_string(days).tolist()))
+    return per_user * users
+
+
+def run(rows, users):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    started = time.perf_counter()
+    built = seed(conn, rows, users)
+    print(f"Built {built:,} medication rows in {time.perf_counter() - started:.1f}s")
+
+    today = date.today()
+    start, end = month_window(today.year, today.month)
+    user_id = users // 2
+    calendar = best_of(lambda: load_calendar_days(conn, user_id, start, end))
+    unsargable = best_of(lambda: conn.execute("""
+        SELECT date, COUNT(*), COUNT(DISTINCT med_name)
+        FROM medications
+        WHERE user_id = ? AND strftime('%Y-%m', date) = ?
+        GROUP BY date
+    """, (user_id, start[:7])).fetchall())
+    conn.close()
+    os.remove(db_path)
+
+    print(f"calendar month, half-open range:  {calendar * 1000:.3f}ms")
+    print(f"calendar month, strftime filter:  {unsargable * 1000:.3f}ms")
+    print("sub-millisecond" if calendar < 0.001 else "over a millisecond")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the medication calendar query")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="medication rows to generate")
+    parser.add_argument("--users", type=int, default=1000, help="users the rows are spread over")
+    args = parser.parse_args()
+    run(args.rows, args.users)
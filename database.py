@@ -0,0 +1,331 @@
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
+from migrations import SCHEMA_VERSION, migrate
+
+DB_PATH = Path("data") / "diabetes_app.db"
+
+# Streamlit runs every session on its own script thread, so connections are
+# opened with check_same_thread=False and handed out to one thread at a time.
+POOL_SIZE = 8
+POOL_TIMEOUT = 10
+
+# Applied to every new connection. WAL lets readers (provider pages, long
+# exports in jobs.py) run alongside the single writer and is stored in the
+# database file. In WAL mode synchronous=NORMAL only risks the last commits
+# on an OS crash, never corruption, and saves an fsync per commit.
+# busy_timeout makes a writer wait for the lock instead of failing at once.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+# The writer retries BEGIN on top of busy_timeout, for a lock held past the
+# timeout by a bulk import or purge
+WRITE_RETRIES = 3
+WRITE_BACKOFF = 0.05  # seconds, doubled per attempt with jitter
+
+# Group commit: how long the writer keeps collecting after the first queued
+# write arrives, and the most writes it commits at once
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_MAX = 256
+
+
+class ConnectionPool:
+    def __init__(self, db_path, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=None):
+        self.db_path = Path(db_path)
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._schema_version = None
+        self._writer = None
+        # The connection each thread holds, and how deeply, so nested
+        # connection() blocks share it instead of taking another from the pool
+        self._held = threading.local()
+
+    def _connect(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), timeout=self.timeout,
+                               check_same_thread=False)
+        try:
+            for name, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+            self._bootstrap(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _bootstrap(self, conn):
+        # Migrations run on the first connection of the process only
+        if self._schema_version == SCHEMA_VERSION:
+            return
+        with self._lock:
+            if self._schema_version != SCHEMA_VERSION:
+                self._schema_version = migrate(conn)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken handle, drop it and let the pool open a fresh one
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = WriteQueue(self._connect)
+        return self._writer
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        # Reentrant per thread: a page holding a connection while it calls
+        # helpers (or cached loaders) that open their own would otherwise
+        # take one pooled connection per level and run the pool dry
+        held = self._held
+        if getattr(held, "depth", 0):
+            held.depth += 1
+            try:
+                yield held.conn
+            finally:
+                held.depth -= 1
+            return
+        conn = self.acquire()
+        held.conn, held.depth = conn, 1
+        try:
+            yield conn
+        finally:
+            held.conn, held.depth = None, 0
+            self.release(conn)
+
+
+class WriteQueue:
+    # Every interactive write goes through one thread with its own
+    # connection. Callers queue fn(conn, *args) and get a Future; the thread
+    # takes everything queued within GROUP_COMMIT_WINDOW of the first item and
+    # commits the batch as one transaction. Concurrent sessions share a commit
+    # instead of taking turns on the write lock, and the writes run back to
+    # back on one thread instead of handing the GIL and the lock around.
+    _STOP = object()
+
+    def __init__(self, connect, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX):
+        self._connect = connect
+        self._window = window
+        self._max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is self._STOP:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self._window
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                # Commit what was collected, then stop
+                self._queue.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            # Fail every write rather than leave callers waiting
+            while (batch := self._next_batch()) is not None:
+                _fail(batch, e)
+            return
+        try:
+            while (batch := self._next_batch()) is not None:
+                self._commit(conn, [item for item in batch if item[2].set_running_or_notify_cancel()])
+        finally:
+            conn.close()
+
+    def _begin(self, conn):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return None
+            except sqlite3.OperationalError as e:
+                if not is_busy(e) or attempt == WRITE_RETRIES:
+                    return e
+                time.sleep(WRITE_BACKOFF * 2 ** attempt * (0.5 + random.random()))
+
+    def _commit(self, conn, batch):
+        # The whole batch runs as one transaction without savepoints, so a
+        # write costs one statement. If any write fails the batch is rolled
+        # back and replayed with a SAVEPOINT around each write, and only the
+        # failing ones are rejected.
+        error = self._begin(conn)
+        if error is not None:
+            _fail(batch, error)
+            return
+        try:
+            results = [fn(conn, *args) for fn, args, _ in batch]
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if len(batch) == 1:
+                _fail(batch, e)
+            else:
+                self._commit_isolated(conn, batch)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _commit_isolated(self, conn, batch):
+        error = self._begin(conn)
+        if error is not None:
+            _fail(batch, error)
+            return
+        outcomes = []
+        try:
+            for fn, args, future in batch:
+                conn.execute("SAVEPOINT queued_write")
+                try:
+                    outcomes.append((future, fn(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    outcomes.append((future, None, e))
+                conn.execute("RELEASE queued_write")
+            conn.commit()
+        except Exception as e:
+            # The transaction itself failed; nothing in the batch was written
+            if conn.in_transaction:
+                conn.rollback()
+            _fail(batch, e)
+            return
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _fail(batch, error):
+    for _, _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def configure(db_path, size=POOL_SIZE, pragmas=None):
+    # Point the process-wide pool at another database file (CLI tools, tests)
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(db_path, size, pragmas=pragmas)
+    return _pool
+
+
+def get_connection():
+    return get_pool().connection()
+
+
+def is_busy(error):
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error))
+
+
+def submit_write(fn, *args):
+    # Queues fn(conn, *args) on the writer thread; returns a Future for its
+    # result once the group it joins has committed. fn must not commit, and
+    # may be run twice if another write in its group fails.
+    return get_pool().writer().submit(fn, *args)
+
+
+def run_write(fn, *args):
+    return submit_write(fn, *args).result()
+
+
+def execute_write(sql, params=()):
+    # Single-statement run_write(); returns the cursor's lastrowid
+    return run_write(lambda conn: conn.execute(sql, params).lastrowid)
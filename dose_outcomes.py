@@ -0,0 +1,358 @@
+import argparse
+from datetime import date, datetime, time, timedelta
+
+from database import run_write
+from queries import TIMESTAMP_FORMAT
+from query_cache import invalidate_user
+
+# Scheduled-dose outcomes. Every medication_schedule row is a daily dose
+# slot at scheduled_time; each slot ends up on time, late or missed
+# depending on whether a dose of that medication was logged inside its
+# window:
+#
+#   due - EARLY_MINUTES .. due + ON_TIME_MINUTES   on time
+#   .. due + LATE_MINUTES                          late
+#   nothing by due + LATE_MINUTES                  missed
+#
+# Outcomes are written incrementally, never recomputed in bulk on a read:
+# log_medication() calls record_dose_outcome() in its transaction, which
+# matches the new dose to an open slot whose window contains it (one it is
+# on time for first, else the earliest), and sweep() (run every minute by the reminder scheduler) closes the slots
+# whose window has passed. The sweep matches those slots against any doses
+# not claimed yet (imports, doses logged outside the app) with a sort-merge
+# join and marks the rest missed. medication_schedule.outcomes_through
+# records the last day closed for each slot, so a sweep only touches slots
+# that closed since the previous one.
+
+EARLY_MINUTES = 60
+ON_TIME_MINUTES = 60
+LATE_MINUTES = 240
+
+ON_TIME, LATE, MISSED = "on_time", "late", "missed"
+OUTCOMES = (ON_TIME, LATE, MISSED)
+
+# Without a start_date, a slot's outcomes start from the first sweep rather
+# than from the beginning of time
+MAX_BACKFILL_DAYS = 1
+
+
+def _med_key(med_name):
+    return (med_name or "").strip().lower()
+
+
+def _as_date(value):
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+
+def _time_of_day(value):
+    # 'HH:MM[:SS]' or a full timestamp; None when unparseable
+    value = str(value or "")
+    colon = value.find(":")
+    if colon < 2:
+        return None
+    try:
+        return time(int(value[colon - 2:colon]), int(value[colon + 1:colon + 3]))
+    except ValueError:
+        return None
+
+
+def _active(start_date, end_date, day):
+    return ((start_date is None or _as_date(start_date) <= day)
+            and (end_date is None or _as_date(end_date) >= day))
+
+
+def classify(due, taken):
+    # Outcome of a dose taken at `taken` for the slot due at `due`, or None
+    # when it falls outside the slot's window
+    minutes = (taken - due).total_seconds() / 60
+    if -EARLY_MINUTES <= minutes <= ON_TIME_MINUTES:
+        return ON_TIME
+    if ON_TIME_MINUTES < minutes <= LATE_MINUTES:
+        return LATE
+    return None
+
+
+def match_doses(slots, doses):
+    # Sort-merge join of dose slots against logged doses. slots are
+    # (key, due, slot) and doses (key, taken, medication_id), both sorted by
+    # (key, time) where key is (user, medication). Each slot takes the
+    # earliest unclaimed dose in its window, at most one slot per dose,
+    # except that a dose which would only be late here but is on time for
+    # the next slot is left to that slot, unless the dose after it is on
+    # time there too. Yields (slot, outcome, medication_id, delay_minutes).
+    def on_time_for(index, key, due):
+        return (index < len(doses) and doses[index][0] == key
+                and classify(due, doses[index][1]) == ON_TIME)
+
+    i = 0
+    for j, (key, due, slot) in enumerate(slots):
+        while i < len(doses) and (doses[i][0] < key or
+                                  (doses[i][0] == key and doses[i][1] < due - timedelta(minutes=EARLY_MINUTES))):
+            i += 1
+        if i < len(doses) and doses[i][0] == key and doses[i][1] <= due + timedelta(minutes=LATE_MINUTES):
+            _, taken, medication_id = doses[i]
+            outcome = classify(due, taken)
+            if outcome == LATE and j + 1 < len(slots) and slots[j + 1][0] == key:
+                next_due = slots[j + 1][1]
+                if on_time_for(i, key, next_due) and not on_time_for(i + 1, key, next_due):
+                    yield slot, MISSED, None, None
+                    continue
+            i += 1
+            yield slot, outcome, medication_id, round((taken - due).total_seconds() / 60)
+        else:
+            yield slot, MISSED, None, None
+
+
+def _save_outcome(conn, user_id, schedule_id, due, outcome, medication_id, delay):
+    conn.execute("""
+        INSERT OR REPLACE INTO dose_outcomes
+        (user_id, day, schedule_id, due_at, status, medication_id, delay_minutes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, due.date().isoformat(), schedule_id, due.strftime(TIMESTAMP_FORMAT), outcome,
+          medication_id, delay))
+
+
+def record_dose_outcome(conn, user_id, med_name, day, time_taken, medication_id):
+    # Call after the medications row is inserted, inside the same transaction.
+    # Claims a slot still open (or closed as missed, for a backfilled dose)
+    # whose window contains the dose, one it is on time for before one it is
+    # late for, then the earliest; returns its outcome or None when the dose
+    # matches no slot.
+    taken_time = _time_of_day(time_taken)
+    if taken_time is None:
+        return None
+    day = _as_date(day)
+    taken = datetime.combine(day, taken_time)
+    schedule = conn.execute("""
+        SELECT id, scheduled_time, start_date, end_date FROM medication_schedule
+        WHERE user_id = ? AND lower(trim(med_name)) = ?
+    """, (user_id, _med_key(med_name))).fetchall()
+
+    candidates = []
+    for schedule_id, scheduled_time, start_date, end_date in schedule:
+        slot_time = _time_of_day(scheduled_time)
+        if slot_time is None:
+            continue
+        for slot_day in (day - timedelta(days=1), day, day + timedelta(days=1)):
+            due = datetime.combine(slot_day, slot_time)
+            outcome = classify(due, taken)
+            if outcome and _active(start_date, end_date, slot_day):
+                candidates.append((due, schedule_id, slot_day, outcome))
+
+    for due, schedule_id, slot_day, outcome in sorted(candidates, key=lambda c: (c[3] != ON_TIME, c[:2])):
+        existing = conn.execute("""
+            SELECT status FROM dose_outcomes WHERE user_id = ? AND day = ? AND schedule_id = ?
+        """, (user_id, slot_day.isoformat(), schedule_id)).fetchone()
+        if existing is None or existing[0] == MISSED:
+            _save_outcome(conn, user_id, schedule_id, due, outcome, medication_id,
+                          round((taken - due).total_seconds() / 60))
+            return outcome
+    return None
+
+
+def _closable_day(slot_time, cutoff):
+    # Last day whose slot at slot_time has a window ending by cutoff
+    return cutoff.date() if slot_time <= cutoff.time() else cutoff.date() - timedelta(days=1)
+
+
+def close_due_slots(conn, now=None):
+    # Closes every slot whose window ended since the last sweep; returns the
+    # ids of the users whose outcomes changed
+    cutoff = (now or datetime.now()) - timedelta(minutes=LATE_MINUTES)
+    schedule = conn.execute("""
+        SELECT id, user_id, med_name, scheduled_time, start_date, end_date, outcomes_through
+        FROM medication_schedule
+        WHERE (outcomes_through IS NULL OR outcomes_through < ?1
+               OR (outcomes_through < ?2 AND scheduled_time <= ?3))
+          AND (end_date IS NULL OR outcomes_through IS NULL OR outcomes_through < end_date)
+    """, ((cutoff.date() - timedelta(days=1)).isoformat(), cutoff.date().isoformat(),
+          cutoff.strftime("%H:%M"))).fetchall()
+
+    slots, closed = [], []
+    for schedule_id, user_id, med_name, scheduled_time, start_date, end_date, through in schedule:
+        slot_time = _time_of_day(scheduled_time)
+        if slot_time is None:
+            continue
+        last = _closable_day(slot_time, cutoff)
+        if end_date is not None:
+            last = min(last, _as_date(end_date))
+        if through is not None:
+            first = _as_date(through) + timedelta(days=1)
+        elif start_date is not None:
+            first = _as_date(start_date)
+        else:
+            first = last - timedelta(days=MAX_BACKFILL_DAYS - 1)
+        # Slots matched by record_dose_outcome() keep their outcome and
+        # must not claim a second dose
+        decided = {row[0] for row in conn.execute("""
+            SELECT day FROM dose_outcomes WHERE user_id = ? AND day >= ? AND day <= ? AND schedule_id = ?
+        """, (user_id, first.isoformat(), last.isoformat(), schedule_id))}
+        key = (str(user_id), _med_key(med_name))
+        day = first
+        while day <= last:
+            if day.isoformat() not in decided:
+                due = datetime.combine(day, slot_time)
+                slots.append((key, due, (user_id, schedule_id, due)))
+            day += timedelta(days=1)
+        closed.append((max(last, first - timedelta(days=1)).isoformat(), schedule_id))
+    if not slots:
+        conn.executemany("UPDATE medication_schedule SET outcomes_through = ? WHERE id = ?", closed)
+        return set()
+    slots.sort(key=lambda slot: slot[:2])
+
+    # Doses near the closing slots that no slot has claimed yet
+    users = {slot[2][0] for slot in slots}
+    first_day = min(slot[1] for slot in slots).date() - timedelta(days=1)
+    last_day = max(slot[1] for slot in slots).date() + timedelta(days=1)
+    doses = []
+    for user_id in users:
+        for medication_id, med_name, day, time_taken in conn.execute("""
+            SELECT m.id, m.med_name, m.date, m.time_taken FROM medications m
+            WHERE m.user_id = ? AND m.date >= ? AND m.date <= ?
+              AND NOT EXISTS (SELECT 1 FROM dose_outcomes o WHERE o.medication_id = m.id)
+        """, (user_id, first_day.isoformat(), last_day.isoformat())):
+            taken_time = _time_of_day(time_taken)
+            if taken_time is not None and day is not None:
+                doses.append(((str(user_id), _med_key(med_name)),
+                              datetime.combine(_as_date(day), taken_time), medication_id))
+    doses.sort(key=lambda dose: dose[:2])
+
+    conn.executemany("""
+        INSERT OR IGNORE INTO dose_outcomes
+        (user_id, day, schedule_id, due_at, status, medication_id, delay_minutes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(user_id, due.date().isoformat(), schedule_id, due.strftime(TIMESTAMP_FORMAT), outcome, medication_id, delay)
+          for (user_id, schedule_id, due), outcome, medication_id, delay in match_doses(slots, doses)])
+    conn.executemany("UPDATE medication_schedule SET outcomes_through = ? WHERE id = ?", closed)
+    return users
+
+
+def sweep(now=None):
+    # close_due_slots() through the writer, for the reminder scheduler's tick
+    for user_id in run_write(close_due_slots, now):
+        invalidate_user(user_id)
+
+
+def rebuild_outcomes(conn, user_id, since, now=None):
+    # Recomputes one user's outcomes from `since`, e.g. after editing past
+    # doses or the schedule
+    conn.execute("DELETE FROM dose_outcomes WHERE user_id = ? AND day >= ?", (user_id, _as_date(since).isoformat()))
+    conn.execute("""
+        UPDATE medication_schedule SET outcomes_through = ? WHERE user_id = ? AND outcomes_through >= ?
+    """, ((_as_date(since) - timedelta(days=1)).isoformat(), user_id, _as_date(since).isoformat()))
+    return close_due_slots(conn, now)
+
+
+# Reads
+
+def load_outcome_rates(conn, user_ids=None, days=30, end=None):
+    # {user_id: {"on_time", "late", "missed", "total", "taken_rate", "on_time_rate"}}
+    # over closed slots in the trailing window; user_ids=None reports everyone
+    end = end or date.today()
+    params = [(end - timedelta(days=days - 1)).isoformat(), end.isoformat()]
+    sql = "SELECT user_id, status, COUNT(*) FROM dose_outcomes WHERE day >= ? AND day <= ?"
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        sql += f" AND user_id IN ({', '.join('?' * len(user_ids))})"
+        params.extend(user_ids)
+    rates = {}
+    for user_id, status, count in conn.execute(sql + " GROUP BY user_id, status", params):
+        rates.setdefault(user_id, dict.fromkeys(OUTCOMES, 0))[status] = count
+    for counts in rates.values():
+        counts["total"] = sum(counts[outcome] for outcome in OUTCOMES)
+        counts["taken_rate"] = (counts[ON_TIME] + counts[LATE]) / counts["total"]
+        counts["on_time_rate"] = counts[ON_TIME] / counts["total"]
+    return rates
+
+
+def load_day_slots(conn, user_id, day=None):
+    # The user's dose slots for one day with their outcome, 'pending' while
+    # still open
+    day = _as_date(day or date.today())
+    rows = conn.execute("""
+        SELECT s.scheduled_time, s.med_name, s.dosage, COALESCE(o.status, 'pending'), o.delay_minutes
+        FROM medication_schedule s
+        LEFT JOIN dose_outcomes o ON o.user_id = s.user_id AND o.day = ?1 AND o.schedule_id = s.id
+        WHERE s.user_id = ?2
+          AND (s.start_date IS NULL OR s.start_date <= ?1) AND (s.end_date IS NULL OR s.end_date >= ?1)
+        ORDER BY s.scheduled_time
+    """, (day.isoformat(), user_id)).fetchall()
+    return [dict(zip(["scheduled_time", "med_name", "dosage", "status", "delay_minutes"], row)) for row in rows]
+
+
+# Schedule editing
+
+def load_schedule(conn, user_id, day=None):
+    day = _as_date(day or date.today()).isoformat()
+    rows = conn.execute("""
+        SELECT med_name, scheduled_time, dosage FROM medication_schedule
+        WHERE user_id = ?1 AND (end_date IS NULL OR end_date >= ?2)
+        ORDER BY scheduled_time, med_name
+    """, (user_id, day)).fetchall()
+    return [dict(zip(["med_name", "scheduled_time", "dosage"], row)) for row in rows]
+
+
+def save_schedule(user_id, entries, today=None):
+    # Replaces the user's current schedule with entries ({med_name,
+    # scheduled_time 'HH:MM', dosage}). Unchanged slots are kept; removed
+    # ones end yesterday and new ones start today, so past outcomes keep
+    # pointing at the slots they were judged against.
+    today = today or date.today()
+    wanted = set()
+    for entry in entries:
+        med_name, scheduled_time, dosage = entry.get("med_name"), entry.get("scheduled_time"), entry.get("dosage")
+        if not med_name or not scheduled_time:
+            continue
+        if not isinstance(scheduled_time, str):
+            scheduled_time = scheduled_time.strftime("%H:%M")
+        # Empty editor cells come back as NaN
+        dosage = None if dosage is None or dosage != dosage else float(dosage)
+        wanted.add((med_name.strip(), scheduled_time[:5], dosage))
+
+    def save(conn):
+        current = conn.execute("""
+            SELECT id, med_name, scheduled_time, dosage FROM medication_schedule
+            WHERE user_id = ? AND (end_date IS NULL OR end_date >= ?)
+        """, (user_id, today.isoformat())).fetchall()
+        kept = set()
+        for schedule_id, med_name, scheduled_time, dosage in current:
+            if (med_name, scheduled_time, dosage) in wanted:
+                kept.add((med_name, scheduled_time, dosage))
+            else:
+                conn.execute("UPDATE medication_schedule SET end_date = ? WHERE id = ?",
+                             ((today - timedelta(days=1)).isoformat(), schedule_id))
+        conn.executemany("""
+            INSERT INTO medication_schedule (user_id, med_name, scheduled_time, dosage, start_date)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(user_id, *entry, today.isoformat()) for entry in sorted(wanted - kept, key=str)])
+
+    run_write(save)
+    invalidate_user(user_id)
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure, get_connection
+
+    parser = argparse.ArgumentParser(description="Maintain scheduled-dose outcomes")
+    parser.add_argument("--sweep", action="store_true", help="close every slot whose window has passed")
+    parser.add_argument("--rebuild", metavar="USER_ID", help="recompute one user's outcomes")
+    parser.add_argument("--since", help="first day to rebuild (YYYY-MM-DD, default 30 days ago)")
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    args = parser.parse_args()
+
+    configure(args.db)
+    user_id = int(args.rebuild) if args.rebuild and args.rebuild.isdigit() else args.rebuild
+    if args.rebuild:
+        since = args.since or (date.today() - timedelta(days=30)).isoformat()
+        run_write(rebuild_outcomes, user_id, since)
+    elif args.sweep:
+        sweep()
+    else:
+        parser.print_help()
+    if args.rebuild or args.sweep:
+        with get_connection() as conn:
+            for user_id, counts in sorted(load_outcome_rates(conn, [user_id] if args.rebuild else None).items(),
+                                          key=lambda item: str(item[0])):
+                print(f"{user_id}: {counts[ON_TIME]} on time, {counts[LATE]} late, {counts[MISSED]} missed")
@@ -0,0 +1,345 @@
+import argparse
+import csv
+import io
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from queries import since_date
+
+# Streaming exports of patient data. Rows are pulled from SQLite with
+# fetchmany() in fixed-size chunks and handed straight to a format writer,
+# so peak memory depends on the chunk size, not on how many rows are
+# exported. Every dataset query walks one of the (user_id, time) indexes, so
+# full-history and whole-panel exports stream without a sort.
+#
+#   csv      one CSV, or a zip with one CSV per dataset
+#   parquet  one Parquet file, or a zip with one file per dataset (needs pyarrow)
+#   xlsx     one workbook with a sheet per dataset, written by openpyxl in
+#            write-only mode; datasets longer than an Excel sheet continue on
+#            "(2)", "(3)"... sheets
+
+CHUNK_ROWS = 50_000
+EXCEL_MAX_ROWS = 1_048_575  # plus the header row
+
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "xlsx": ".xlsx"}
+
+MIME_TYPES = {
+    ".csv": "text/csv",
+    ".parquet": "application/vnd.apache.parquet",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".zip": "application/zip",
+}
+
+# name: (sheet title, table, select list, time column for windows, ORDER BY, column types)
+DATASETS = {
+    "glucose": (
+        "Glucose Data", "glucose_readings", "user_id, reading_time, glucose_level",
+        "reading_time", "user_id, reading_time",
+        {"user_id": "string", "reading_time": "string", "glucose_level": "float"},
+    ),
+    "medications": (
+        "Medication Data", "medications", "user_id, date, time_taken, med_name, dosage",
+        "date", "user_id, date, time_taken",
+        {"user_id": "string", "date": "string", "time_taken": "string",
+         "med_name": "string", "dosage": "float"},
+    ),
+    "daily_summary": (
+        "Daily Glucose Summary", "daily_glucose_summary",
+        """user_id, day, reading_count, glucose_sum / reading_count AS mean_glucose,
+           glucose_min, glucose_max, hypo_count, hyper_count""",
+        "day", "user_id, day",
+        {"user_id": "string", "day": "string", "reading_count": "int", "mean_glucose": "float",
+         "glucose_min": "float", "glucose_max": "float", "hypo_count": "int", "hyper_count": "int"},
+    ),
+}
+
+MAX_IN_LIST = 900
+
+
+class ExportError(Exception):
+    pass
+
+
+def _dataset_queries(dataset, user_ids=None, days=None, count=False):
+    # (sql, params) pairs covering the dataset; user_ids=None exports every
+    # patient and days=None the full history
+    _, table, select_list, time_column, order_by, _ = DATASETS[dataset]
+    batches = [None] if user_ids is None else [
+        user_ids[offset:offset + MAX_IN_LIST] for offset in range(0, len(user_ids), MAX_IN_LIST)]
+    for batch in batches:
+        conditions, params = [], []
+        if batch is not None:
+            conditions.append(f"user_id IN ({', '.join('?' * len(batch))})")
+            params.extend(batch)
+        if days is not None:
+            conditions.append(f"{time_column} >= ?")
+            params.append(since_date(days))
+        sql = f"SELECT {'COUNT(*)' if count else select_list} FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        yield (sql if count else f"{sql} ORDER BY {order_by}"), params
+
+
+def _dataset_chunks(conn, dataset, user_ids=None, days=None, chunk_rows=CHUNK_ROWS):
+    # Lists of row tuples
+    for sql, params in _dataset_queries(dataset, user_ids, days):
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield rows
+
+
+def count_rows(conn, dataset, user_ids=None, days=None):
+    # Rows an export of the dataset will write, for progress reporting
+    user_ids = None if user_ids is None else list(dict.fromkeys(user_ids))
+    return sum(conn.execute(sql, params).fetchone()[0]
+               for sql, params in _dataset_queries(dataset, user_ids, days, count=True))
+
+
+class CsvWriter:
+    def __init__(self, stream):
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="", write_through=True)
+        self._writer = csv.writer(self._text)
+
+    def start(self, columns):
+        self._writer.writerow(columns)
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._text.flush()
+        self._text.detach()
+
+
+class ParquetWriter:
+    _TYPES = {"string": "string", "float": "float64", "int": "int64"}
+
+    def __init__(self, stream):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ExportError("Parquet export requires pyarrow (pip install pyarrow)")
+        self._pa, self._pq = pa, pq
+        self._stream = stream
+        self._writer = None
+
+    def start(self, columns, types):
+        pa = self._pa
+        self._types = [types[column] for column in columns]
+        self._schema = pa.schema([(column, getattr(pa, self._TYPES[kind])())
+                                  for column, kind in zip(columns, self._types)])
+        self._writer = self._pq.ParquetWriter(self._stream, self._schema, compression="zstd")
+
+    def write_rows(self, rows):
+        pa = self._pa
+        arrays = []
+        for values, kind in zip(zip(*rows), self._types):
+            if kind == "string":
+                # user_id mixes integer and anonymous text ids
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type=getattr(pa, self._TYPES[kind])()))
+        self._writer.write_batch(pa.record_batch(arrays, schema=self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ExcelWriter:
+    def __init__(self, stream):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise ExportError("Excel export requires openpyxl (pip install openpyxl)")
+        self._stream = stream
+        self._workbook = Workbook(write_only=True)
+
+    def start_sheet(self, title, columns):
+        self._title = title
+        self._columns = columns
+        self._sheets = 0
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self._sheets += 1
+        title = self._title if self._sheets == 1 else f"{self._title} ({self._sheets})"
+        self._sheet = self._workbook.create_sheet(title[:31])
+        self._sheet.append(self._columns)
+        self._rows = 0
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self._rows == EXCEL_MAX_ROWS:
+                self._new_sheet()
+            self._sheet.append(row)
+            self._rows += 1
+
+    def close(self):
+        self._workbook.save(self._stream)
+
+
+def _columns(dataset):
+    return list(DATASETS[dataset][5])
+
+
+def _export_stream(conn, stream, fmt, dataset, user_ids, days, chunk_rows, progress):
+    columns = _columns(dataset)
+    if fmt == "csv":
+        writer = CsvWriter(stream)
+        writer.start(columns)
+    else:
+        writer = ParquetWriter(stream)
+        writer.start(columns, DATASETS[dataset][5])
+    count = 0
+    try:
+        for rows in _dataset_chunks(conn, dataset, user_ids, days, chunk_rows):
+            writer.write_rows(rows)
+            count += len(rows)
+            if progress:
+                progress(dataset, count)
+    finally:
+        writer.close()
+    return count
+
+
+def export(conn, target, fmt, datasets=("glucose", "medications"), user_ids=None, days=None,
+           extra_frames=None, chunk_rows=CHUNK_ROWS, progress=None):
+    # target: a path or a binary file object. extra_frames are small,
+    # already-computed DataFrames (e.g. adherence) exported alongside the
+    # datasets. progress(dataset, rows_so_far) is called after every chunk.
+    # Returns {dataset: rows written}.
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown export format '{fmt}'")
+    user_ids = None if user_ids is None else list(dict.fromkeys(user_ids))
+    extra_frames = extra_frames or {}
+    counts = {}
+
+    owns_stream = isinstance(target, (str, Path))
+    stream = open(target, "wb") if owns_stream else target
+    try:
+        if fmt == "xlsx":
+            writer = ExcelWriter(stream)
+            for dataset in datasets:
+                writer.start_sheet(DATASETS[dataset][0], _columns(dataset))
+                counts[dataset] = 0
+                for rows in _dataset_chunks(conn, dataset, user_ids, days, chunk_rows):
+                    writer.write_rows(rows)
+                    counts[dataset] += len(rows)
+                    if progress:
+                        progress(dataset, counts[dataset])
+            for title, frame in extra_frames.items():
+                writer.start_sheet(title, list(frame.columns))
+                writer.write_rows(frame.itertuples(index=False, name=None))
+            writer.close()
+        elif len(datasets) == 1 and not extra_frames:
+            counts[datasets[0]] = _export_stream(conn, stream, fmt, datasets[0], user_ids, days,
+                                                 chunk_rows, progress)
+        else:
+            with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+                for dataset in datasets:
+                    with archive.open(f"{dataset}{FORMATS[fmt]}", "w") as member:
+                        counts[dataset] = _export_stream(conn, member, fmt, dataset, user_ids, days,
+                                                         chunk_rows, progress)
+                for title, frame in extra_frames.items():
+                    name = title.lower().replace(" ", "_") + FORMATS[fmt]
+                    with archive.open(name, "w") as member:
+                        if fmt == "csv":
+                            frame.to_csv(member, index=False)
+                        else:
+                            frame.to_parquet(member, index=False)
+    finally:
+        if owns_stream:
+            stream.close()
+    return counts
+
+
+def export_filename(fmt, datasets, extra_frames=None, prefix="patient_export"):
+    # Single CSV/Parquet datasets are written bare; everything else is zipped
+    if fmt == "xlsx" or (len(datasets) == 1 and not extra_frames):
+        return f"{prefix}{FORMATS[fmt]}"
+    return f"{prefix}_{fmt}.zip"
+
+
+def _benchmark(rows, formats, chunk_rows):
+    # Synthetic glucose_readings of `rows` readings spread over 100 patients,
+    # exported once per format by a child process so each run's peak RSS can
+    # be read from its own rusage
+    import sqlite3
+    import subprocess
+    import sys
+
+    from migrations import migrate
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "bench.db")
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    started = time.perf_counter()
+    with conn:
+        # Bulk-load without the rollup triggers; only the export is measured
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+            conn.execute(f"DROP TRIGGER {name}")
+        conn.execute("""
+            WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < ? - 1)
+            INSERT INTO glucose_readings (user_id, glucose_level, reading_time)
+            SELECT n % 100 + 1, 70 + (n * 37) % 200,
+                   datetime('2020-01-01', '+' || (n / 100 * 5) || ' minutes')
+            FROM seq
+        """, (rows,))
+    conn.close()
+    print(f"Built {rows:,} readings in {time.perf_counter() - started:.1f}s")
+
+    for fmt in formats:
+        path = os.path.join(workdir, f"export{FORMATS[fmt]}")
+        started = time.perf_counter()
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), path, "--format", fmt,
+                                  "--dataset", "glucose", "--db", db_path,
+                                  "--chunk-rows", str(chunk_rows)], stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(child.pid, 0)
+        elapsed = time.perf_counter() - started
+        if status:
+            raise ExportError(f"{fmt} export failed")
+        # ru_maxrss is in kilobytes on Linux
+        print(f"{fmt:8s} {rows / elapsed:>9,.0f} rows/s  {elapsed:6.1f}s  "
+              f"{os.path.getsize(path) / 1e6:7.1f} MB  peak RSS {usage.ru_maxrss / 1024:.0f} MB")
+        os.remove(path)
+    os.remove(db_path)
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure, get_connection
+
+    parser = argparse.ArgumentParser(description="Export patient data as CSV, Parquet or Excel")
+    parser.add_argument("output", nargs="?", help="file to write")
+    parser.add_argument("--format", choices=sorted(FORMATS), help="defaults to the output's extension")
+    parser.add_argument("--dataset", action="append", choices=sorted(DATASETS),
+                        help="dataset to include (repeatable, default glucose and medications)")
+    parser.add_argument("--user-id", action="append", help="patient to include (repeatable, default all)")
+    parser.add_argument("--days", type=int, help="only the last N days (default full history)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    parser.add_argument("--benchmark", type=int, metavar="ROWS",
+                        help="export ROWS synthetic readings and report time, size and peak memory")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        _benchmark(args.benchmark, [args.format] if args.format else list(FORMATS), args.chunk_rows)
+    elif not args.output:
+        parser.error("an output file is required")
+    else:
+        fmt = args.format or Path(args.output).suffix.lstrip(".")
+        user_ids = None if args.user_id is None else [
+            int(user_id) if user_id.isdigit() else user_id for user_id in args.user_id]
+        configure(args.db)
+        with get_connection() as conn:
+            counts = export(conn, args.output, fmt, tuple(args.dataset or ("glucose", "medications")),
+                            user_ids, args.days, chunk_rows=args.chunk_rows)
+        for dataset, count in counts.items():
+            print(f"{dataset}: {count:,} rows")
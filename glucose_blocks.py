@@ -0,0 +1,341 @@
+import argparse
+import zlib
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from database import get_connection, get_pool, run_write
+
+# Columnar copy of glucose_readings for scans. glucose_blocks holds one block
+# per user and day with the day's readings in time order as two columns,
+# zlib-compressed together into one BLOB:
+#
+#   times    uint32 seconds since midnight, delta-encoded (CGM deltas repeat)
+#   levels   uint16 tenths of mg/dL (the importer already rounds to 0.1)
+#
+# A CGM day of 288 readings packs into about 700 bytes, ~2.4 bytes a reading
+# against ~66 for the row and its index entry (--benchmark).
+# glucose_readings stays the system of record, since the triggers, rollups,
+# importer, retention and exports are all built on rows. Days are packed
+# once they are closed, and user_stats.packed_through marks how far each
+# user is packed; load_readings() serves packed days from blocks and only
+# the days after them from rows.
+#
+# Writes to packed days keep their blocks current the way the importer and
+# retention keep rollups current: record_readings() merges readings into a
+# packed day's block and delete_days() drops blocks before a day's
+# survivors are recorded again.
+
+# A day is packed once it is this many days old, which leaves room for
+# readings stamped in UTC (log_glucose uses datetime('now'))
+PACK_AFTER_DAYS = 2
+# Users packed per scheduler tick, so a first pack of a large history is
+# spread over minutes instead of holding up reminders (or run --pack)
+PACK_USERS_PER_TICK = 50
+LEVEL_SCALE = 10
+ZLIB_LEVEL = 6
+MAX_IN_LIST = 900
+
+ONE_DAY = np.timedelta64(1, "D")
+
+
+def _as_times(reading_times):
+    # 'YYYY-MM-DD HH:MM:SS[.ffffff]' strings to datetime64[s]
+    return np.asarray(reading_times, dtype="U19").astype("datetime64[s]")
+
+
+def encode_block(seconds, levels):
+    # seconds: seconds since midnight in ascending order
+    deltas = np.diff(np.asarray(seconds, dtype=np.int64), prepend=0).astype("<u4")
+    scaled = np.clip(np.round(np.asarray(levels, dtype=float) * LEVEL_SCALE), 0, np.iinfo(np.uint16).max)
+    return zlib.compress(deltas.tobytes() + scaled.astype("<u2").tobytes(), ZLIB_LEVEL)
+
+
+def decode_block(data, count):
+    # (seconds since midnight, levels in mg/dL)
+    raw = zlib.decompress(data)
+    seconds = np.cumsum(np.frombuffer(raw, dtype="<u4", count=count), dtype=np.int64)
+    levels = np.frombuffer(raw, dtype="<u2", count=count, offset=4 * count) / LEVEL_SCALE
+    return seconds, levels
+
+
+def _save_blocks(conn, user_id, times, levels):
+    # Writes one block per day of `times` (datetime64[s], ascending),
+    # replacing any stored block for those days
+    days = times.astype("datetime64[D]")
+    starts = np.concatenate(([0], np.nonzero(days[1:] != days[:-1])[0] + 1))
+    ends = np.concatenate((starts[1:], [len(times)]))
+    conn.executemany("""
+        INSERT OR REPLACE INTO glucose_blocks (user_id, day, reading_count, data)
+        VALUES (?, ?, ?, ?)
+    """, [(user_id, str(days[start]), int(end - start),
+           encode_block((times[start:end] - days[start]).astype(np.int64), levels[start:end]))
+          for start, end in zip(starts.tolist(), ends.tolist())])
+
+
+def _packed_through(conn, user_id):
+    row = conn.execute("SELECT packed_through FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def pack_user(conn, user_id, through):
+    # Packs the user's days after packed_through up to and including `through`
+    packed = _packed_through(conn, user_id)
+    if packed is not None and packed >= str(through):
+        return 0
+    start = "" if packed is None else str(date.fromisoformat(packed) + timedelta(days=1))
+    rows = conn.execute("""
+        SELECT substr(reading_time, 1, 19), glucose_level FROM glucose_readings
+        WHERE user_id = ? AND reading_time >= ? AND reading_time < ? AND glucose_level IS NOT NULL
+        ORDER BY reading_time
+    """, (user_id, start, str(through + timedelta(days=1)))).fetchall()
+    if rows:
+        times, levels = zip(*rows)
+        _save_blocks(conn, user_id, _as_times(times), np.asarray(levels, dtype=float))
+    conn.execute("UPDATE user_stats SET packed_through = ? WHERE user_id = ?", (str(through), user_id))
+    return len(rows)
+
+
+def users_to_pack(conn, through, limit=-1):
+    return [row[0] for row in conn.execute("""
+        SELECT user_id FROM user_stats
+        WHERE last_reading_at IS NOT NULL AND (packed_through IS NULL OR packed_through < ?)
+        LIMIT ?
+    """, (str(through), limit))]
+
+
+def pack_through(today=None):
+    return (today or date.today()) - timedelta(days=PACK_AFTER_DAYS)
+
+
+_packed = None
+
+
+def pack(now=None):
+    # pack_user() for every user through the writer, one user per write so
+    # app writes are never queued behind a long pack. Runs on the reminder
+    # scheduler's tick and has nothing to do once a day is packed.
+    global _packed
+    through = pack_through((now or datetime.now()).date())
+    if _packed == (get_pool().db_path, through):
+        return
+    with get_connection() as conn:
+        user_ids = users_to_pack(conn, through, PACK_USERS_PER_TICK)
+    for user_id in user_ids:
+        run_write(pack_user, user_id, through)
+    if len(user_ids) < PACK_USERS_PER_TICK:
+        _packed = (get_pool().db_path, through)
+
+
+def record_readings(conn, user_id, reading_times, levels):
+    # Merges readings into the blocks of days that are already packed; later
+    # days are left to pack_user(). For writers that bypass log_glucose's
+    # unpacked today (imports, retention repairs).
+    packed = _packed_through(conn, user_id)
+    if packed is None:
+        return
+    times = _as_times(reading_times)
+    levels = np.asarray(levels, dtype=float)
+    keep = times < np.datetime64(packed, "s") + ONE_DAY
+    if not keep.any():
+        return
+    times, levels = times[keep], levels[keep]
+    days = np.unique(times.astype("datetime64[D]")).astype(str).tolist()
+    for day in days:
+        row = conn.execute("SELECT reading_count, data FROM glucose_blocks WHERE user_id = ? AND day = ?",
+                           (user_id, day)).fetchone()
+        if row is not None:
+            seconds, stored = decode_block(row[1], row[0])
+            times = np.concatenate((times, np.datetime64(day, "s") + seconds))
+            levels = np.concatenate((levels, stored))
+    order = np.argsort(times, kind="stable")
+    _save_blocks(conn, user_id, times[order], levels[order])
+
+
+def delete_days(conn, days):
+    # days: (user_id, 'YYYY-MM-DD') pairs
+    conn.executemany("DELETE FROM glucose_blocks WHERE user_id = ? AND day = ?", days)
+
+
+def load_readings(conn, user_ids, start, end):
+    # {user_id: (times as datetime64[s], levels)} in time order for readings
+    # in [start, end) ('YYYY-MM-DD HH:MM:SS'); users without any are left out.
+    # Packed days are decoded from blocks and later days read from rows, with
+    # one rows query per distinct packed_through in the batch.
+    user_ids = list(dict.fromkeys(user_ids))
+    lower, upper = np.datetime64(start, "s"), np.datetime64(end, "s")
+    parts = {}
+    for offset in range(0, len(user_ids), MAX_IN_LIST):
+        batch = user_ids[offset:offset + MAX_IN_LIST]
+        marks = ", ".join("?" * len(batch))
+        packed = dict(conn.execute(f"""
+            SELECT user_id, packed_through FROM user_stats
+            WHERE user_id IN ({marks}) AND packed_through IS NOT NULL
+        """, batch).fetchall())
+
+        if packed:
+            blocks = conn.execute(f"""
+                SELECT user_id, day, reading_count, data FROM glucose_blocks
+                WHERE user_id IN ({marks}) AND day >= ? AND day <= ?
+                ORDER BY user_id, day
+            """, (*batch, start[:10], end[:10])).fetchall()
+            for user_id, day, count, data in blocks:
+                seconds, levels = decode_block(data, count)
+                times = np.datetime64(day, "s") + seconds
+                inside = (times >= lower) & (times < upper)
+                parts.setdefault(user_id, []).append((times[inside], levels[inside]))
+
+        bounds = {}
+        for user_id in batch:
+            bound = start
+            if user_id in packed:
+                bound = max(start, str(date.fromisoformat(packed[user_id]) + timedelta(days=1)))
+            if bound < end:
+                bounds.setdefault(bound, []).append(user_id)
+        for bound, users in bounds.items():
+            rows = conn.execute(f"""
+                SELECT user_id, substr(reading_time, 1, 19), glucose_level FROM glucose_readings
+                WHERE user_id IN ({", ".join("?" * len(users))})
+                AND reading_time >= ? AND reading_time < ? AND glucose_level IS NOT NULL
+                ORDER BY user_id, reading_time
+            """, (*users, bound, end)).fetchall()
+            if not rows:
+                continue
+            ids = np.array([row[0] for row in rows], dtype=object)
+            times = _as_times([row[1] for row in rows])
+            levels = np.array([row[2] for row in rows], dtype=float)
+            boundaries = np.nonzero(ids[1:] != ids[:-1])[0] + 1
+            for first, last in zip(np.concatenate(([0], boundaries)),
+                                   np.concatenate((boundaries, [len(rows)]))):
+                parts.setdefault(ids[first], []).append((times[first:last], levels[first:last]))
+
+    readings = {}
+    for user_id, chunks in parts.items():
+        times = np.concatenate([chunk[0] for chunk in chunks])
+        if len(times):
+            readings[user_id] = (times, np.concatenate([chunk[1] for chunk in chunks]))
+    return readings
+
+
+def load_user_readings(conn, user_id, start, end):
+    # (times, levels) for one user, empty arrays without readings
+    return load_readings(conn, [user_id], start, end).get(
+        user_id, (np.array([], dtype="datetime64[s]"), np.array([], dtype=float)))
+
+
+def _benchmark(patients, days):
+    # Synthetic CGM history (5-minute readings with a few seconds of jitter,
+    # whole mg/dL as sensors report them) for `patients` patients over
+    # `days` days. Reports the bytes per reading of each layout, and the
+    # time to read every patient's last 14 days (the provider panel) and
+    # one patient's last 90 days through load_readings() before and after
+    # packing.
+    import os
+    import sqlite3
+    import tempfile
+    import time
+
+    from migrations import migrate
+
+    def file_size(conn):
+        conn.execute("VACUUM")
+        return os.path.getsize(db_path)
+
+    def best_of(fn, runs=3):
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    empty = file_size(conn)
+
+    rng = np.random.default_rng(0)
+    end = np.datetime64(date.today() - timedelta(days=PACK_AFTER_DAYS - 1), "s")
+    per_patient = days * 288
+    started = time.perf_counter()
+    with conn:
+        for user_id in range(1, patients + 1):
+            steps = 300 + rng.integers(-3, 4, per_patient)
+            times = end - np.cumsum(steps)[::-1]
+            daily = 40 * np.sin(2 * np.pi * (times.astype(np.int64) % 86400) / 86400)
+            levels = np.clip(np.round(130 + daily + np.cumsum(rng.normal(0, 2, per_patient)) % 60), 40, 400)
+            conn.executemany("INSERT INTO glucose_readings (user_id, glucose_level, reading_time) VALUES (?, ?, ?)",
+                             zip([user_id] * per_patient, levels.tolist(),
+                                 np.datetime_as_string(times).astype("U19").tolist()))
+            conn.execute("INSERT INTO user_stats (user_id, reading_count, last_reading_at) VALUES (?, ?, ?)",
+                         (user_id, per_patient, str(times[-1]).replace("T", " ")))
+    readings = patients * per_patient
+    print(f"Built {readings:,} readings in {time.perf_counter() - started:.1f}s")
+
+    user_ids = list(range(1, patients + 1))
+    last = str(end + 1).replace("T", " ")
+    panel_start = str(end - np.timedelta64(14, "D")).replace("T", " ")
+    chart_start = str(end - np.timedelta64(90, "D")).replace("T", " ")
+    scans = {
+        "panel 14d": lambda: load_readings(conn, user_ids, panel_start, last),
+        "chart 90d": lambda: load_user_readings(conn, 1, chart_start, last),
+    }
+    row_times = {name: best_of(fn) for name, fn in scans.items()}
+    expected = load_readings(conn, user_ids, panel_start, last)
+
+    started = time.perf_counter()
+    with conn:
+        for user_id in user_ids:
+            pack_user(conn, user_id, pack_through())
+    print(f"Packed in {time.perf_counter() - started:.1f}s")
+    block_times = {name: best_of(fn) for name, fn in scans.items()}
+    packed = load_readings(conn, user_ids, panel_start, last)
+    assert all(np.array_equal(expected[u][0], packed[u][0]) and np.allclose(expected[u][1], packed[u][1])
+               for u in user_ids), "blocks and rows disagree"
+
+    both = file_size(conn)
+    with conn:
+        conn.execute("DELETE FROM glucose_blocks")
+    rows_size = file_size(conn) - empty
+    blocks_size = both - empty - rows_size
+    conn.close()
+    os.remove(db_path)
+
+    print(f"{'layout':8s} {'bytes/reading':>13s} {'total':>9s}  " + "  ".join(f"{name:>9s}" for name in scans))
+    for layout, size, scan_times in (("rows", rows_size, row_times), ("blocks", blocks_size, block_times)):
+        print(f"{layout:8s} {size / readings:13.1f} {size / 1e6:7.1f} MB  "
+              + "  ".join(f"{scan_times[name] * 1000:7.1f}ms" for name in scans))
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure
+
+    parser = argparse.ArgumentParser(description="Pack glucose readings into per-day blocks")
+    parser.add_argument("--pack", action="store_true", help="pack every user's closed days")
+    parser.add_argument("--repack", action="store_true", help="drop all blocks and pack again")
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    parser.add_argument("--benchmark", type=int, metavar="PATIENTS",
+                        help="compare size and scan time of rows and blocks on synthetic CGM data")
+    parser.add_argument("--days", type=int, default=90, help="days of readings per benchmark patient")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        _benchmark(args.benchmark, args.days)
+    elif args.pack or args.repack:
+        configure(args.db)
+        through = pack_through()
+        with get_connection() as conn:
+            if args.repack:
+                with conn:
+                    conn.execute("DELETE FROM glucose_blocks")
+                    conn.execute("UPDATE user_stats SET packed_through = NULL")
+            readings = 0
+            user_ids = users_to_pack(conn, through)
+            for user_id in user_ids:
+                with conn:
+                    readings += pack_user(conn, user_id, through)
+        print(f"Packed {readings:,} readings for {len(user_ids)} users through {through}")
+    else:
+        parser.print_help()
@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import glucose_blocks
+from queries import TIMESTAMP_FORMAT
+
+# Clinical CGM metrics from raw readings, following the international
+# consensus on time in range:
+#
+#   time in range bands   share of readings <54, 54-69, 70-180, 181-250, >250 mg/dL
+#   gmi                   glucose management indicator, 3.31 + 0.02392 * mean (%)
+#   estimated_a1c         ADAG estimated A1C, (mean + 46.7) / 28.7 (%)
+#   cv                    coefficient of variation, SD / mean (%); <= 36 is stable
+#   mage                  mean amplitude of glycemic excursions larger than 1 SD,
+#                         averaged over rises and falls
+#   agp                   ambulatory glucose profile, percentiles of glucose by
+#                         time of day
+#
+# Readings are assumed to be evenly sampled, as CGM data is, so band shares
+# are shares of readings. Everything is vectorized over the series except
+# MAGE's pass over turning points, which are a small fraction of readings.
+
+BANDS = ["very_low", "low", "in_range", "high", "very_high"]
+BAND_LABELS = {"very_low": "<54", "low": "54-69", "in_range": "70-180",
+               "high": "181-250", "very_high": ">250"}
+
+AGP_PERCENTILES = (5, 25, 50, 75, 95)
+AGP_SLOT_MINUTES = 15
+
+
+def band_indices(levels):
+    # 0..4 into BANDS; 70 and 180 are in range, 54 is low, 250 is high
+    levels = np.asarray(levels, dtype=float)
+    return ((levels >= 54).astype(np.int8) + (levels >= 70) + (levels > 180) + (levels > 250))
+
+
+def time_in_range(levels):
+    counts = np.bincount(band_indices(levels), minlength=len(BANDS))
+    total = counts.sum()
+    return dict(zip(BANDS, counts / total if total else np.zeros(len(BANDS))))
+
+
+def gmi(mean):
+    return 3.31 + 0.02392 * mean
+
+
+def estimated_a1c(mean):
+    return (mean + 46.7) / 28.7
+
+
+def mage(levels, sd=None):
+    # Excursions are measured between alternating peaks and nadirs, and only
+    # swings of at least one SD count; smaller wiggles are absorbed into the
+    # surrounding excursion
+    levels = np.asarray(levels, dtype=float)
+    if len(levels) < 3:
+        return float("nan")
+    sd = np.std(levels) if sd is None else sd
+    if sd == 0:
+        return 0.0
+
+    # Turning points: drop flat steps, then keep where the slope changes sign
+    levels = levels[np.concatenate(([True], np.diff(levels) != 0))]
+    slope = np.sign(np.diff(levels))
+    turning = np.concatenate(([0], np.nonzero(slope[1:] != slope[:-1])[0] + 1, [len(levels) - 1]))
+
+    extremes = []
+    for value in levels[turning].tolist():
+        if len(extremes) >= 2 and (value - extremes[-1]) * (extremes[-1] - extremes[-2]) > 0:
+            extremes[-1] = value
+        elif not extremes or abs(value - extremes[-1]) >= sd:
+            extremes.append(value)
+    amplitudes = np.abs(np.diff(extremes))
+    amplitudes = amplitudes[amplitudes >= sd]
+    return float(amplitudes.mean()) if len(amplitudes) else 0.0
+
+
+def agp_curve(minutes, levels, percentiles=AGP_PERCENTILES, slot_minutes=AGP_SLOT_MINUTES):
+    # Percentiles of glucose per time-of-day slot, for every slot at once:
+    # sort by (slot, level) and interpolate at each slot's rank offsets
+    minutes = np.asarray(minutes, dtype=np.int64)
+    levels = np.asarray(levels, dtype=float)
+    n_slots = 24 * 60 // slot_minutes
+    slots = np.clip(minutes // slot_minutes, 0, n_slots - 1)
+    order = np.lexsort((levels, slots))
+    sorted_levels = levels[order]
+    counts = np.bincount(slots, minlength=n_slots)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    present = np.nonzero(counts)[0]
+    curve = {"slot": [f"{slot * slot_minutes // 60:02d}:{slot * slot_minutes % 60:02d}" for slot in present],
+             "readings": counts[present]}
+    for q in percentiles:
+        rank = starts[present] + (counts[present] - 1) * (q / 100)
+        below = np.floor(rank).astype(np.int64)
+        above = np.minimum(below + 1, starts[present] + counts[present] - 1)
+        fraction = rank - below
+        curve[f"p{q}"] = sorted_levels[below] * (1 - fraction) + sorted_levels[above] * fraction
+    return pd.DataFrame(curve)
+
+
+def compute_metrics(levels):
+    levels = np.asarray(levels, dtype=float)
+    if not len(levels):
+        return None
+    mean = float(levels.mean())
+    sd = float(levels.std())
+    metrics = {
+        "readings": len(levels),
+        "mean": mean,
+        "sd": sd,
+        "cv": 100 * sd / mean if mean else float("nan"),
+        "gmi": gmi(mean),
+        "estimated_a1c": estimated_a1c(mean),
+        "mage": mage(levels, sd),
+    }
+    metrics.update({band: float(share) for band, share in time_in_range(levels).items()})
+    return metrics
+
+
+def _window_bounds(days, today=None):
+    # Half-open timestamps covering `days` whole days up to and including today
+    today = today or datetime.now().date()
+    end = datetime.combine(today, datetime.min.time()) + timedelta(days=1)
+    return (end - timedelta(days=days)).strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT)
+
+
+def load_readings(conn, user_ids, days, today=None):
+    # {user_id: (minutes of day, levels)} in time order, from glucose_blocks
+    # for packed days and the (user_id, reading_time, glucose_level) index
+    # after them
+    start, end = _window_bounds(days, today)
+    return {user_id: ((times - times.astype("datetime64[D]")).astype(np.int64) // 60, levels)
+            for user_id, (times, levels) in glucose_blocks.load_readings(conn, user_ids, start, end).items()}
+
+
+def load_panel_metrics(conn, user_ids, days=14, today=None):
+    # {user_id: metrics dict, or None without readings in the window}
+    readings = load_readings(conn, user_ids, days, today)
+    return {user_id: compute_metrics(readings[user_id][1]) if user_id in readings else None
+            for user_id in user_ids}
+
+
+def load_agp(conn, user_id, days=14, today=None):
+    readings = load_readings(conn, [user_id], days, today).get(user_id)
+    if readings is None:
+        return None
+    return agp_curve(*readings)
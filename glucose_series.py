@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from glucose_blocks import load_user_readings
+
+# Downsampled glucose series for charting. glucose_rollups holds hourly and
+# daily count/sum/min/max buckets per user, kept current by triggers on
+# glucose_readings (and in bulk by the importer), so a chart over months or
+# years reads a few thousand pre-aggregated rows instead of every reading.
+# load_series() serves a window from the finest tier that stays small and
+# thins whatever it loads with LTTB before it goes to the browser.
+
+MAX_POINTS = 2000
+
+# Tiers from finest to coarsest, with the widest window (in days) each one
+# serves; anything wider comes from the daily tier
+TIERS = [("raw", 3), ("hour", 90)]
+
+# reading_time is 'YYYY-MM-DD HH:MM:SS[.ffffff]', so buckets are prefixes
+BUCKET_LENGTHS = {"hour": 13, "day": 10}
+BUCKET_SUFFIXES = {"hour": ":00:00", "day": ""}
+
+
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: indices of `threshold` points that keep
+    # the visual shape of the series (peaks and troughs survive, flat
+    # stretches are thinned). x must be ascending and numeric.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the next bucket is the third corner of the triangle
+        if i + 2 < len(edges):
+            next_x = x[stop:edges[i + 2]].mean()
+            next_y = y[stop:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous])
+                       - (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def record_readings(conn, user_id, reading_times, levels):
+    # Bulk equivalent of trg_glucose_rollups_insert for callers that suspend
+    # the trigger; reading_times are 'YYYY-MM-DD HH:MM:SS' strings. Casting
+    # to a shorter fixed-width string dtype truncates each one to its bucket.
+    reading_times = np.asarray(reading_times, dtype="U19")
+    levels = np.asarray(levels, dtype=float)
+    for resolution, length in BUCKET_LENGTHS.items():
+        buckets, rows = np.unique(reading_times.astype(f"U{length}"), return_inverse=True)
+        counts = np.bincount(rows, minlength=len(buckets))
+        totals = np.bincount(rows, weights=levels, minlength=len(buckets))
+        lows = np.full(len(buckets), np.inf)
+        highs = np.full(len(buckets), -np.inf)
+        np.minimum.at(lows, rows, levels)
+        np.maximum.at(highs, rows, levels)
+        conn.executemany("""
+            INSERT INTO glucose_rollups
+            (user_id, resolution, bucket, reading_count, glucose_sum, glucose_min, glucose_max)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+                reading_count = reading_count + excluded.reading_count,
+                glucose_sum = glucose_sum + excluded.glucose_sum,
+                glucose_min = min(glucose_min, excluded.glucose_min),
+                glucose_max = max(glucose_max, excluded.glucose_max)
+        """, zip([user_id] * len(buckets), [resolution] * len(buckets),
+                 np.char.add(buckets, BUCKET_SUFFIXES[resolution]).tolist(),
+                 counts.tolist(), totals.tolist(), lows.tolist(), highs.tolist()))
+
+
+def rebuild_rollups(conn, user_id=None):
+    # Recompute from glucose_readings, for backfills and repairs
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM glucose_rollups {where}", params)
+    for resolution, length in BUCKET_LENGTHS.items():
+        conn.execute(f"""
+            INSERT INTO glucose_rollups
+            (user_id, resolution, bucket, reading_count, glucose_sum, glucose_min, glucose_max)
+            SELECT user_id, ?, substr(reading_time, 1, {length}) || ?, COUNT(*),
+                   SUM(glucose_level), MIN(glucose_level), MAX(glucose_level)
+            FROM glucose_readings
+            {where or "WHERE true"} AND glucose_level IS NOT NULL AND reading_time IS NOT NULL
+            GROUP BY user_id, substr(reading_time, 1, {length})
+        """, (resolution, BUCKET_SUFFIXES[resolution], *params))
+
+
+def choose_tier(days):
+    for tier, max_days in TIERS:
+        if days <= max_days:
+            return tier
+    return "day"
+
+
+def reading_span(conn, user_id):
+    # (first, last) reading time for the user, or None without readings. Two
+    # subqueries so that MIN and MAX are each a single index probe.
+    row = conn.execute("""
+        SELECT (SELECT MIN(bucket) FROM glucose_rollups WHERE user_id = ? AND resolution = 'hour'),
+               (SELECT MAX(bucket) FROM glucose_rollups WHERE user_id = ? AND resolution = 'hour')
+    """, (user_id, user_id)).fetchone()
+    if row[0] is None:
+        return None
+    return pd.Timestamp(row[0]), pd.Timestamp(row[1]) + timedelta(hours=1)
+
+
+def load_series(conn, user_id, days=None, now=None, max_points=MAX_POINTS):
+    # The window covers the `days` up to now (the whole history when days is
+    # None), so it is empty for a user who stopped logging before it began.
+    # Returns a DataFrame of time, glucose_level (bucket mean), glucose_min
+    # and glucose_max, and the tier it came from (None when empty).
+    empty = pd.DataFrame(columns=["time", "glucose_level", "glucose_min", "glucose_max"])
+    span = reading_span(conn, user_id)
+    if span is None:
+        return empty, None
+    first, last = span
+    if days is None:
+        start, end = first, last
+    else:
+        end = pd.Timestamp(now or datetime.now())
+        start = end - timedelta(days=days)
+        if last <= start:
+            return empty, None
+        start = max(first, start)
+    tier = choose_tier((end - start) / timedelta(days=1))
+
+    if tier == "raw":
+        # Packed days come straight from glucose_blocks as arrays
+        times, levels = load_user_readings(conn, user_id, start.strftime('%Y-%m-%d %H:%M:%S'),
+                                           (end + timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S'))
+        df = pd.DataFrame({"time": times, "glucose_level": levels,
+                           "glucose_min": levels, "glucose_max": levels})
+    else:
+        df = pd.read_sql_query("""
+            SELECT bucket AS time, glucose_sum / reading_count AS glucose_level,
+                   glucose_min, glucose_max
+            FROM glucose_rollups
+            WHERE user_id = ? AND resolution = ? AND bucket >= ? AND bucket <= ?
+            ORDER BY bucket
+        """, conn, params=(user_id, tier, start.strftime('%Y-%m-%d %H:%M:%S')[:BUCKET_LENGTHS[tier]],
+                           end.strftime('%Y-%m-%d %H:%M:%S')))
+
+    df["time"] = pd.to_datetime(df["time"], format="ISO8601")
+    if len(df) > max_points:
+        keep = lttb(df["time"].to_numpy(dtype="datetime64[s]").astype(np.int64),
+                    df["glucose_level"].to_numpy(), max_points)
+        df = df.iloc[keep].reset_index(drop=True)
+    return df, tier
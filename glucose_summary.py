@@ -0,0 +1,135 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+# One row per user per day with everything the analytics tab derives from
+# glucose readings: count, sum and sum of squares (mean and standard
+# deviation), min/max, hypo/hyper counts and a 24-slot hour-of-day histogram
+# of counts and sums. Triggers on glucose_readings keep it current (the
+# importer suspends them and calls record_readings per chunk), so a year of
+# analytics reads 365 rows instead of every reading.
+#
+# The hour histograms are JSON arrays so the triggers can bump a single slot
+# with json_set().
+
+HYPO_THRESHOLD = 70
+HYPER_THRESHOLD = 180
+
+EMPTY_HOURS = json.dumps([0] * 24)
+
+SUMMARY_COLUMNS = ["day", "reading_count", "glucose_sum", "glucose_sum_sq", "glucose_min",
+                   "glucose_max", "hypo_count", "hyper_count", "hour_counts", "hour_sums"]
+
+
+def _merge_rows(existing, new):
+    # Combine two summary rows for the same day (tuples in SUMMARY_COLUMNS order)
+    return (new[0], existing[1] + new[1], existing[2] + new[2], existing[3] + new[3],
+            min(existing[4], new[4]), max(existing[5], new[5]),
+            existing[6] + new[6], existing[7] + new[7],
+            json.dumps((np.array(json.loads(existing[8])) + json.loads(new[8])).tolist()),
+            json.dumps((np.array(json.loads(existing[9])) + json.loads(new[9])).tolist()))
+
+
+def summarize_readings(reading_times, levels):
+    # Summary rows for a batch of one user's readings; reading_times are
+    # 'YYYY-MM-DD HH:MM:SS' strings
+    reading_times = np.asarray(reading_times, dtype="U19")
+    levels = np.asarray(levels, dtype=float)
+    days, rows = np.unique(reading_times.astype("U10"), return_inverse=True)
+    # Hour digits straight from the UCS-4 code points; like the trigger's
+    # CAST, anything that is not two digits counts as hour 0
+    digits = reading_times.view(np.uint32).reshape(-1, 19)[:, 11:13].astype(np.int64) - ord("0")
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    hours = np.where(valid, digits[:, 0] * 10 + digits[:, 1], 0)
+    n_days = len(days)
+
+    def per_day(weights=None):
+        return np.bincount(rows, weights=weights, minlength=n_days)
+
+    lows = np.full(n_days, np.inf)
+    highs = np.full(n_days, -np.inf)
+    np.minimum.at(lows, rows, levels)
+    np.maximum.at(highs, rows, levels)
+    slots = rows * 24 + hours
+    hour_counts = np.bincount(slots, minlength=n_days * 24).reshape(n_days, 24)
+    hour_sums = np.bincount(slots, weights=levels, minlength=n_days * 24).reshape(n_days, 24)
+
+    return list(zip(days.tolist(), per_day().tolist(), per_day(levels).tolist(),
+                    per_day(levels * levels).tolist(), lows.tolist(), highs.tolist(),
+                    per_day(levels < HYPO_THRESHOLD).astype(int).tolist(),
+                    per_day(levels > HYPER_THRESHOLD).astype(int).tolist(),
+                    [json.dumps(counts) for counts in hour_counts.tolist()],
+                    [json.dumps(sums) for sums in hour_sums.tolist()]))
+
+
+def record_readings(conn, user_id, reading_times, levels):
+    # Bulk equivalent of trg_daily_glucose_summary_insert. Days the user
+    # already has rows for are merged in Python, then everything is written
+    # back in one executemany.
+    summary = summarize_readings(reading_times, levels)
+    if not summary:
+        return
+    existing = {row[0]: row for row in conn.execute(f"""
+        SELECT {", ".join(SUMMARY_COLUMNS)} FROM daily_glucose_summary
+        WHERE user_id = ? AND day >= ? AND day <= ?
+    """, (user_id, summary[0][0], summary[-1][0]))}
+    rows = [_merge_rows(existing[row[0]], row) if row[0] in existing else row for row in summary]
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO daily_glucose_summary (user_id, {", ".join(SUMMARY_COLUMNS)})
+        VALUES (?, {", ".join("?" * len(SUMMARY_COLUMNS))})
+    """, [(user_id, *row) for row in rows])
+
+
+def rebuild_summary(conn, user_id=None):
+    # Recompute from glucose_readings, for backfills and repairs
+    where, params = ("AND user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM daily_glucose_summary WHERE true {where}", params)
+    users = conn.execute(f"""
+        SELECT DISTINCT user_id FROM glucose_readings WHERE true {where}
+    """, params).fetchall()
+    for (uid,) in users:
+        readings = conn.execute("""
+            SELECT substr(reading_time, 1, 19), glucose_level FROM glucose_readings
+            WHERE user_id = ? AND glucose_level IS NOT NULL AND reading_time IS NOT NULL
+        """, (uid,)).fetchall()
+        if readings:
+            times, levels = zip(*readings)
+            record_readings(conn, uid, times, levels)
+
+
+def load_daily_summary(conn, user_id, since_day):
+    # Days from since_day ('YYYY-MM-DD') on, oldest first, with derived
+    # mean/std columns and the hour histograms parsed into 24-item lists
+    df = pd.read_sql_query(f"""
+        SELECT {", ".join(SUMMARY_COLUMNS)} FROM daily_glucose_summary
+        WHERE user_id = ? AND day >= ?
+        ORDER BY day
+    """, conn, params=(user_id, since_day))
+    df["mean"] = df["glucose_sum"] / df["reading_count"]
+    variance = df["glucose_sum_sq"] / df["reading_count"] - df["mean"] ** 2
+    df["std"] = np.sqrt(variance.clip(lower=0))
+    for column in ("hour_counts", "hour_sums"):
+        df[column] = [json.loads(value) for value in df[column]]
+    return df
+
+
+def hourly_profile(summary):
+    # Mean glucose by hour of day across the summarized days, for hours
+    # that have readings
+    counts = np.array(summary["hour_counts"].tolist(), dtype=float).reshape(-1, 24).sum(axis=0)
+    sums = np.array(summary["hour_sums"].tolist(), dtype=float).reshape(-1, 24).sum(axis=0)
+    hours = np.nonzero(counts)[0]
+    return pd.DataFrame({"hour": [f"{hour:02d}" for hour in hours],
+                         "glucose_level": sums[hours] / counts[hours]})
+
+
+def window_totals(summary):
+    # Aggregate statistics over every day in the summary
+    count = summary["reading_count"].sum()
+    return {
+        "reading_count": int(count),
+        "mean": float(summary["glucose_sum"].sum() / count) if count else float("nan"),
+        "hypo_count": int(summary["hypo_count"].sum()),
+        "hyper_count": int(summary["hyper_count"].sum()),
+    }
@@ -0,0 +1,319 @@
+import argparse
+import csv
+import io
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import glucose_blocks
+import glucose_series
+import glucose_summary
+from queries import TIMESTAMP_FORMAT
+
+# Bulk import of glucose readings from CGM / meter CSV exports. Files are read
+# in chunks straight off the stream, so a multi-year CGM export never has to
+# fit in memory; every chunk is validated, deduplicated on
+# (user_id, reading_time) and written with executemany, with the derived
+# tables brought up to date in the same transaction.
+#
+# Chunks are committed together in transactions of up to COMMIT_ROWS rows,
+# which covers a couple of years of CGM data, so most files are one
+# transaction. Larger files commit every COMMIT_ROWS rows, about two seconds
+# of holding the write lock, well inside the busy_timeout the app's writes
+# wait for. A failed import keeps the transactions already committed;
+# importing the file again skips them as duplicates.
+
+CHUNK_SIZE = 50_000
+COMMIT_ROWS = 250_000
+
+# Readings outside what meters can report are treated as invalid
+MIN_GLUCOSE = 20
+MAX_GLUCOSE = 600
+MMOL_TO_MGDL = 18.0
+
+# Known export layouts, matched on lower-cased header names. 'time' and
+# 'glucose' list candidate columns (first match wins, several glucose columns
+# are coalesced in order), 'filter' keeps only rows whose column has one of
+# the given values, and 'time_formats' are tried in turn for each chunk.
+FORMATS = {
+    "dexcom": {
+        "time": ["timestamp (yyyy-mm-ddthh:mm:ss)"],
+        "glucose": ["glucose value (mg/dl)", "glucose value (mmol/l)"],
+        "filter": ("event type", {"EGV"}),
+        "time_formats": ["%Y-%m-%dT%H:%M:%S"],
+        "text_values": {"Low": 40, "High": 400},
+    },
+    "libre": {
+        "time": ["device timestamp"],
+        "glucose": ["historic glucose mg/dl", "scan glucose mg/dl",
+                    "historic glucose mmol/l", "scan glucose mmol/l"],
+        "filter": ("record type", {"0", "1"}),
+        "time_formats": ["%m-%d-%Y %I:%M %p", "%d-%m-%Y %H:%M", "%m-%d-%Y %H:%M"],
+    },
+    "generic": {
+        "time": ["reading_time", "timestamp", "datetime", "date time", "time"],
+        "glucose": ["glucose_level", "glucose (mg/dl)", "glucose", "glucose (mmol/l)",
+                    "bg", "value"],
+        "time_formats": [None],
+    },
+}
+
+# The per-row insert triggers cost more than the inserts themselves, so each
+# transaction drops them once and applies one aggregated update per chunk
+# instead. The DROP and the re-CREATE commit (or roll back) together with the
+# rows, so no other connection ever sees glucose_readings without its
+# triggers. Dropping a trigger is a schema change that makes every other
+# connection re-prepare its statements, which is why it happens once per
+# transaction rather than once per chunk.
+SUSPENDED_TRIGGERS = ["trg_user_stats_glucose_insert", "trg_glucose_rollups_insert",
+                      "trg_daily_glucose_summary_insert"]
+
+# How many leading lines to search for the header row (LibreView and Dexcom
+# both put metadata above it)
+HEADER_SEARCH_LINES = 20
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _open_text(source):
+    # Accepts a path or a binary file object such as Streamlit's UploadedFile
+    if isinstance(source, (str, Path)):
+        return open(source, newline="", encoding="utf-8-sig")
+    return io.TextIOWrapper(source, newline="", encoding="utf-8-sig")
+
+
+def _resolve_columns(header, fmt):
+    lowered = [name.strip().lower() for name in header]
+    time_column = next((lowered.index(name) for name in fmt["time"] if name in lowered), None)
+    glucose_columns = [lowered.index(name) for name in fmt["glucose"] if name in lowered]
+    if time_column is None or not glucose_columns:
+        return None
+    filter_column = None
+    if "filter" in fmt:
+        if fmt["filter"][0] not in lowered:
+            return None
+        filter_column = lowered.index(fmt["filter"][0])
+    return time_column, glucose_columns, filter_column
+
+
+def detect_format(stream, format_name=None):
+    # Consumes lines up to and including the header row, leaving the stream
+    # positioned on the first data row. Returns (format name, header, columns).
+    candidates = [format_name] if format_name else list(FORMATS)
+    for _ in range(HEADER_SEARCH_LINES):
+        line = stream.readline()
+        if not line:
+            break
+        header = next(csv.reader([line]), [])
+        for name in candidates:
+            columns = _resolve_columns(header, FORMATS[name])
+            if columns:
+                return name, header, columns
+    raise ImportFormatError("Unrecognised file: no known glucose export header found")
+
+
+def _parse_times(values, formats):
+    # Try each candidate format on the whole chunk and keep the one that
+    # parses the most rows
+    best = None
+    for fmt in formats:
+        parsed = pd.to_datetime(values, format=fmt or "ISO8601", errors="coerce")
+        if best is None or parsed.notna().sum() > best.notna().sum():
+            best = parsed
+        if not best.isna().any():
+            break
+    return best
+
+
+def _glucose_values(chunk, header, glucose_columns, fmt):
+    text_values = fmt.get("text_values", {})
+    levels = None
+    for column in glucose_columns:
+        values = chunk[column]
+        if values.dtype.kind not in "if":
+            if text_values:
+                values = values.replace(text_values)
+            values = pd.to_numeric(values, errors="coerce")
+        if "mmol" in header[column].lower():
+            values = values * MMOL_TO_MGDL
+        levels = values if levels is None else levels.fillna(values)
+    return levels.to_numpy(dtype=float)
+
+
+def _format_times(times):
+    # datetime64 -> 'YYYY-MM-DD HH:MM:SS', matching queries.TIMESTAMP_FORMAT.
+    # ISO output has 'T' at index 10; overwrite it in place through a UCS-4
+    # code point view rather than a per-string replace.
+    text = np.datetime_as_string(times.to_numpy(dtype="datetime64[s]"), unit="s").astype("U19")
+    text.view(np.uint32).reshape(-1, 19)[:, 10] = ord(" ")
+    return text
+
+
+def _existing_times(conn, user_id, first, last):
+    # Timestamps already stored for this user across the chunk's span, served
+    # from the (user_id, reading_time) index. App-entered readings carry
+    # microseconds, so compare on whole seconds.
+    upper = (last + timedelta(seconds=1)).strftime(TIMESTAMP_FORMAT)
+    rows = conn.execute("""
+        SELECT reading_time FROM glucose_readings
+        WHERE user_id = ? AND reading_time >= ? AND reading_time < ?
+    """, (user_id, first.strftime(TIMESTAMP_FORMAT), upper))
+    return {str(row[0])[:19] for row in rows}
+
+
+def _import_chunk(conn, chunk, user_id, header, columns, fmt, stats):
+    time_column, glucose_columns, filter_column = columns
+    stats["rows"] += len(chunk)
+    if filter_column is not None:
+        kept = chunk[chunk[filter_column].isin(fmt["filter"][1])]
+        stats["skipped"] += len(chunk) - len(kept)
+        chunk = kept
+    if chunk.empty:
+        return
+
+    times = _parse_times(chunk[time_column], fmt["time_formats"])
+    levels = _glucose_values(chunk, header, glucose_columns, fmt)
+    valid = (times.notna().to_numpy() & (levels >= MIN_GLUCOSE) & (levels <= MAX_GLUCOSE))
+    stats["invalid"] += int((~valid).sum())
+    if not valid.any():
+        return
+
+    frame = pd.DataFrame({"reading_time": _format_times(times[valid]),
+                          "glucose_level": np.round(levels[valid], 1)})
+    # Duplicates inside the file, then against what is already stored
+    before = len(frame)
+    frame = frame.drop_duplicates("reading_time")
+    existing = _existing_times(conn, user_id, times[valid].min(), times[valid].max())
+    if existing:
+        frame = frame[~frame["reading_time"].isin(existing)]
+    stats["duplicates"] += before - len(frame)
+
+    if frame.empty:
+        return
+    conn.executemany("""
+        INSERT INTO glucose_readings (user_id, glucose_level, reading_time)
+        VALUES (?, ?, ?)
+    """, zip([user_id] * len(frame), frame["glucose_level"].tolist(),
+             frame["reading_time"].tolist()))
+    _update_user_stats(conn, user_id, len(frame), frame["reading_time"].max())
+    glucose_series.record_readings(conn, user_id, frame["reading_time"], frame["glucose_level"])
+    glucose_summary.record_readings(conn, user_id, frame["reading_time"], frame["glucose_level"])
+    glucose_blocks.record_readings(conn, user_id, frame["reading_time"], frame["glucose_level"])
+    stats["imported"] += len(frame)
+
+
+def _update_user_stats(conn, user_id, count, last_reading_at):
+    # What trg_user_stats_glucose_insert does per row, once per chunk
+    conn.execute("""
+        INSERT INTO user_stats (user_id, reading_count, last_reading_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            reading_count = reading_count + excluded.reading_count,
+            last_reading_at = CASE
+                WHEN last_reading_at IS NULL OR excluded.last_reading_at > last_reading_at
+                THEN excluded.last_reading_at ELSE last_reading_at END
+    """, (user_id, count, last_reading_at))
+
+
+def suspend_trigger(conn, name):
+    # Returns the trigger's definition so it can be re-created before commit
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                       (name,)).fetchone()
+    if row:
+        conn.execute(f"DROP TRIGGER {name}")
+    return row[0] if row else None
+
+
+def _import_chunks(conn, chunks, user_id, header, columns, fmt, stats, commit_rows, progress):
+    # Runs chunks in transactions of at least commit_rows rows (the last one
+    # takes what is left); stats only keep a transaction's counts once it
+    # has committed
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+    while chunk is not None:
+        committed = dict(stats)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            triggers = [suspend_trigger(conn, name) for name in SUSPENDED_TRIGGERS]
+            rows = 0
+            while chunk is not None and rows < commit_rows:
+                _import_chunk(conn, chunk, user_id, header, columns, fmt, stats)
+                rows += len(chunk)
+                if progress:
+                    progress(stats)
+                chunk = next(chunks, None)
+            for trigger_sql in filter(None, triggers):
+                conn.execute(trigger_sql)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            stats.update(committed)
+            raise
+
+
+def import_readings(conn, source, user_id, format_name=None, chunk_size=CHUNK_SIZE,
+                    progress=None, commit_rows=COMMIT_ROWS):
+    # source: a path or binary file object. progress, if given, is called with
+    # the running stats after each chunk and may raise to stop the import;
+    # bytes_read is how far into the file the parser has got. Returns the
+    # final stats dict.
+    stats = {"format": None, "rows": 0, "skipped": 0, "invalid": 0,
+             "duplicates": 0, "imported": 0, "bytes_read": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    stream = _open_text(source)
+    try:
+        name, header, columns = detect_format(stream, format_name)
+        stats["format"] = name
+        fmt = FORMATS[name]
+        # Text columns stay strings; glucose columns are left to the C parser,
+        # which only falls back to strings for files with values like 'Low'
+        text_columns = [columns[0]] + ([columns[2]] if columns[2] is not None else [])
+        used = sorted(set(text_columns + columns[1]))
+
+        chunks = pd.read_csv(stream, header=None, usecols=used,
+                             dtype={column: str for column in text_columns},
+                             chunksize=chunk_size, skip_blank_lines=True, on_bad_lines="skip")
+
+        def report(stats):
+            stats["bytes_read"] = stream.buffer.tell()
+            if progress:
+                progress(stats)
+
+        _import_chunks(conn, chunks, user_id, header, columns, fmt, stats, commit_rows, report)
+    finally:
+        if isinstance(source, (str, Path)):
+            stream.close()
+        else:
+            # Leave the caller's file object open
+            stream.detach()
+
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure, get_connection
+
+    parser = argparse.ArgumentParser(description="Import glucose readings from CGM/meter CSV exports")
+    parser.add_argument("files", nargs="+", help="CSV export(s) to import")
+    parser.add_argument("--user-id", required=True, help="patient the readings belong to")
+    parser.add_argument("--format", choices=sorted(FORMATS), help="skip header auto-detection")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    args = parser.parse_args()
+
+    user_id = int(args.user_id) if args.user_id.isdigit() else args.user_id
+    configure(args.db)
+    with get_connection() as conn:
+        for path in args.files:
+            stats = import_readings(conn, path, user_id, args.format, args.chunk_size)
+            rate = stats["imported"] / stats["seconds"] if stats["seconds"] else 0
+            print(f"{path}: {stats['format']} export, imported {stats['imported']} of "
+                  f"{stats['rows']} rows ({stats['duplicates']} duplicates, "
+                  f"{stats['invalid']} invalid, {stats['skipped']} other events) "
+                  f"in {stats['seconds']:.2f}s ({rate:,.0f} readings/s)")
@@ -0,0 +1,360 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from adherence import load_adherence, summary_frame
+from database import execute_write, get_connection, get_pool, run_write
+from exporter import DATASETS, MIME_TYPES, count_rows, export, export_filename
+from importer import import_readings
+from queries import TIMESTAMP_FORMAT
+from query_cache import invalidate_all, invalidate_user
+from retention import BATCH_PAUSE, BATCH_ROWS, RETENTION_TABLES, purge_old_data
+from streaks import rebuild_bitmap, rebuild_streak
+
+# Background jobs for work too slow for a Streamlit rerun (exports, purges,
+# bulk imports). Each job is a row in the jobs table and runs on a small
+# thread pool inside the app process. SQLite and the export writers spend
+# most of their time outside the GIL, and threads can share the connection
+# pool and query cache, which worker processes could not.
+#
+# A job function is registered with @job_kind(name) and called as
+# fn(conn, job, **params). It reports progress with job.report(), which also
+# raises JobCancelled once the job has been cancelled, and returns a
+# JSON-serializable result. Result files go to job.result_path() and are
+# deleted with the job row after RESULT_RETENTION_DAYS.
+#
+#   queued -> running -> succeeded | failed | cancelled
+
+MAX_WORKERS = 2
+PROGRESS_INTERVAL = 1.0  # seconds between progress writes
+STATUS_TIMEOUT = 0.5  # progress writes are skipped rather than wait on a writer
+RESULT_RETENTION_DAYS = 7
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+JOB_COLUMNS = ["job_id", "kind", "params", "owner", "status", "progress", "message", "result",
+               "error", "cancel_requested", "created_at", "started_at", "finished_at"]
+
+JOB_KINDS = {}
+
+
+def job_kind(name):
+    def register(fn):
+        JOB_KINDS[name] = fn
+        return fn
+    return register
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.now().strftime(TIMESTAMP_FORMAT)
+
+
+class Job:
+    # Handle passed to a running job function
+    def __init__(self, job_id, runner):
+        self.job_id = job_id
+        self.progress = 0.0
+        self.message = None
+        self._runner = runner
+        self._cancel = threading.Event()
+        self._reported_at = 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def report(self, progress=None, message=None):
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        now = time.monotonic()
+        if now - self._reported_at >= PROGRESS_INTERVAL:
+            self._reported_at = now
+            self._runner._write_progress(self)
+        if self.cancelled:
+            raise JobCancelled()
+
+    def result_path(self, suffix):
+        self._runner.results_dir.mkdir(parents=True, exist_ok=True)
+        return self._runner.results_dir / f"job_{self.job_id}{suffix}"
+
+
+class JobRunner:
+    def __init__(self, db_path, max_workers=MAX_WORKERS):
+        self.db_path = Path(db_path)
+        self.results_dir = self.db_path.parent / "job_results"
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._active = {}
+        self._lock = threading.Lock()
+        # Progress goes through its own connection with a short busy timeout,
+        # so a job holding the write lock never stalls on its own reports
+        self._status_conn = sqlite3.connect(str(self.db_path), timeout=STATUS_TIMEOUT,
+                                            check_same_thread=False)
+        self._status_lock = threading.Lock()
+        self._recover()
+
+    def _recover(self):
+        # Jobs left queued or running by a previous process cannot resume
+        cutoff = (datetime.now() - timedelta(days=RESULT_RETENTION_DAYS)).strftime(TIMESTAMP_FORMAT)
+
+        def recover(conn):
+            conn.execute(f"""
+                UPDATE jobs SET status = ?, error = 'Interrupted by an app restart', finished_at = ?
+                WHERE status IN ({", ".join("?" * len(ACTIVE))})
+            """, (FAILED, _now(), *ACTIVE))
+            expired = [row[0] for row in conn.execute(
+                "SELECT job_id FROM jobs WHERE finished_at < ?", (cutoff,))]
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+            return expired
+
+        for job_id in run_write(recover):
+            self._remove_results(job_id)
+
+    def _remove_results(self, job_id):
+        for path in self.results_dir.glob(f"job_{job_id}.*"):
+            path.unlink(missing_ok=True)
+
+    def submit(self, kind, params=None, owner=None):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        params = params or {}
+        job_id = execute_write("""
+            INSERT INTO jobs (kind, params, owner, status, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (kind, json.dumps(params), owner, QUEUED, _now()))
+        job = Job(job_id, self)
+        with self._lock:
+            self._active[job_id] = job
+        self._executor.submit(self._run, job, kind, params)
+        return job_id
+
+    def cancel(self, job_id):
+        # Jobs of this process are flagged in memory and stop at their next
+        # report(), or before starting if still queued. The table write is
+        # best effort for them, since a long-running reader can hold off
+        # writers; anything else is cancelled through the table.
+        with self._lock:
+            job = self._active.get(job_id)
+        if job is not None:
+            job.cancel()
+            job.message = "Cancelling..."
+            self._write_progress(job, cancel=True)
+            return
+        execute_write("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = ?",
+                      (job_id, RUNNING))
+
+    def _run(self, job, kind, params):
+        try:
+            started = run_write(lambda conn: conn.execute("""
+                UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ? AND status = ?
+            """, (RUNNING, _now(), job.job_id, QUEUED)).rowcount)
+            if not started:
+                return
+            status, result, error = SUCCEEDED, None, None
+            with get_connection() as conn:
+                try:
+                    if job.cancelled:
+                        raise JobCancelled()
+                    result = JOB_KINDS[kind](conn, job, **params)
+                    job.progress = 1.0
+                except JobCancelled:
+                    status = CANCELLED
+                except Exception as e:
+                    status, error = FAILED, f"{type(e).__name__}: {e}"
+            execute_write("""
+                UPDATE jobs SET status = ?, progress = ?, message = ?, result = ?, error = ?,
+                                finished_at = ?
+                WHERE job_id = ?
+            """, (status, job.progress, job.message,
+                  None if result is None else json.dumps(result), error, _now(), job.job_id))
+            if status != SUCCEEDED:
+                self._remove_results(job.job_id)
+        finally:
+            with self._lock:
+                self._active.pop(job.job_id, None)
+
+    def _write_progress(self, job, cancel=False):
+        # Best effort: a busy database just means this update is skipped.
+        # Also picks up cancellations requested through the table.
+        try:
+            with self._status_lock, self._status_conn:
+                self._status_conn.execute("""
+                    UPDATE jobs SET progress = ?, message = ?, cancel_requested = cancel_requested OR ?
+                    WHERE job_id = ?
+                """, (job.progress, job.message, cancel, job.job_id))
+                requested = self._status_conn.execute(
+                    "SELECT cancel_requested FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+        except sqlite3.OperationalError:
+            return
+        if requested and requested[0]:
+            job.cancel()
+
+    def live_progress(self, job_id):
+        with self._lock:
+            job = self._active.get(job_id)
+        return None if job is None else (job.progress, job.message)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    # Follows database.configure() onto another database file
+    global _runner
+    db_path = get_pool().db_path
+    if _runner is None or _runner.db_path != db_path:
+        with _runner_lock:
+            if _runner is None or _runner.db_path != db_path:
+                _runner = JobRunner(db_path)
+    return _runner
+
+
+def submit_job(kind, params=None, owner=None):
+    return get_runner().submit(kind, params, owner)
+
+
+def cancel_job(job_id):
+    get_runner().cancel(job_id)
+
+
+def _job_dict(row, runner):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = None if job["result"] is None else json.loads(job["result"])
+    # The table is only written once a second; prefer the in-memory progress
+    live = runner.live_progress(job["job_id"]) if job["status"] in ACTIVE else None
+    if live is not None:
+        job["progress"], job["message"] = live[0], live[1] or job["message"]
+    return job
+
+
+def get_job(conn, job_id):
+    row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return None if row is None else _job_dict(row, get_runner())
+
+
+def list_jobs(conn, owner=None, limit=10):
+    # Most recent first
+    where, params = ("WHERE owner = ?", (owner,)) if owner is not None else ("", ())
+    rows = conn.execute(f"""
+        SELECT {', '.join(JOB_COLUMNS)} FROM jobs {where} ORDER BY job_id DESC LIMIT ?
+    """, (*params, limit)).fetchall()
+    runner = get_runner()
+    return [_job_dict(row, runner) for row in rows]
+
+
+@job_kind("export")
+def run_export(conn, job, fmt, datasets, user_ids=None, days=None, adherence_days=None,
+               prefix="patient_export"):
+    # Adherence is only added for single-patient exports, as the tab did inline
+    extra_frames = None
+    if adherence_days and user_ids and len(user_ids) == 1:
+        extra_frames = {"Adherence": summary_frame(load_adherence(conn, user_ids, days=adherence_days))}
+    file_name = export_filename(fmt, datasets, extra_frames, prefix=prefix)
+    path = job.result_path(Path(file_name).suffix)
+    totals = [count_rows(conn, dataset, user_ids, days) for dataset in datasets]
+    total = max(sum(totals), 1)
+
+    def progress(dataset, rows):
+        done = sum(totals[:datasets.index(dataset)]) + rows
+        job.report(done / total, f"{DATASETS[dataset][0]}: {rows:,} rows")
+
+    counts = export(conn, path, fmt, tuple(datasets), user_ids, days, extra_frames, progress=progress)
+    job.report(1.0, f"Exported {sum(counts.values()):,} rows")
+    return {"path": str(path), "file_name": file_name, "mime": MIME_TYPES[path.suffix], "rows": counts}
+
+
+DAILY_MEDICATION = "med_name = 'Daily Medication'"
+
+
+def _clear_daily_medication_batch(conn, start, end):
+    # Deletes the entries with ids in [start, end] and rebuilds the streaks
+    # and adherent-day bitmaps of the users they belonged to
+    where = f"id BETWEEN ? AND ? AND {DAILY_MEDICATION}"
+    users = [row[0] for row in conn.execute(f"SELECT DISTINCT user_id FROM medications WHERE {where}",
+                                            (start, end))]
+    deleted = conn.execute(f"DELETE FROM medications WHERE {where}", (start, end)).rowcount
+    for user_id in users:
+        rebuild_streak(conn, user_id)
+        rebuild_bitmap(conn, user_id)
+    return deleted
+
+
+@job_kind("clear_daily_medication")
+def clear_daily_medication(conn, job):
+    # Batched by id range through the writer like retention purges, so app
+    # writes get the lock between batches instead of waiting on one DELETE
+    total, start, last = conn.execute(f"""
+        SELECT COUNT(*), MIN(id), MAX(id) FROM medications WHERE {DAILY_MEDICATION}
+    """).fetchone()
+    deleted = 0
+    try:
+        while total and start is not None and start <= last:
+            end = conn.execute(f"""
+                SELECT MAX(id) FROM (
+                    SELECT id FROM medications WHERE id >= ? AND {DAILY_MEDICATION}
+                    ORDER BY id LIMIT ?)
+            """, (start, BATCH_ROWS)).fetchone()[0]
+            if end is None:
+                break
+            deleted += run_write(_clear_daily_medication_batch, start, end)
+            start = end + 1
+            job.report(deleted / total, f"Removed {deleted:,} of {total:,} entries")
+            time.sleep(BATCH_PAUSE)
+    finally:
+        # Batches committed before a cancellation or failure stay deleted
+        invalidate_all()
+    job.report(1.0, f"Removed {deleted:,} entries")
+    return {"deleted": deleted}
+
+
+@job_kind("purge_old_data")
+def run_purge(conn, job, days_to_keep, tables=None, archive=False):
+    tables = [table for table in RETENTION_TABLES if tables is None or table in tables]
+
+    def progress(table, deleted, expired):
+        done = tables.index(table) + deleted / max(expired, 1)
+        job.report(done / len(tables), f"{RETENTION_TABLES[table][0]}: {deleted:,} of {expired:,} rows")
+
+    # Archives are kept outside job_results so they never expire with the job
+    archive_dir = get_pool().db_path.parent / "archive" if archive else None
+    try:
+        result = purge_old_data(conn, days_to_keep, tables, archive_dir, progress=progress)
+    finally:
+        # Batches committed before a cancellation or failure stay purged
+        invalidate_all()
+    job.report(1.0, f"Removed {sum(result['deleted'].values()):,} rows")
+    return result
+
+
+@job_kind("import_readings")
+def run_import(conn, job, path, user_id, format_name=None, remove_source=False):
+    size = Path(path).stat().st_size
+
+    def progress(stats):
+        job.report(stats["bytes_read"] / max(size, 1),
+                   f"{stats['rows']:,} rows read, {stats['imported']:,} imported")
+
+    try:
+        stats = import_readings(conn, path, user_id, format_name, progress=progress)
+    finally:
+        # Transactions committed before a cancellation or failure stay imported
+        invalidate_user(user_id)
+        if remove_source:
+            Path(path).unlink(missing_ok=True)
+    job.report(1.0, f"Imported {stats['imported']:,} readings")
+    return stats
@@ -0,0 +1,222 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+
+import database
+from database import POOL_SIZE, WRITE_BACKOFF, WRITE_RETRIES, get_connection, is_busy, run_write
+from glucose_series import load_series
+from glucose_summary import load_daily_summary
+from queries import latest_glucose, since_date
+from streaks import current_streak, record_dose
+from triage import load_triage
+
+# Multi-threaded load test for the connection layer. Simulated patients log
+# glucose and doses and load their home page while providers run the triage
+# panel and chart reads, all through one process-wide pool as Streamlit
+# sessions do. Writes go through the group-commit writer thread. --direct
+# runs them on pooled connections instead, one BEGIN IMMEDIATE transaction
+# per write with retries, and --legacy additionally uses the old settings
+# (rollback journal, synchronous=FULL, deferred transactions, no retries).
+#
+#   python loadtest.py --patients 300 --providers 20 --seconds 30
+#   python loadtest.py --think 0.01 [--direct]   # write throughput under contention
+
+LEGACY_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000}
+
+# Patient operations and their weights
+PATIENT_MIX = {"log_glucose": 0.7, "log_medication": 0.1, "home": 0.2}
+PROVIDER_MIX = {"triage": 0.2, "chart": 0.5, "summary": 0.3}
+
+
+def seed(db_path, patients, days):
+    # Accounts plus `days` of 15-minute readings per patient, loaded through
+    # the triggers so every derived table is populated
+    database.configure(db_path)
+    with get_connection() as conn:
+        with conn:
+            conn.executemany("INSERT INTO user_accounts (full_name, username) VALUES (?, ?)",
+                             [(f"Patient {n}", f"patient{n}") for n in range(1, patients + 1)])
+            conn.execute("""
+                WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < ? - 1)
+                INSERT INTO glucose_readings (user_id, glucose_level, reading_time)
+                SELECT user_id, 60 + abs(random() % 200),
+                       datetime('now', '-' || (n * 15) || ' minutes')
+                FROM seq, (SELECT user_id FROM user_accounts)
+            """, (days * 96,))
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+
+    def timed(self, name, fn, *args):
+        started = time.perf_counter()
+        try:
+            fn(*args)
+        except sqlite3.Error as e:
+            with self._lock:
+                self.errors[name][str(e)] += 1
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[name].append(elapsed)
+
+    def report(self, seconds):
+        print(f"{'operation':16s} {'ops':>7s} {'ops/s':>7s} {'p50 ms':>8s} {'p95 ms':>8s} "
+              f"{'p99 ms':>8s} {'max ms':>8s} {'errors':>7s}")
+        for name in list(PATIENT_MIX) + list(PROVIDER_MIX):
+            samples = np.array(self.latencies.get(name, [])) * 1000
+            errors = sum(self.errors[name].values())
+            if not len(samples) and not errors:
+                continue
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if len(samples) else (np.nan,) * 3
+            print(f"{name:16s} {len(samples):7d} {len(samples) / seconds:7.1f} {p50:8.1f} {p95:8.1f} "
+                  f"{p99:8.1f} {samples.max() if len(samples) else np.nan:8.1f} {errors:7d}")
+        for name, errors in self.errors.items():
+            for message, count in errors.most_common(3):
+                print(f"  {name}: {count} x {message}")
+
+
+def _legacy_write(fn, *args):
+    # The old pattern: implicit deferred transaction, commit, no retry
+    with get_connection() as conn:
+        with conn:
+            fn(conn, *args)
+
+
+def _direct_write(fn, *args):
+    # One transaction per write on a pooled connection, as before the writer
+    # thread: every session queues on the write lock by itself
+    with get_connection() as conn:
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if not is_busy(e) or attempt == WRITE_RETRIES:
+                    raise
+                time.sleep(WRITE_BACKOFF * 2 ** attempt * (0.5 + random.random()))
+        try:
+            fn(conn, *args)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def _log_glucose(conn, user_id, level):
+    conn.execute("""
+        INSERT INTO glucose_readings (user_id, glucose_level, reading_time)
+        VALUES (?, ?, datetime('now'))
+    """, (user_id, level))
+
+
+def _log_medication(conn, user_id, today):
+    conn.execute("""
+        INSERT INTO medications (user_id, med_name, dosage, time_taken, date)
+        VALUES (?, 'Metformin', 500, ?, ?)
+    """, (user_id, datetime.now().strftime('%H:%M:%S'), today))
+    record_dose(conn, user_id, today)
+
+
+def _home(user_id, today):
+    with get_connection() as conn:
+        latest_glucose(conn, user_id)
+        current_streak(conn, user_id, today)
+
+
+def _read(load, *args):
+    with get_connection() as conn:
+        load(conn, *args)
+
+
+WRITERS = {"legacy": _legacy_write, "direct": _direct_write, "queued": run_write}
+
+
+def patient(recorder, user_id, deadline, think, mode):
+    write = WRITERS[mode]
+    names, weights = zip(*PATIENT_MIX.items())
+    while time.monotonic() < deadline:
+        time.sleep(random.expovariate(1 / think))
+        today = datetime.now().date()
+        name = random.choices(names, weights)[0]
+        if name == "log_glucose":
+            recorder.timed(name, write, _log_glucose, user_id, random.randint(60, 260))
+        elif name == "log_medication":
+            recorder.timed(name, write, _log_medication, user_id, today)
+        else:
+            recorder.timed(name, _home, user_id, today)
+
+
+def provider(recorder, patients, deadline, think):
+    names, weights = zip(*PROVIDER_MIX.items())
+    while time.monotonic() < deadline:
+        time.sleep(random.expovariate(1 / think))
+        name = random.choices(names, weights)[0]
+        user_id = random.randint(1, patients)
+        if name == "triage":
+            recorder.timed(name, _read, load_triage)
+        elif name == "chart":
+            recorder.timed(name, _read, load_series, user_id, 30)
+        else:
+            recorder.timed(name, _read, load_daily_summary, user_id, since_date(90))
+
+
+def run(db_path, patients, providers, seconds, think, mode, pool_size):
+    database.configure(db_path, pool_size, pragmas=LEGACY_PRAGMAS if mode == "legacy" else None)
+    recorder = Recorder()
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=patient, args=(recorder, user_id, deadline, think, mode))
+               for user_id in range(1, patients + 1)]
+    threads += [threading.Thread(target=provider, args=(recorder, patients, deadline, think))
+                for _ in range(providers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent patient/provider load test")
+    parser.add_argument("--patients", type=int, default=300, help="concurrent patient threads")
+    parser.add_argument("--providers", type=int, default=20, help="concurrent provider threads")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--think", type=float, default=1.0, help="mean pause between operations (s)")
+    parser.add_argument("--history-days", type=int, default=14, help="seeded readings per patient")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE)
+    parser.add_argument("--legacy", action="store_true", help="pre-WAL settings without retries")
+    parser.add_argument("--direct", action="store_true",
+                        help="per-session write transactions instead of the writer thread")
+    args = parser.parse_args()
+    mode = "legacy" if args.legacy else "direct" if args.direct else "queued"
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "load.db")
+    started = time.perf_counter()
+    seed(db_path, args.patients, args.history_days)
+    print(f"Seeded {args.patients} patients x {args.history_days} days in {time.perf_counter() - started:.1f}s")
+    if args.legacy:
+        # journal_mode is stored in the file, so switch it back explicitly
+        database.get_pool().close()
+        sqlite3.connect(db_path).execute("PRAGMA journal_mode = DELETE").fetchone()
+
+    recorder = run(db_path, args.patients, args.providers, args.seconds, args.think,
+                   mode, args.pool_size)
+    print(f"{mode} writes, {args.patients} patients, "
+          f"{args.providers} providers, {args.seconds:.0f}s")
+    recorder.report(args.seconds)
+    database.get_pool().close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
@@ -0,0 +1,109 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from queries import month_window
+
+# Calendar heatmaps of medication days. The days of a window come from one
+# grouped query (queries.load_calendar_days), or for the year-long adherence
+# heatmap from the per-year bitmaps (streaks.adherent_days), and are laid
+# out on a (weeks x 7) grid with NumPy indexing, so a month, a quarter or a year all
+# cost the same handful of array operations instead of per-cell Python.
+#
+# Each day gets a level:
+#
+#   NO_DATA   in the future, today before any dose, or before the first dose
+#   MISSED    a past day without a dose, or with every scheduled slot missed
+#   PARTIAL   doses logged but some scheduled slots missed
+#   TAKEN     doses logged and no scheduled slot missed
+
+NO_DATA, MISSED, PARTIAL, TAKEN = 0, 1, 2, 3
+LEVEL_LABELS = {NO_DATA: "No data", MISSED: "Missed", PARTIAL: "Partly taken", TAKEN: "Taken"}
+LEVEL_COLORS = {NO_DATA: "#ebedf0", MISSED: "#f4a6a6", PARTIAL: "#f9d77e", TAKEN: "#40c463"}
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+# View name: months shown, ending with the current month
+CALENDAR_VIEWS = {"Month": 1, "3 Months": 3, "Year": 12}
+
+
+def calendar_window(months, today=None):
+    # [first day of the first month, first day of next month)
+    today = today or date.today()
+    first = today.year * 12 + today.month - months
+    start, _ = month_window(first // 12, first % 12 + 1)
+    _, end = month_window(today.year, today.month)
+    return date.fromisoformat(start), date.fromisoformat(end)
+
+
+def calendar_colorscale():
+    # Discrete Plotly colorscale for z values NO_DATA..TAKEN
+    levels = sorted(LEVEL_COLORS)
+    scale = []
+    for i, level in enumerate(levels):
+        scale += [[i / len(levels), LEVEL_COLORS[level]], [(i + 1) / len(levels), LEVEL_COLORS[level]]]
+    return scale
+
+
+def day_levels(doses, scheduled, missed, days, today, first_dose=None):
+    # Level per day from per-day counts aligned on `days` (datetime64[D])
+    # Days without a dose only count as missed once the user has logged one
+    if first_dose is None:
+        observed = np.zeros(len(days), dtype=bool)
+    else:
+        observed = (days < np.datetime64(today, "D")) & (days >= np.datetime64(str(first_dose)[:10], "D"))
+    return np.where(doses > 0,
+                    np.where(missed > 0, PARTIAL, TAKEN),
+                    np.where(observed | ((scheduled > 0) & (missed > 0)), MISSED, NO_DATA))
+
+
+def calendar_grid(frame, start, end, today=None, first_dose=None):
+    # frame: load_calendar_days() rows for [start, end). Returns the (weeks x
+    # 7) level grid with day-of-month text, hover text and the Monday of each
+    # week; cells outside the window are NaN.
+    today = today or date.today()
+    days = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D"))
+    n = len(days)
+    counts = {column: np.zeros(n, dtype=np.int64) for column in ("doses", "medications", "scheduled", "missed")}
+    if not frame.empty:
+        positions = (frame["day"].to_numpy(dtype="datetime64[D]") - days[0]).astype(np.int64)
+        inside = (positions >= 0) & (positions < n)
+        for column, values in counts.items():
+            values[positions[inside]] = frame[column].to_numpy()[inside]
+    levels = day_levels(counts["doses"], counts["scheduled"], counts["missed"], days, today, first_dose)
+
+    hover = (pd.Series(days.astype(str)) + ": " + _labels()[levels]
+             + " (" + pd.Series(counts["doses"]).astype(str) + " doses, "
+             + pd.Series(counts["medications"]).astype(str) + " medications, "
+             + pd.Series(counts["missed"]).astype(str) + " scheduled missed)").to_numpy()
+    return _layout(days, start, levels, hover)
+
+
+def adherence_grid(adherent, start, end, today=None, first_dose=None):
+    # Same grid from one adherent flag per day in [start, end)
+    # (streaks.adherent_days), without dose counts
+    days = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D"))
+    none = np.zeros(len(days), dtype=np.int64)
+    levels = day_levels(adherent.astype(np.int64), none, none, days, today or date.today(), first_dose)
+    hover = (pd.Series(days.astype(str)) + ": " + _labels()[levels]).to_numpy()
+    return _layout(days, start, levels, hover)
+
+
+def _labels():
+    return np.array([LEVEL_LABELS[level] for level in sorted(LEVEL_LABELS)], dtype=object)
+
+
+def _layout(days, start, levels, hover):
+    # Places per-day values on the (weeks x 7) grid, Monday first
+    cells = np.arange(len(days)) + start.weekday()
+    weeks, weekdays = cells // 7, cells % 7
+    n_weeks = int(weeks[-1]) + 1 if len(days) else 0
+    z = np.full((n_weeks, 7), np.nan)
+    z[weeks, weekdays] = levels
+    text = np.full((n_weeks, 7), "", dtype=object)
+    text[weeks, weekdays] = (days - days.astype("datetime64[M]")).astype(np.int64) + 1
+    grid_hover = np.full((n_weeks, 7), None, dtype=object)
+    grid_hover[weeks, weekdays] = hover
+    mondays = [start - timedelta(days=start.weekday()) + timedelta(weeks=week) for week in range(n_weeks)]
+    return {"z": z, "text": text, "hover": grid_hover, "weeks": mondays, "levels": levels}
@@ -0,0 +1,605 @@
+import calendar
+import json
+import sqlite3
+from datetime import date
+
+# Schema migrations keyed off PRAGMA user_version. Each step upgrades the
+# database by exactly one version; append new steps to MIGRATIONS and never
+# edit a step that has already shipped. Steps carry their own copy of any
+# backfill SQL and constants instead of calling the live helpers in
+# streaks.py / glucose_*.py, so a later change there cannot change what an
+# old step does to a database that is still catching up.
+
+
+def _table_columns(conn, table):
+    return {row[1]: (row[2] or '').upper() for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = _table_columns(conn, table)
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _rebuild_table(conn, table, create_sql, columns):
+    # SQLite cannot change a column's type in place, so copy into a fresh table.
+    # INTEGER affinity turns numeric TEXT ids like '1' back into integers.
+    column_list = ", ".join(columns)
+    conn.execute(create_sql.replace(f"CREATE TABLE IF NOT EXISTS {table}", f"CREATE TABLE {table}_new"))
+    conn.execute(f"INSERT INTO {table}_new ({column_list}) SELECT {column_list} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+GLUCOSE_READINGS_TABLE = '''CREATE TABLE IF NOT EXISTS glucose_readings
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  glucose_level REAL,
+                  reading_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'''
+
+MEDICATIONS_TABLE = '''CREATE TABLE IF NOT EXISTS medications
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  med_name TEXT,
+                  dosage REAL,
+                  time_taken TIMESTAMP,
+                  date DATE)'''
+
+
+def _create_tables(conn):
+    conn.execute(GLUCOSE_READINGS_TABLE)
+
+    conn.execute(MEDICATIONS_TABLE)
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_accounts
+                 (user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  full_name TEXT,
+                  username TEXT UNIQUE,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS provider_messages
+                 (message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  patient_id INTEGER,
+                  provider_id INTEGER,
+                  message_content TEXT,
+                  sender_type TEXT,
+                  sent_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (patient_id) REFERENCES user_accounts(user_id),
+                  FOREIGN KEY (provider_id) REFERENCES user_accounts(user_id))''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS treatment_plans
+                 (plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  patient_id INTEGER,
+                  provider_id INTEGER,
+                  plan_content TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS community_posts
+                 (post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  content TEXT,
+                  post_type TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES user_accounts(user_id))''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS post_comments
+                 (comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  post_id INTEGER,
+                  user_id INTEGER,
+                  content TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (post_id) REFERENCES community_posts(post_id),
+                  FOREIGN KEY (user_id) REFERENCES user_accounts(user_id))''')
+
+
+def _reconcile_legacy_schemas(conn):
+    # Databases created by streamlit_appV1.py / streamlit_appV2.py keyed
+    # medications and glucose_readings by TEXT user_id
+    if _table_columns(conn, "glucose_readings")["user_id"] == "TEXT":
+        _rebuild_table(conn, "glucose_readings", GLUCOSE_READINGS_TABLE,
+                       ["id", "user_id", "glucose_level", "reading_time"])
+    legacy_medications = _table_columns(conn, "medications")
+    if legacy_medications["user_id"] == "TEXT":
+        # Both apps also kept a scheduled_time on each dose; carry it over
+        # instead of dropping it with the copy
+        columns = ["id", "user_id", "med_name", "dosage", "time_taken", "date"]
+        create_sql = MEDICATIONS_TABLE
+        if "scheduled_time" in legacy_medications:
+            columns.append("scheduled_time")
+            create_sql = create_sql[:-1] + ",\n                  scheduled_time TIME)"
+        _rebuild_table(conn, "medications", create_sql, columns)
+
+    # Columns the app inserts into that older databases never had
+    _add_missing_columns(conn, "community_posts", [("post_type", "TEXT")])
+    _add_missing_columns(conn, "provider_messages", [("read_status", "INTEGER DEFAULT 0")])
+    _add_missing_columns(conn, "treatment_plans", [("medications", "TEXT"),
+                                                   ("follow_up_date", "DATE")])
+
+
+# Secondary indexes for the per-user and per-thread lookups the app runs on
+# every rerun. Trailing columns make the hot reads covering, so SQLite never
+# has to visit the table rows.
+INDEXES = {
+    "idx_glucose_user_time": "glucose_readings (user_id, reading_time, glucose_level)",
+    "idx_medications_user_date": "medications (user_id, date, time_taken, med_name, dosage)",
+    "idx_provider_messages_patient_time": "provider_messages (patient_id, sent_time)",
+    "idx_post_comments_post_time": "post_comments (post_id, created_at)",
+    "idx_community_posts_created": "community_posts (created_at)",
+    "idx_treatment_plans_patient_created": "treatment_plans (patient_id, created_at)",
+}
+
+
+def _create_indexes(conn):
+    for name, definition in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+
+def _create_user_stats(conn):
+    # Per-user activity rollup for the provider patient list, kept current by
+    # triggers so every write path (app, imports, purges) maintains it
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER NOT NULL,
+                  reading_count INTEGER NOT NULL DEFAULT 0,
+                  med_count INTEGER NOT NULL DEFAULT 0,
+                  last_reading_at TIMESTAMP,
+                  last_med_at DATE,
+                  PRIMARY KEY (user_id)) WITHOUT ROWID''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_stats_glucose_insert
+                 AFTER INSERT ON glucose_readings
+                 BEGIN
+                     INSERT INTO user_stats (user_id, reading_count, last_reading_at)
+                     VALUES (NEW.user_id, 1, NEW.reading_time)
+                     ON CONFLICT (user_id) DO UPDATE SET
+                         reading_count = reading_count + 1,
+                         last_reading_at = CASE
+                             WHEN last_reading_at IS NULL OR excluded.last_reading_at > last_reading_at
+                             THEN excluded.last_reading_at ELSE last_reading_at END;
+                 END''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_stats_glucose_delete
+                 AFTER DELETE ON glucose_readings
+                 BEGIN
+                     UPDATE user_stats SET
+                         reading_count = reading_count - 1,
+                         last_reading_at = (SELECT MAX(reading_time) FROM glucose_readings
+                                            WHERE user_id = OLD.user_id)
+                     WHERE user_id = OLD.user_id;
+                 END''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_stats_medication_insert
+                 AFTER INSERT ON medications
+                 BEGIN
+                     INSERT INTO user_stats (user_id, med_count, last_med_at)
+                     VALUES (NEW.user_id, 1, NEW.date)
+                     ON CONFLICT (user_id) DO UPDATE SET
+                         med_count = med_count + 1,
+                         last_med_at = CASE
+                             WHEN last_med_at IS NULL OR excluded.last_med_at > last_med_at
+                             THEN excluded.last_med_at ELSE last_med_at END;
+                 END''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_stats_medication_delete
+                 AFTER DELETE ON medications
+                 BEGIN
+                     UPDATE user_stats SET
+                         med_count = med_count - 1,
+                         last_med_at = (SELECT MAX(date) FROM medications
+                                        WHERE user_id = OLD.user_id)
+                     WHERE user_id = OLD.user_id;
+                 END''')
+
+    # Backfill from whatever is already in the database
+    conn.execute('''INSERT OR REPLACE INTO user_stats (user_id, reading_count, last_reading_at)
+                 SELECT user_id, COUNT(*), MAX(reading_time)
+                 FROM glucose_readings
+                 GROUP BY user_id''')
+    conn.execute('''INSERT INTO user_stats (user_id, med_count, last_med_at)
+                 SELECT user_id, COUNT(*), MAX(date)
+                 FROM medications
+                 WHERE true
+                 GROUP BY user_id
+                 ON CONFLICT (user_id) DO UPDATE SET
+                     med_count = excluded.med_count,
+                     last_med_at = excluded.last_med_at''')
+
+    # Lets the patient picker walk user_accounts already in display order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_accounts_full_name ON user_accounts (full_name, username)")
+
+
+def _index_messages_by_id(conn):
+    # Conversations page by message_id; an index on patient_id alone is
+    # ordered by (patient_id, rowid) which is exactly that key
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_provider_messages_patient ON provider_messages (patient_id)")
+
+
+def _create_adherence_state(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS adherence_state
+                 (user_id INTEGER NOT NULL,
+                  current_streak INTEGER NOT NULL DEFAULT 0,
+                  longest_streak INTEGER NOT NULL DEFAULT 0,
+                  last_adherent_day DATE,
+                  PRIMARY KEY (user_id)) WITHOUT ROWID''')
+
+    # Backfill: a day is adherent with any dose logged; runs of consecutive
+    # days share julianday(day) - row number, the latest run is the current
+    # streak and the longest run the longest streak
+    conn.execute("DELETE FROM adherence_state")
+    conn.execute('''INSERT INTO adherence_state
+                 (user_id, current_streak, longest_streak, last_adherent_day)
+                 WITH days AS (
+                     SELECT DISTINCT user_id, substr(date, 1, 10) AS day
+                     FROM medications
+                     WHERE user_id IS NOT NULL AND date IS NOT NULL
+                 ), runs AS (
+                     SELECT user_id, COUNT(*) AS length, MAX(day) AS last
+                     FROM (SELECT user_id, day,
+                                  julianday(day) - ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day) AS run
+                           FROM days)
+                     GROUP BY user_id, run
+                 )
+                 SELECT user_id,
+                        (SELECT length FROM runs AS latest
+                         WHERE latest.user_id = runs.user_id
+                         ORDER BY last DESC LIMIT 1),
+                        MAX(length), MAX(last)
+                 FROM runs
+                 GROUP BY user_id''')
+
+
+def _rollup_bucket(row, resolution):
+    # Bucket key and [start, end) bounds of `row`'s reading for one tier
+    if resolution == "hour":
+        bucket = f"substr({row}.reading_time, 1, 13) || ':00:00'"
+        end = "datetime(bucket, '+1 hour')"
+    else:
+        bucket = f"substr({row}.reading_time, 1, 10)"
+        end = "date(bucket, '+1 day')"
+    return bucket, end
+
+
+def _create_glucose_rollups(conn):
+    # Hourly and daily buckets behind the downsampled glucose chart
+    conn.execute('''CREATE TABLE IF NOT EXISTS glucose_rollups
+                 (user_id INTEGER NOT NULL,
+                  resolution TEXT NOT NULL,
+                  bucket TEXT NOT NULL,
+                  reading_count INTEGER NOT NULL,
+                  glucose_sum REAL NOT NULL,
+                  glucose_min REAL,
+                  glucose_max REAL,
+                  PRIMARY KEY (user_id, resolution, bucket)) WITHOUT ROWID''')
+
+    inserts, deletes = [], []
+    for resolution in ("hour", "day"):
+        new_bucket, _ = _rollup_bucket("NEW", resolution)
+        old_bucket, end = _rollup_bucket("OLD", resolution)
+        match = f"user_id = OLD.user_id AND resolution = '{resolution}' AND bucket = {old_bucket}"
+        inserts.append(f'''
+                     INSERT INTO glucose_rollups
+                     (user_id, resolution, bucket, reading_count, glucose_sum, glucose_min, glucose_max)
+                     VALUES (NEW.user_id, '{resolution}', {new_bucket}, 1,
+                             NEW.glucose_level, NEW.glucose_level, NEW.glucose_level)
+                     ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+                         reading_count = reading_count + 1,
+                         glucose_sum = glucose_sum + excluded.glucose_sum,
+                         glucose_min = min(glucose_min, excluded.glucose_min),
+                         glucose_max = max(glucose_max, excluded.glucose_max);''')
+        # Count and sum can be reversed directly; min/max are only rescanned
+        # from the bucket's readings when the deleted one was an extreme
+        deletes.append(f'''
+                     UPDATE glucose_rollups SET
+                         reading_count = reading_count - 1,
+                         glucose_sum = glucose_sum - OLD.glucose_level
+                     WHERE {match};
+                     DELETE FROM glucose_rollups WHERE {match} AND reading_count <= 0;
+                     UPDATE glucose_rollups SET
+                         glucose_min = (SELECT MIN(glucose_level) FROM glucose_readings
+                                        WHERE user_id = OLD.user_id
+                                          AND reading_time >= bucket AND reading_time < {end}),
+                         glucose_max = (SELECT MAX(glucose_level) FROM glucose_readings
+                                        WHERE user_id = OLD.user_id
+                                          AND reading_time >= bucket AND reading_time < {end})
+                     WHERE {match}
+                       AND (glucose_min = OLD.glucose_level OR glucose_max = OLD.glucose_level);''')
+
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_glucose_rollups_insert
+                 AFTER INSERT ON glucose_readings
+                 WHEN NEW.glucose_level IS NOT NULL AND NEW.reading_time IS NOT NULL
+                 BEGIN{"".join(inserts)}
+                 END''')
+
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_glucose_rollups_delete
+                 AFTER DELETE ON glucose_readings
+                 WHEN OLD.glucose_level IS NOT NULL AND OLD.reading_time IS NOT NULL
+                 BEGIN{"".join(deletes)}
+                 END''')
+
+    # Backfill from the readings already stored
+    conn.execute("DELETE FROM glucose_rollups")
+    for resolution, length, suffix in (("hour", 13, ":00:00"), ("day", 10, "")):
+        conn.execute(f'''INSERT INTO glucose_rollups
+                     (user_id, resolution, bucket, reading_count, glucose_sum, glucose_min, glucose_max)
+                     SELECT user_id, ?, substr(reading_time, 1, {length}) || ?, COUNT(*),
+                            SUM(glucose_level), MIN(glucose_level), MAX(glucose_level)
+                     FROM glucose_readings
+                     WHERE glucose_level IS NOT NULL AND reading_time IS NOT NULL
+                     GROUP BY user_id, substr(reading_time, 1, {length})''', (resolution, suffix))
+
+
+def _create_daily_glucose_summary(conn):
+    # Thresholds and the empty hour histogram as of this step; the triggers
+    # below store them, so changing them takes a new step
+    hypo_threshold, hyper_threshold = 70, 180
+    empty_hours = json.dumps([0] * 24)
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS daily_glucose_summary
+                 (user_id INTEGER NOT NULL,
+                  day DATE NOT NULL,
+                  reading_count INTEGER NOT NULL,
+                  glucose_sum REAL NOT NULL,
+                  glucose_sum_sq REAL NOT NULL,
+                  glucose_min REAL,
+                  glucose_max REAL,
+                  hypo_count INTEGER NOT NULL,
+                  hyper_count INTEGER NOT NULL,
+                  hour_counts TEXT NOT NULL,
+                  hour_sums TEXT NOT NULL,
+                  PRIMARY KEY (user_id, day)) WITHOUT ROWID''')
+
+    def hour_slot(row):
+        return f"'$[' || CAST(substr({row}.reading_time, 12, 2) AS INTEGER) || ']'"
+
+    match = "user_id = OLD.user_id AND day = substr(OLD.reading_time, 1, 10)"
+    new_slot, old_slot = hour_slot("NEW"), hour_slot("OLD")
+
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_daily_glucose_summary_insert
+                 AFTER INSERT ON glucose_readings
+                 WHEN NEW.glucose_level IS NOT NULL AND NEW.reading_time IS NOT NULL
+                 BEGIN
+                     INSERT INTO daily_glucose_summary
+                     (user_id, day, reading_count, glucose_sum, glucose_sum_sq, glucose_min,
+                      glucose_max, hypo_count, hyper_count, hour_counts, hour_sums)
+                     VALUES (NEW.user_id, substr(NEW.reading_time, 1, 10), 1, NEW.glucose_level,
+                             NEW.glucose_level * NEW.glucose_level, NEW.glucose_level, NEW.glucose_level,
+                             NEW.glucose_level < {hypo_threshold}, NEW.glucose_level > {hyper_threshold},
+                             json_set('{empty_hours}', {new_slot}, 1),
+                             json_set('{empty_hours}', {new_slot}, NEW.glucose_level))
+                     ON CONFLICT (user_id, day) DO UPDATE SET
+                         reading_count = reading_count + 1,
+                         glucose_sum = glucose_sum + excluded.glucose_sum,
+                         glucose_sum_sq = glucose_sum_sq + excluded.glucose_sum_sq,
+                         glucose_min = min(glucose_min, excluded.glucose_min),
+                         glucose_max = max(glucose_max, excluded.glucose_max),
+                         hypo_count = hypo_count + excluded.hypo_count,
+                         hyper_count = hyper_count + excluded.hyper_count,
+                         hour_counts = json_set(hour_counts, {new_slot},
+                                                json_extract(hour_counts, {new_slot}) + 1),
+                         hour_sums = json_set(hour_sums, {new_slot},
+                                              json_extract(hour_sums, {new_slot}) + NEW.glucose_level);
+                 END''')
+
+    # As with glucose_rollups, min/max are only rescanned when the deleted
+    # reading was the day's extreme
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_daily_glucose_summary_delete
+                 AFTER DELETE ON glucose_readings
+                 WHEN OLD.glucose_level IS NOT NULL AND OLD.reading_time IS NOT NULL
+                 BEGIN
+                     UPDATE daily_glucose_summary SET
+                         reading_count = reading_count - 1,
+                         glucose_sum = glucose_sum - OLD.glucose_level,
+                         glucose_sum_sq = glucose_sum_sq - OLD.glucose_level * OLD.glucose_level,
+                         hypo_count = hypo_count - (OLD.glucose_level < {hypo_threshold}),
+                         hyper_count = hyper_count - (OLD.glucose_level > {hyper_threshold}),
+                         hour_counts = json_set(hour_counts, {old_slot},
+                                                json_extract(hour_counts, {old_slot}) - 1),
+                         hour_sums = json_set(hour_sums, {old_slot},
+                                              json_extract(hour_sums, {old_slot}) - OLD.glucose_level)
+                     WHERE {match};
+                     DELETE FROM daily_glucose_summary WHERE {match} AND reading_count <= 0;
+                     UPDATE daily_glucose_summary SET
+                         glucose_min = (SELECT MIN(glucose_level) FROM glucose_readings
+                                        WHERE user_id = OLD.user_id
+                                          AND reading_time >= day AND reading_time < date(day, '+1 day')),
+                         glucose_max = (SELECT MAX(glucose_level) FROM glucose_readings
+                                        WHERE user_id = OLD.user_id
+                                          AND reading_time >= day AND reading_time < date(day, '+1 day'))
+                     WHERE {match}
+                       AND (glucose_min = OLD.glucose_level OR glucose_max = OLD.glucose_level);
+                 END''')
+
+    # Backfill: the day totals in one pass, then the hour histograms filled
+    # in slot by slot with the same json_set() the insert trigger uses
+    conn.execute("DELETE FROM daily_glucose_summary")
+    readings = ("FROM glucose_readings"
+                " WHERE user_id IS NOT NULL AND glucose_level IS NOT NULL AND reading_time IS NOT NULL")
+    conn.execute(f'''INSERT INTO daily_glucose_summary
+                 (user_id, day, reading_count, glucose_sum, glucose_sum_sq, glucose_min,
+                  glucose_max, hypo_count, hyper_count, hour_counts, hour_sums)
+                 SELECT user_id, substr(reading_time, 1, 10), COUNT(*), SUM(glucose_level),
+                        SUM(glucose_level * glucose_level), MIN(glucose_level), MAX(glucose_level),
+                        SUM(glucose_level < {hypo_threshold}), SUM(glucose_level > {hyper_threshold}),
+                        '{empty_hours}', '{empty_hours}'
+                 {readings}
+                 GROUP BY user_id, substr(reading_time, 1, 10)''')
+    slots = conn.execute(f'''SELECT user_id, substr(reading_time, 1, 10),
+                        CAST(substr(reading_time, 12, 2) AS INTEGER), COUNT(*), SUM(glucose_level)
+                 {readings}
+                 GROUP BY 1, 2, 3''').fetchall()
+    conn.executemany('''UPDATE daily_glucose_summary SET
+                     hour_counts = json_set(hour_counts, '$[' || ?3 || ']', ?4),
+                     hour_sums = json_set(hour_sums, '$[' || ?3 || ']', ?5)
+                 WHERE user_id = ?1 AND day = ?2''', slots)
+
+
+def _create_jobs(conn):
+    # Background jobs (jobs.py). params and result are JSON; cancel_requested
+    # lets a job be cancelled from any connection, not just its runner.
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT NOT NULL,
+                  params TEXT NOT NULL,
+                  owner TEXT,
+                  status TEXT NOT NULL,
+                  progress REAL NOT NULL DEFAULT 0,
+                  message TEXT,
+                  result TEXT,
+                  error TEXT,
+                  cancel_requested INTEGER NOT NULL DEFAULT 0,
+                  created_at TIMESTAMP NOT NULL,
+                  started_at TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner, job_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+
+MEDICATION_SCHEDULE_TABLE = '''CREATE TABLE IF NOT EXISTS medication_schedule
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  med_name TEXT,
+                  scheduled_time TIME,
+                  dosage REAL,
+                  start_date DATE,
+                  end_date DATE)'''
+
+
+def _create_reminders(conn):
+    # Reminder times and snooze choices from the Settings page, the dosing
+    # schedule (dropped after streamlit_appV2.py, which keyed it by TEXT
+    # user_id), and the scheduler's pending snoozes and in-app inbox
+    # (reminders.py). Times of day are 'HH:MM'.
+    conn.execute(MEDICATION_SCHEDULE_TABLE)
+    if _table_columns(conn, "medication_schedule")["user_id"] == "TEXT":
+        _rebuild_table(conn, "medication_schedule", MEDICATION_SCHEDULE_TABLE,
+                       ["id", "user_id", "med_name", "scheduled_time", "dosage"])
+        # time_input values were stored as 'HH:MM:SS'
+        conn.execute("UPDATE medication_schedule SET scheduled_time = substr(scheduled_time, 1, 5)")
+    _add_missing_columns(conn, "medication_schedule", [("start_date", "DATE"), ("end_date", "DATE")])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_medication_schedule_user ON medication_schedule (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_medication_schedule_time ON medication_schedule (scheduled_time)")
+
+    reminder_settings = '''CREATE TABLE IF NOT EXISTS reminder_settings
+                 (reminder_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  reminder_time TEXT NOT NULL,
+                  snooze_minutes TEXT NOT NULL DEFAULT '')'''
+    conn.execute(reminder_settings)
+    if "reminder_id" not in _table_columns(conn, "reminder_settings"):
+        _rebuild_table(conn, "reminder_settings", reminder_settings, ["user_id", "reminder_time"])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminder_settings_user ON reminder_settings (user_id)")
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS reminder_snoozes
+                 (snooze_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  reminder_id INTEGER,
+                  message TEXT NOT NULL,
+                  due_at TIMESTAMP NOT NULL)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS reminder_inbox
+                 (notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  reminder_id INTEGER,
+                  message TEXT NOT NULL,
+                  due_at TIMESTAMP NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'unread',
+                  delivered_at TIMESTAMP NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminder_inbox_user ON reminder_inbox (user_id, status)")
+
+
+def _create_dose_outcomes(conn):
+    # One row per closed (or already taken) scheduled dose slot
+    # (dose_outcomes.py); outcomes_through is the last day each schedule
+    # row's slots have been closed for
+    _add_missing_columns(conn, "medication_schedule", [("outcomes_through", "DATE")])
+    conn.execute('''CREATE TABLE IF NOT EXISTS dose_outcomes
+                 (user_id INTEGER NOT NULL,
+                  day DATE NOT NULL,
+                  schedule_id INTEGER NOT NULL,
+                  due_at TIMESTAMP NOT NULL,
+                  status TEXT NOT NULL,
+                  medication_id INTEGER,
+                  delay_minutes INTEGER,
+                  PRIMARY KEY (user_id, day, schedule_id)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dose_outcomes_medication ON dose_outcomes (medication_id)")
+
+
+def _create_adherence_days(conn):
+    # One bitmap of adherent days per user and year (streaks.py)
+    conn.execute('''CREATE TABLE IF NOT EXISTS adherence_days
+                 (user_id INTEGER NOT NULL,
+                  year INTEGER NOT NULL,
+                  days BLOB NOT NULL,
+                  PRIMARY KEY (user_id, year)) WITHOUT ROWID''')
+
+    # Backfill: 46 bytes per year, bit i (little-endian within each byte) is
+    # day i of a leap year, so Feb 29 stays clear in other years
+    bitmaps = {}
+    for user_id, day in conn.execute('''SELECT DISTINCT user_id, substr(date, 1, 10) FROM medications
+                                        WHERE user_id IS NOT NULL AND date IS NOT NULL''').fetchall():
+        day = date.fromisoformat(day)
+        bit = day.timetuple().tm_yday - 1 + (day.month > 2 and not calendar.isleap(day.year))
+        days = bitmaps.setdefault((user_id, day.year), bytearray(46))
+        days[bit // 8] |= 1 << bit % 8
+    conn.execute("DELETE FROM adherence_days")
+    conn.executemany("INSERT INTO adherence_days (user_id, year, days) VALUES (?, ?, ?)",
+                     [(user_id, year, bytes(days)) for (user_id, year), days in bitmaps.items()])
+
+
+def _create_glucose_blocks(conn):
+    # Per-user, per-day packed readings (glucose_blocks.py). A rowid table,
+    # as blocks run to hundreds of bytes; packing starts on the scheduler's
+    # next tick.
+    _add_missing_columns(conn, "user_stats", [("packed_through", "DATE")])
+    conn.execute('''CREATE TABLE IF NOT EXISTS glucose_blocks
+                 (user_id INTEGER NOT NULL,
+                  day DATE NOT NULL,
+                  reading_count INTEGER NOT NULL,
+                  data BLOB NOT NULL,
+                  PRIMARY KEY (user_id, day))''')
+
+
+MIGRATIONS = [
+    _create_tables,
+    _reconcile_legacy_schemas,
+    _create_indexes,
+    _create_user_stats,
+    _index_messages_by_id,
+    _create_adherence_state,
+    _create_glucose_rollups,
+    _create_daily_glucose_summary,
+    _create_jobs,
+    _create_reminders,
+    _create_dose_outcomes,
+    _create_adherence_days,
+    _create_glucose_blocks,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    if get_schema_version(conn) == SCHEMA_VERSION:
+        return SCHEMA_VERSION
+
+    # BEGIN IMMEDIATE takes the write lock so that two processes starting at
+    # once cannot both apply the same step; re-read the version under the lock.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(
+                f"Database schema version {version} is newer than this app supports ({SCHEMA_VERSION})")
+        for step in range(version, SCHEMA_VERSION):
+            MIGRATIONS[step](conn)
+            conn.execute(f"PRAGMA user_version = {step + 1}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return SCHEMA_VERSION
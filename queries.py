@@ -0,0 +1,166 @@
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+# Date windows are computed in Python and compared against the raw date /
+# reading_time columns, so range predicates stay sargable and SQLite can use
+# the (user_id, date) and (user_id, reading_time) indexes instead of applying
+# strftime()/datetime() to every row.
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def month_window(year, month):
+    # Half-open [first of month, first of next month) as DATE strings
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def since_date(days, now=None):
+    now = now or datetime.now()
+    return (now - timedelta(days=days)).date().isoformat()
+
+
+def since_timestamp(days, now=None):
+    now = now or datetime.now()
+    return (now - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+
+
+def _fetch_dicts(conn, sql, params=()):
+    cursor = conn.execute(sql, params)
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+# Community feed
+
+FEED_PAGE_SIZE = 20
+
+
+def load_feed_page(conn, cursor=None, page_size=FEED_PAGE_SIZE):
+    # Keyset pagination on (created_at, post_id): cursor is the key of the
+    # last post already shown, or None for the newest page. Returns the page's
+    # posts, their comments grouped by post_id, and the cursor for the next
+    # page (None when there is nothing older).
+    sql = """
+        SELECT p.post_id, p.content, p.post_type, p.created_at, u.username, u.full_name
+        FROM community_posts p
+        LEFT JOIN user_accounts u ON p.user_id = u.user_id
+    """
+    params = []
+    if cursor is not None:
+        sql += " WHERE (p.created_at, p.post_id) < (?, ?)"
+        params.extend(cursor)
+    sql += " ORDER BY p.created_at DESC, p.post_id DESC LIMIT ?"
+    params.append(page_size + 1)
+
+    posts = _fetch_dicts(conn, sql, params)
+    next_cursor = None
+    if len(posts) > page_size:
+        posts = posts[:page_size]
+        next_cursor = (posts[-1]['created_at'], posts[-1]['post_id'])
+
+    comments = {post['post_id']: [] for post in posts}
+    if posts:
+        placeholders = ", ".join("?" * len(posts))
+        for comment in _fetch_dicts(conn, f"""
+            SELECT c.post_id, c.content, c.created_at, u.username, u.full_name
+            FROM post_comments c
+            LEFT JOIN user_accounts u ON c.user_id = u.user_id
+            WHERE c.post_id IN ({placeholders})
+            ORDER BY c.post_id, c.created_at
+        """, list(comments)):
+            comments[comment['post_id']].append(comment)
+
+    return posts, comments, next_cursor
+
+
+# Provider/patient conversations
+
+MESSAGE_PAGE_SIZE = 50
+
+_MESSAGE_SELECT = """
+    SELECT pm.message_id, pm.message_content, pm.sent_time, pm.sender_type,
+           pm.provider_id, pm.patient_id,
+           CASE WHEN pm.sender_type = 'provider' THEN prov.full_name
+                ELSE pat.full_name END AS sender_name
+    FROM provider_messages pm
+    LEFT JOIN user_accounts prov ON prov.user_id = pm.provider_id
+    LEFT JOIN user_accounts pat ON pat.user_id = pm.patient_id
+    WHERE pm.patient_id = ?
+"""
+
+
+def load_recent_messages(conn, patient_id, before_id=None, page_size=MESSAGE_PAGE_SIZE):
+    # The newest page_size messages older than before_id (or the newest
+    # overall), oldest first, plus whether anything older remains
+    sql = _MESSAGE_SELECT
+    params = [patient_id]
+    if before_id is not None:
+        sql += " AND pm.message_id < ?"
+        params.append(before_id)
+    sql += " ORDER BY pm.message_id DESC LIMIT ?"
+    params.append(page_size + 1)
+
+    messages = _fetch_dicts(conn, sql, params)
+    has_older = len(messages) > page_size
+    messages = messages[:page_size]
+    messages.reverse()
+    return messages, has_older
+
+
+def load_new_messages(conn, patient_id, after_id):
+    # Everything sent after the last message the caller has already seen
+    return _fetch_dicts(conn, _MESSAGE_SELECT + " AND pm.message_id > ? ORDER BY pm.message_id",
+                        (patient_id, after_id))
+
+
+# Per-user reads for the Home and tracker pages, shaped for query_cache.cached
+
+def load_calendar_days(conn, user_id, start, end):
+    # One row per day in [start, end) with any doses or scheduled slots:
+    # doses logged, distinct medications, scheduled slots closed and missed
+    return pd.read_sql_query("""
+        SELECT day, SUM(doses) AS doses, SUM(medications) AS medications,
+               SUM(scheduled) AS scheduled, SUM(missed) AS missed
+        FROM (
+            SELECT date AS day, COUNT(*) AS doses, COUNT(DISTINCT med_name) AS medications,
+                   0 AS scheduled, 0 AS missed
+            FROM medications
+            WHERE user_id = ?1 AND date >= ?2 AND date < ?3
+            GROUP BY date
+            UNION ALL
+            SELECT day, 0, 0, COUNT(*), SUM(status = 'missed')
+            FROM dose_outcomes
+            WHERE user_id = ?1 AND day >= ?2 AND day < ?3
+            GROUP BY day
+        )
+        GROUP BY day
+    """, conn, params=(user_id, str(start), str(end)))
+
+
+def first_dose_date(conn, user_id):
+    return conn.execute("SELECT MIN(date) FROM medications WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+def load_recent_medications(conn, user_id, limit=10):
+    return pd.read_sql_query("""
+        SELECT med_name, dosage, time_taken, date
+        FROM medications
+        WHERE user_id = ?
+        AND med_name != 'Daily Medication'
+        ORDER BY date DESC, time_taken DESC
+        LIMIT ?
+    """, conn, params=(user_id, limit))
+
+
+def latest_glucose(conn, user_id):
+    row = conn.execute("""
+        SELECT glucose_level
+        FROM glucose_readings
+        WHERE user_id = ?
+        ORDER BY reading_time DESC
+        LIMIT 1
+    """, (user_id,)).fetchone()
+    return row[0] if row else None
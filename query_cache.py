@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+
+from database import get_connection
+
+# Process-wide memo for per-user reads. Every Streamlit rerun re-executes the
+# page script, so the Home page alone would otherwise repeat the same streak,
+# calendar, adherence and chart queries on every click. Entries are keyed by
+# (loader, user_id, params) and stamped with the user's data generation;
+# write paths call invalidate_user() after committing, which bumps the
+# generation so that user's next read misses and reloads. Nothing is evicted
+# on a bump, stale entries are simply never matched again and age out of the
+# LRU.
+#
+# Cached values are shared between sessions, so callers must treat them as
+# read-only (DataFrames included).
+
+MAX_ENTRIES = 4096
+
+
+class QueryCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _generation(self, user_id):
+        return self._epoch, self._generations.get(user_id, 0)
+
+    def lookup(self, key, user_id):
+        # (hit, value, generation); pass the generation to store() after a miss
+        with self._lock:
+            generation = self._generation(user_id)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1], generation
+            self.misses += 1
+            return False, None, generation
+
+    def store(self, key, generation, value):
+        # If the user's data changed while the value was loading it is stored
+        # under the old generation and simply misses next time
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current[0] <= generation:
+                self._entries[key] = (generation, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+    def get(self, key, user_id, load):
+        hit, value, generation = self.lookup(key, user_id)
+        if not hit:
+            # Load outside the lock so slow queries don't serialize sessions
+            value = load()
+            self.store(key, generation, value)
+        return value
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def invalidate_all(self):
+        # For bulk changes that touch many users, such as admin purges
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_cache = QueryCache()
+
+
+def cached(load, user_id, *params):
+    # load(conn, user_id, *params), run on a pooled connection on a miss.
+    # params must be hashable; include anything the result depends on besides
+    # the user's data, such as today's date for rolling windows.
+    key = (f"{load.__module__}.{load.__qualname__}", user_id, params)
+
+    def run():
+        with get_connection() as conn:
+            return load(conn, user_id, *params)
+
+    return _cache.get(key, user_id, run)
+
+
+def cached_many(load_many, user_ids, *params):
+    # Batched cached() for panels: load_many(conn, user_ids, *params) returns
+    # {user_id: value} and is only asked for the users that missed. Each user
+    # is cached under its own key, so single-patient views and panels share
+    # entries when they use the same loader.
+    name = f"{load_many.__module__}.{load_many.__qualname__}"
+    results, missing = {}, {}
+    for user_id in dict.fromkeys(user_ids):
+        key = (name, user_id, params)
+        hit, value, generation = _cache.lookup(key, user_id)
+        if hit:
+            results[user_id] = value
+        else:
+            missing[user_id] = (key, generation)
+
+    if missing:
+        with get_connection() as conn:
+            loaded = load_many(conn, list(missing), *params)
+        for user_id, (key, generation) in missing.items():
+            results[user_id] = loaded.get(user_id)
+            _cache.store(key, generation, results[user_id])
+    return results
+
+
+def invalidate_user(user_id):
+    _cache.invalidate_user(user_id)
+
+
+def invalidate_all():
+    _cache.invalidate_all()
+
+
+def cache_stats():
+    return _cache.stats()
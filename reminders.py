@@ -0,0 +1,395 @@
+import argparse
+import threading
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import dose_outcomes
+import glucose_blocks
+from database import get_connection, get_pool, run_write
+from queries import TIMESTAMP_FORMAT
+
+# Medication reminders. Users pick daily reminder times and the snooze
+# delays they want offered (reminder_settings); one scheduler thread per
+# process fires them and hands every due reminder to its sinks, the in-app
+# inbox by default or a log file when run from the command line.
+#
+# Daily reminders sit in a timer wheel with one slot per minute of the day.
+# A slot is an array of reminder_ids, 8 bytes per reminder, so millions of
+# reminders fit in a few MB and a tick only looks at the slot that is due.
+# Recurring reminders never move, so edits only ever add ids: an id whose row
+# was deleted or moved to another time is dropped from its slot the next time
+# that slot fires (ids are AUTOINCREMENT and never reused). Snoozes are
+# one-off and few, and are kept in reminder_snoozes so they survive a
+# restart; each tick fires the ones that have come due.
+#
+# Other per-minute work (closing missed dose slots, packing closed days of
+# glucose readings) runs as tasks on the same tick. Run one scheduler per
+# database; two app processes would both deliver.
+
+MINUTES_PER_DAY = 24 * 60
+SNOOZE_OPTIONS = [5, 10, 15, 30, 60]  # minutes, offered on the Settings page
+MAX_CATCH_UP = 15  # minutes of missed ticks still fired late, e.g. after a suspend
+LOOKUP_CHUNK = 900  # ids per IN (...) lookup, under SQLite's parameter limit
+DEFAULT_MESSAGE = "Time to take your medication"
+# Per-minute work run after the reminders on every tick, in the app and
+# from the command line alike
+SCHEDULER_TASKS = [dose_outcomes.sweep, glucose_blocks.pack]
+
+Reminder = namedtuple("Reminder", ["user_id", "reminder_id", "message", "due_at"])
+
+
+def parse_time(value):
+    # 'HH:MM' (or 'HH:MM:SS') to minute of the day
+    hours, minutes = str(value).split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def _minute(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def _chunks(items, size=LOOKUP_CHUNK):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class TimerWheel:
+    # One slot per minute of the day, each an array of reminder ids
+    def __init__(self):
+        self._slots = [array("q") for _ in range(MINUTES_PER_DAY)]
+        self._lock = threading.Lock()
+        # minute -> ids discarded while that slot was out between take()
+        # and keep()
+        self._discarded = {}
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def add(self, minute, reminder_id):
+        with self._lock:
+            self._slots[minute].append(reminder_id)
+
+    def extend(self, rows):
+        # rows: (minute, reminder_id) pairs in any order
+        slots = [array("q") for _ in range(MINUTES_PER_DAY)]
+        for minute, reminder_id in rows:
+            slots[minute].append(reminder_id)
+        with self._lock:
+            for slot, ids in zip(self._slots, slots):
+                slot.extend(ids)
+
+    def take(self, minute):
+        # Empties the slot and returns its ids; every take() must be
+        # followed by keep() to put back the ones that stay
+        with self._lock:
+            taken, self._slots[minute] = self._slots[minute], array("q")
+            self._discarded[minute] = set()
+            return taken.tolist()
+
+    def keep(self, minute, taken, valid):
+        # Puts back the ids from take() that are still in valid, once each,
+        # ahead of any added since and without any discarded since
+        with self._lock:
+            discarded = self._discarded.pop(minute, set())
+            kept = dict.fromkeys(i for i in taken if i in valid and i not in discarded)
+            self._slots[minute] = array("q", kept) + self._slots[minute]
+
+    def discard(self, minute, reminder_ids):
+        with self._lock:
+            self._slots[minute] = array("q", (i for i in self._slots[minute] if i not in reminder_ids))
+            if minute in self._discarded:
+                self._discarded[minute].update(reminder_ids)
+
+
+class InboxSink:
+    # The in-app inbox on the Home page
+    def deliver(self, reminders):
+        delivered_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+        rows = [(r.user_id, r.reminder_id, r.message, r.due_at.strftime(TIMESTAMP_FORMAT), delivered_at)
+                for r in reminders]
+        run_write(lambda conn: conn.executemany("""
+            INSERT INTO reminder_inbox (user_id, reminder_id, message, due_at, delivered_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows).rowcount)
+
+
+class LogSink:
+    # One tab-separated line per reminder, for running the scheduler offline
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def deliver(self, reminders):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for r in reminders:
+                f.write(f"{r.due_at.strftime(TIMESTAMP_FORMAT)}\t{r.user_id}\t{r.reminder_id}\t{r.message}\n")
+
+
+class ReminderScheduler:
+    def __init__(self, sinks, tasks=(), clock=datetime.now):
+        self.sinks = list(sinks)
+        self.tasks = list(tasks)
+        self._clock = clock
+        self._wheel = TimerWheel()
+        self._last_tick = None
+        self._tick_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.delivered = 0
+        self.last_error = None
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def load(self, conn):
+        # Streams every reminder into the wheel; returns how many
+        before = len(self._wheel)
+        self._wheel.extend(conn.execute("""
+            SELECT substr(reminder_time, 1, 2) * 60 + substr(reminder_time, 4, 2), reminder_id
+            FROM reminder_settings
+        """))
+        return len(self._wheel) - before
+
+    def add(self, reminder_id, reminder_time):
+        self._wheel.add(parse_time(reminder_time), reminder_id)
+
+    def cancel(self, reminders):
+        # Drops (reminder_id, reminder_time) pairs from the wheel now rather
+        # than when their slot next fires
+        minutes = {}
+        for reminder_id, reminder_time in reminders:
+            minutes.setdefault(parse_time(reminder_time), set()).add(reminder_id)
+        for minute, reminder_ids in minutes.items():
+            self._wheel.discard(minute, reminder_ids)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="reminder-scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        # Loading happens here rather than in start() so a large table never
+        # holds up the page that first starts the scheduler
+        try:
+            with get_connection() as conn:
+                self.load(conn)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+            now = datetime.now()
+            self._stop.wait(60 - now.second - now.microsecond / 1e6 + 0.05)
+
+    def tick(self, now=None):
+        # Fires every slot from the last tick up to now, plus due snoozes;
+        # returns the reminders delivered
+        now = now or self._clock()
+        with self._tick_lock:
+            current = _minute(now)
+            start = current
+            if self._last_tick is not None:
+                start = max(self._last_tick + timedelta(minutes=1),
+                            current - timedelta(minutes=MAX_CATCH_UP - 1))
+            reminders = []
+            moment = start
+            while moment <= current:
+                reminders.extend(self._due_reminders(moment))
+                moment += timedelta(minutes=1)
+            self._last_tick = max(current, self._last_tick or current)
+
+            snoozes = self._due_snoozes(now)
+            reminders.extend(Reminder(*snooze[1:]) for snooze in snoozes)
+            if self._deliver(reminders) and snoozes:
+                # After delivery, so a failing sink leaves them to fire again
+                run_write(lambda conn: conn.executemany("DELETE FROM reminder_snoozes WHERE snooze_id = ?",
+                                                        [(snooze[0],) for snooze in snoozes]).rowcount)
+            for task in self.tasks:
+                try:
+                    task(now)
+                except Exception as e:
+                    self.last_error = f"{getattr(task, '__name__', task)}: {type(e).__name__}: {e}"
+            return reminders
+
+    def _due_reminders(self, moment):
+        slot = moment.hour * 60 + moment.minute
+        ids = self._wheel.take(slot)
+        time_of_day = moment.strftime("%H:%M")
+        valid = {}
+        try:
+            if not ids:
+                return []
+            with get_connection() as conn:
+                for chunk in _chunks(ids):
+                    valid.update(conn.execute(f"""
+                        SELECT reminder_id, user_id FROM reminder_settings
+                        WHERE reminder_id IN ({", ".join("?" * len(chunk))}) AND substr(reminder_time, 1, 5) = ?
+                    """, (*chunk, time_of_day)))
+                messages = _dose_messages(conn, time_of_day, moment.date()) if valid else {}
+        except Exception:
+            # Lookup failed: keep the whole slot for the next day
+            valid = dict.fromkeys(ids)
+            raise
+        finally:
+            self._wheel.keep(slot, ids, valid)
+        # Several reminders of one user at the same minute fire once
+        users = {}
+        for reminder_id, user_id in valid.items():
+            users.setdefault(user_id, reminder_id)
+        return [Reminder(user_id, reminder_id, messages.get(user_id, DEFAULT_MESSAGE), moment)
+                for user_id, reminder_id in users.items()]
+
+    def _due_snoozes(self, now):
+        with get_connection() as conn:
+            rows = conn.execute("""
+                SELECT snooze_id, user_id, reminder_id, message, due_at FROM reminder_snoozes
+                WHERE due_at <= ? ORDER BY due_at
+            """, (now.strftime(TIMESTAMP_FORMAT),)).fetchall()
+        return [(snooze_id, user_id, reminder_id, message, datetime.strptime(due_at, TIMESTAMP_FORMAT))
+                for snooze_id, user_id, reminder_id, message, due_at in rows]
+
+    def _deliver(self, reminders):
+        # True if every sink took every reminder
+        ok = True
+        for sink in self.sinks:
+            try:
+                for chunk in _chunks(reminders):
+                    sink.deliver(chunk)
+            except Exception as e:
+                self.last_error = f"{type(sink).__name__}: {type(e).__name__}: {e}"
+                ok = False
+        self.delivered += len(reminders)
+        return ok
+
+
+def _dose_messages(conn, time_of_day, day):
+    # user_id -> message naming the medications scheduled at time_of_day
+    rows = conn.execute("""
+        SELECT user_id, med_name, dosage FROM medication_schedule
+        WHERE scheduled_time = ?1
+          AND (start_date IS NULL OR start_date <= ?2) AND (end_date IS NULL OR end_date >= ?2)
+    """, (time_of_day, day.isoformat())).fetchall()
+    doses = {}
+    for user_id, med_name, dosage in rows:
+        doses.setdefault(user_id, []).append(f"{med_name} {dosage:g}" if dosage is not None else med_name)
+    return {user_id: f"Time to take {', '.join(names)}" for user_id, names in doses.items()}
+
+
+_scheduler = None
+_scheduler_db = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # Started on first use; follows database.configure() like jobs.get_runner()
+    global _scheduler, _scheduler_db
+    db_path = get_pool().db_path
+    if _scheduler is None or _scheduler_db != db_path:
+        with _scheduler_lock:
+            if _scheduler is None or _scheduler_db != db_path:
+                if _scheduler is not None:
+                    _scheduler.stop()
+                _scheduler = ReminderScheduler([InboxSink()], SCHEDULER_TASKS).start()
+                _scheduler_db = db_path
+    return _scheduler
+
+
+# Settings and inbox
+
+def load_reminder_settings(conn, user_id):
+    # (['HH:MM', ...], [snooze minutes])
+    rows = conn.execute("""
+        SELECT reminder_time, snooze_minutes FROM reminder_settings
+        WHERE user_id = ? ORDER BY reminder_time
+    """, (user_id,)).fetchall()
+    snooze = [int(m) for m in rows[0][1].split(",") if m] if rows else []
+    return [row[0] for row in rows], snooze
+
+
+def save_reminder_settings(user_id, times, snooze_minutes):
+    # Replaces the user's reminders and schedules the new ones
+    times = sorted({t if isinstance(t, str) else t.strftime("%H:%M") for t in times})
+    snooze = ",".join(str(m) for m in sorted(set(snooze_minutes)))
+
+    def save(conn):
+        conn.execute("DELETE FROM reminder_settings WHERE user_id = ?", (user_id,))
+        return [(conn.execute("""
+            INSERT INTO reminder_settings (user_id, reminder_time, snooze_minutes) VALUES (?, ?, ?)
+        """, (user_id, t, snooze)).lastrowid, t) for t in times]
+
+    scheduler = get_scheduler()
+    for reminder_id, t in run_write(save):
+        scheduler.add(reminder_id, t)
+
+
+def delete_user_reminders(conn, user_id):
+    # Deletes the user's reminders, snoozes and inbox inside the caller's
+    # write; returns the (reminder_id, reminder_time) pairs to cancel once
+    # it has committed
+    reminders = conn.execute("SELECT reminder_id, reminder_time FROM reminder_settings WHERE user_id = ?",
+                             (user_id,)).fetchall()
+    for table in ("reminder_settings", "reminder_snoozes", "reminder_inbox"):
+        conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+    return reminders
+
+
+def load_inbox(conn, user_id, limit=5):
+    rows = conn.execute("""
+        SELECT notification_id, reminder_id, message, due_at FROM reminder_inbox
+        WHERE user_id = ? AND status = 'unread'
+        ORDER BY notification_id DESC LIMIT ?
+    """, (user_id, limit)).fetchall()
+    return [dict(zip(["notification_id", "reminder_id", "message", "due_at"], row)) for row in rows]
+
+
+def dismiss_notification(notification_id):
+    run_write(lambda conn: conn.execute(
+        "UPDATE reminder_inbox SET status = 'done' WHERE notification_id = ?", (notification_id,)).rowcount)
+
+
+def snooze_notification(notification_id, minutes, now=None):
+    # Marks the notification snoozed and queues it to fire again
+    due_at = ((now or datetime.now()) + timedelta(minutes=minutes)).strftime(TIMESTAMP_FORMAT)
+
+    def snooze(conn):
+        conn.execute("""
+            INSERT INTO reminder_snoozes (user_id, reminder_id, message, due_at)
+            SELECT user_id, reminder_id, message, ? FROM reminder_inbox
+            WHERE notification_id = ? AND status = 'unread'
+        """, (due_at, notification_id))
+        conn.execute("UPDATE reminder_inbox SET status = 'snoozed' WHERE notification_id = ?",
+                     (notification_id,))
+
+    run_write(snooze)
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure
+
+    parser = argparse.ArgumentParser(description="Run the medication reminder scheduler")
+    parser.add_argument("--log", help="append reminders to this file instead of the in-app inbox")
+    parser.add_argument("--at", help="fire a single tick as of 'YYYY-MM-DD HH:MM' and exit")
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    args = parser.parse_args()
+
+    configure(args.db)
+    scheduler = ReminderScheduler([LogSink(args.log) if args.log else InboxSink()], SCHEDULER_TASKS)
+    if args.at:
+        with get_connection() as conn:
+            print(f"{scheduler.load(conn):,} reminders loaded")
+        for reminder in scheduler.tick(datetime.strptime(args.at, "%Y-%m-%d %H:%M")):
+            print(f"{reminder.user_id}\t{reminder.message}")
+    else:
+        scheduler.start()
+        try:
+            scheduler._thread.join()
+        except KeyboardInterrupt:
+            scheduler.stop()
@@ -0,0 +1,234 @@
+import argparse
+import csv
+import gzip
+import time
+from datetime import datetime
+from pathlib import Path
+
+import glucose_blocks
+import glucose_series
+import glucose_summary
+from importer import suspend_trigger
+from queries import since_date
+from streaks import rebuild_bitmap, rebuild_streak
+
+# Retention purges in bounded batches. Each table is walked in rowid order;
+# a batch is the next BATCH_ROWS expired rows, deleted by rowid range in its
+# own short BEGIN IMMEDIATE transaction, and the purge sleeps briefly between
+# batches so the app's writes (log_glucose, log_medication) get the lock in
+# between instead of waiting behind one long DELETE.
+#
+# The per-row glucose delete triggers rescan min/max and rewrite JSON hour
+# slots for every reading, so they are suspended for each batch and the
+# aggregates of the touched (user, day) pairs are rebuilt from what is left
+# once the batch is deleted. Expired rows can optionally be archived to
+# gzipped CSV before they are deleted.
+
+BATCH_ROWS = 10_000
+# Seconds between batches. SQLite's busy handler polls at most every 100 ms,
+# so a shorter gap can keep missing a waiting writer.
+BATCH_PAUSE = 0.12
+
+# table: (label, rowid column, time column); comments go before posts so that
+# a post's newer comments are purged with it rather than orphaned
+RETENTION_TABLES = {
+    "glucose_readings": ("Glucose readings", "id", "reading_time"),
+    "medications": ("Medications", "id", "date"),
+    "provider_messages": ("Provider messages", "message_id", "sent_time"),
+    "post_comments": ("Community comments", "comment_id", "created_at"),
+    "community_posts": ("Community posts", "post_id", "created_at"),
+}
+
+SUSPENDED_TRIGGERS = ["trg_user_stats_glucose_delete", "trg_glucose_rollups_delete",
+                      "trg_daily_glucose_summary_delete"]
+
+
+class _Archive:
+    # One gzipped CSV per table, appended to batch by batch
+    def __init__(self, directory, table, stamp):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f"{table}_{stamp}.csv.gz"
+        self._file = None
+
+    def write(self, cursor):
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        if self._file is None:
+            self._file = gzip.open(self.path, "wt", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([column[0] for column in cursor.description])
+        self._writer.writerows(rows)
+        # Rows must be on disk before the DELETE commits
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        return self.path if self._file is not None else None
+
+
+def _expired_range(conn, table, cutoff):
+    _, id_column, time_column = RETENTION_TABLES[table]
+    return conn.execute(f"""
+        SELECT COUNT(*), MIN({id_column}), MAX({id_column}) FROM {table} WHERE {time_column} < ?
+    """, (cutoff,)).fetchone()
+
+
+def _batch_end(conn, table, start, cutoff, batch_rows):
+    # Rowid of the batch_rows-th expired row at or after start
+    _, id_column, time_column = RETENTION_TABLES[table]
+    return conn.execute(f"""
+        SELECT MAX({id_column}) FROM (
+            SELECT {id_column} FROM {table} WHERE {id_column} >= ? AND {time_column} < ?
+            ORDER BY {id_column} LIMIT ?)
+    """, (start, cutoff, batch_rows)).fetchone()[0]
+
+
+def _repair_glucose_aggregates(conn, touched):
+    # Rebuilds user_stats, glucose_rollups, daily_glucose_summary and
+    # glucose_blocks for the (user_id, day, deleted rows) in touched, with
+    # the delete triggers suspended. Days are usually emptied completely;
+    # whatever survives a partial day is re-recorded.
+    conn.executemany("""
+        UPDATE user_stats SET
+            reading_count = reading_count - ?,
+            last_reading_at = (SELECT MAX(reading_time) FROM glucose_readings WHERE user_id = ?)
+        WHERE user_id = ?
+    """, [(count, user_id, user_id) for user_id, count in _per_user(touched).items()])
+
+    days = [(user_id, day) for user_id, day, _ in touched if day is not None]
+    conn.executemany("DELETE FROM daily_glucose_summary WHERE user_id = ? AND day = ?", days)
+    glucose_blocks.delete_days(conn, days)
+    conn.executemany("""
+        DELETE FROM glucose_rollups WHERE user_id = ? AND resolution = 'day' AND bucket = ?
+    """, days)
+    conn.executemany("""
+        DELETE FROM glucose_rollups
+        WHERE user_id = ?1 AND resolution = 'hour' AND bucket >= ?2 AND bucket < date(?2, '+1 day')
+    """, days)
+
+    remaining = {}
+    for user_id, day in days:
+        rows = conn.execute("""
+            SELECT substr(reading_time, 1, 19), glucose_level FROM glucose_readings
+            WHERE user_id = ?1 AND reading_time >= ?2 AND reading_time < date(?2, '+1 day')
+            AND glucose_level IS NOT NULL
+        """, (user_id, day)).fetchall()
+        remaining.setdefault(user_id, []).extend(rows)
+    for user_id, rows in remaining.items():
+        if rows:
+            times, levels = zip(*rows)
+            glucose_series.record_readings(conn, user_id, times, levels)
+            glucose_summary.record_readings(conn, user_id, times, levels)
+            glucose_blocks.record_readings(conn, user_id, times, levels)
+
+
+def _per_user(touched):
+    counts = {}
+    for user_id, _, count in touched:
+        counts[user_id] = counts.get(user_id, 0) + count
+    return counts
+
+
+def _purge_batch(conn, table, start, end, cutoff, archives):
+    # Deletes the expired rows with rowids in [start, end] and brings the
+    # tables derived from them up to date; returns the number deleted
+    _, id_column, time_column = RETENTION_TABLES[table]
+    where = f"{id_column} BETWEEN ? AND ? AND {time_column} < ?"
+    params = (start, end, cutoff)
+    touched = []
+    if table == "glucose_readings":
+        touched = conn.execute(f"""
+            SELECT user_id, substr(reading_time, 1, 10), COUNT(*) FROM glucose_readings
+            WHERE {where} GROUP BY 1, 2
+        """, params).fetchall()
+    elif table == "medications":
+        touched = conn.execute(f"SELECT DISTINCT user_id, NULL, 0 FROM medications WHERE {where}",
+                               params).fetchall()
+    elif table == "community_posts":
+        orphans = f"post_id IN (SELECT post_id FROM community_posts WHERE {where})"
+        if "post_comments" in archives:
+            archives["post_comments"].write(conn.execute(f"SELECT * FROM post_comments WHERE {orphans}", params))
+        conn.execute(f"DELETE FROM post_comments WHERE {orphans}", params)
+
+    if table in archives:
+        archives[table].write(conn.execute(f"SELECT * FROM {table} WHERE {where}", params))
+    deleted = conn.execute(f"DELETE FROM {table} WHERE {where}", params).rowcount
+    if table == "glucose_readings":
+        _repair_glucose_aggregates(conn, touched)
+    elif table == "medications":
+        # Streaks and adherent-day bitmaps are derived from the remaining
+        # dose history
+        for user_id, _, _ in touched:
+            rebuild_streak(conn, user_id)
+            rebuild_bitmap(conn, user_id)
+    return deleted
+
+
+def purge_old_data(conn, days_to_keep, tables=None, archive_dir=None, batch_rows=BATCH_ROWS,
+                   pause=BATCH_PAUSE, progress=None):
+    # Deletes rows older than days_to_keep days from each table (default all
+    # of RETENTION_TABLES). progress(table, deleted, expired) is called after
+    # every batch and may raise to stop the purge; completed batches stay
+    # committed. Returns {"deleted": {table: rows}, "archives": [paths]}.
+    cutoff = since_date(days_to_keep)
+    tables = [table for table in RETENTION_TABLES if tables is None or table in tables]
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    archived = set(tables) | ({"post_comments"} if "community_posts" in tables else set())
+    archives = {table: _Archive(archive_dir, table, stamp) for table in archived} if archive_dir else {}
+    result = {"deleted": {}, "archives": []}
+    try:
+        for table in tables:
+            expired, start, last = _expired_range(conn, table, cutoff)
+            result["deleted"][table] = 0
+            while expired and start is not None and start <= last:
+                end = _batch_end(conn, table, start, cutoff, batch_rows)
+                if end is None:
+                    break
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    triggers = ([suspend_trigger(conn, name) for name in SUSPENDED_TRIGGERS]
+                                if table == "glucose_readings" else [])
+                    deleted = _purge_batch(conn, table, start, end, cutoff, archives)
+                    for trigger_sql in filter(None, triggers):
+                        conn.execute(trigger_sql)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                result["deleted"][table] += deleted
+                start = end + 1
+                if progress:
+                    progress(table, result["deleted"][table], expired)
+                time.sleep(pause)
+    finally:
+        result["archives"] = [str(path) for path in (archive.close() for archive in archives.values()) if path]
+    return result
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure, get_connection
+
+    parser = argparse.ArgumentParser(description="Delete data older than a retention window")
+    parser.add_argument("--days", type=int, required=True, help="days of data to keep")
+    parser.add_argument("--table", action="append", choices=list(RETENTION_TABLES),
+                        help="table to purge (repeatable, default all)")
+    parser.add_argument("--archive", help="directory for gzipped CSV copies of purged rows")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    args = parser.parse_args()
+
+    configure(args.db)
+    started = time.perf_counter()
+    with get_connection() as conn:
+        result = purge_old_data(conn, args.days, args.table, args.archive, args.batch_rows,
+                                progress=lambda table, deleted, expired: print(
+                                    f"\r{table}: {deleted:,} / {expired:,}", end="", flush=True))
+    print()
+    for table, deleted in result["deleted"].items():
+        print(f"{table}: {deleted:,} rows deleted")
+    for path in result["archives"]:
+        print(f"archived to {path}")
+    print(f"{time.perf_counter() - started:.1f}s")
@@ -0,0 +1,228 @@
+import argparse
+import calendar
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# Per-user medication streaks kept in adherence_state. A day counts as
+# adherent when at least one dose is logged for it. record_dose() updates the
+# state in O(1) for the normal case of logging today's (or a later) dose;
+# a backfilled earlier date falls back to rebuilding that user's history.
+#
+# The adherent days themselves are kept in adherence_days as one 46-byte
+# bitmap per user and year, so a year's heatmap is a single BLOB read. Bit i
+# is day i of a leap year (Feb 29 stays clear in other years), so the same
+# calendar date has the same bit in every year and years compare with
+# plain bitwise operations.
+
+YEAR_BITS = 366
+BITMAP_BYTES = (YEAR_BITS + 7) // 8
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _walk_days(days):
+    # days: distinct adherent dates in ascending order
+    current = longest = 0
+    last = None
+    for day in days:
+        if last is not None and (day - last).days == 1:
+            current += 1
+        else:
+            current = 1
+        longest = max(longest, current)
+        last = day
+    return current, longest, last
+
+
+def day_bit(day):
+    # Position of `day` in its year's bitmap
+    index = day.timetuple().tm_yday - 1
+    if day.month > 2 and not calendar.isleap(day.year):
+        index += 1
+    return index
+
+
+def _mark_day(conn, user_id, day):
+    # Sets the day's bit; False when it was already set
+    row = conn.execute("SELECT days FROM adherence_days WHERE user_id = ? AND year = ?",
+                       (user_id, day.year)).fetchone()
+    days = bytearray(row[0] if row else BITMAP_BYTES)
+    byte, bit = divmod(day_bit(day), 8)
+    if days[byte] >> bit & 1:
+        return False
+    days[byte] |= 1 << bit
+    conn.execute("INSERT OR REPLACE INTO adherence_days (user_id, year, days) VALUES (?, ?, ?)",
+                 (user_id, day.year, bytes(days)))
+    return True
+
+
+def _save_state(conn, user_id, current, longest, last):
+    conn.execute("""
+        INSERT OR REPLACE INTO adherence_state
+        (user_id, current_streak, longest_streak, last_adherent_day)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, current, longest, last.isoformat()))
+
+
+def rebuild_streak(conn, user_id):
+    rows = conn.execute("""
+        SELECT DISTINCT date
+        FROM medications
+        WHERE user_id = ? AND date IS NOT NULL
+        ORDER BY date
+    """, (user_id,)).fetchall()
+    days = sorted({_as_date(row[0]) for row in rows})
+    if not days:
+        conn.execute("DELETE FROM adherence_state WHERE user_id = ?", (user_id,))
+        return
+    _save_state(conn, user_id, *_walk_days(days))
+
+
+def rebuild_streaks(conn):
+    # Full recomputation for every user, for backfills and bulk deletes
+    conn.execute("DELETE FROM adherence_state")
+    user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM medications")]
+    for user_id in user_ids:
+        rebuild_streak(conn, user_id)
+    return len(user_ids)
+
+
+def rebuild_bitmap(conn, user_id):
+    conn.execute("DELETE FROM adherence_days WHERE user_id = ?", (user_id,))
+    rows = conn.execute("""
+        SELECT DISTINCT date FROM medications WHERE user_id = ? AND date IS NOT NULL
+    """, (user_id,)).fetchall()
+    bits = {}
+    for row in rows:
+        day = _as_date(row[0])
+        bits.setdefault(day.year, set()).add(day_bit(day))
+    for year, positions in bits.items():
+        flags = np.zeros(YEAR_BITS, dtype=np.uint8)
+        flags[list(positions)] = 1
+        conn.execute("INSERT INTO adherence_days (user_id, year, days) VALUES (?, ?, ?)",
+                     (user_id, year, np.packbits(flags, bitorder="little").tobytes()))
+
+
+def rebuild_bitmaps(conn):
+    # Kept apart from rebuild_streaks(), which migrations run before
+    # adherence_days exists
+    conn.execute("DELETE FROM adherence_days")
+    user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM medications")]
+    for user_id in user_ids:
+        rebuild_bitmap(conn, user_id)
+    return len(user_ids)
+
+
+def record_dose(conn, user_id, day):
+    # Call after the medications row is inserted, inside the same transaction
+    day = _as_date(day)
+    if not _mark_day(conn, user_id, day):
+        # The day was already adherent, so the streaks are unchanged
+        return
+    row = conn.execute("""
+        SELECT current_streak, longest_streak, last_adherent_day
+        FROM adherence_state
+        WHERE user_id = ?
+    """, (user_id,)).fetchone()
+
+    if row is None:
+        _save_state(conn, user_id, 1, 1, day)
+        return
+
+    current, longest, last = row
+    gap = (day - _as_date(last)).days
+    if gap == 0:
+        return
+    if gap < 0:
+        rebuild_streak(conn, user_id)
+        return
+    current = current + 1 if gap == 1 else 1
+    _save_state(conn, user_id, current, max(longest, current), day)
+
+
+def get_streaks(conn, user_id, today=None):
+    # (current, longest); the current streak lapses once a full day is missed
+    row = conn.execute("""
+        SELECT current_streak, longest_streak, last_adherent_day
+        FROM adherence_state
+        WHERE user_id = ?
+    """, (user_id,)).fetchone()
+    if row is None:
+        return 0, 0
+    current, longest, last = row
+    today = today or date.today()
+    if _as_date(last) < today - timedelta(days=1):
+        current = 0
+    return current, longest
+
+
+def current_streak(conn, user_id, today=None):
+    return get_streaks(conn, user_id, today)[0]
+
+
+def _year_flags(days, year):
+    flags = np.unpackbits(np.frombuffer(days, dtype=np.uint8), bitorder="little")[:YEAR_BITS].astype(bool)
+    # Drop the Feb 29 slot outside leap years
+    return flags if calendar.isleap(year) else np.delete(flags, day_bit(date(year, 3, 1)) - 1)
+
+
+def adherent_days(conn, user_id, start, end):
+    # One flag per day in [start, end), from the bitmaps of the years it spans
+    last = end - timedelta(days=1)
+    stored = dict(conn.execute("""
+        SELECT year, days FROM adherence_days WHERE user_id = ? AND year BETWEEN ? AND ?
+    """, (user_id, start.year, last.year)).fetchall())
+    flags = np.concatenate([_year_flags(stored.get(year, bytes(BITMAP_BYTES)), year)
+                            for year in range(start.year, last.year + 1)])
+    offset = (start - date(start.year, 1, 1)).days
+    return flags[offset:offset + (end - start).days]
+
+
+def load_year_bitmaps(conn, user_id, years):
+    # {year: bitmap as an int}; years without doses are 0
+    years = list(years)
+    rows = conn.execute(f"""
+        SELECT year, days FROM adherence_days
+        WHERE user_id = ? AND year IN ({", ".join("?" * len(years))})
+    """, (user_id, *years)).fetchall()
+    bitmaps = dict.fromkeys(years, 0)
+    bitmaps.update((year, int.from_bytes(days, "little")) for year, days in rows)
+    return bitmaps
+
+
+def compare_years(conn, user_id, year, other, through=None):
+    # Adherent days in `year` and `other`, and on the same dates in both.
+    # With `through`, only dates up to its day of the year count, for
+    # year-to-date comparisons.
+    bitmaps = load_year_bitmaps(conn, user_id, (year, other))
+    mask = (1 << (day_bit(_as_date(through)) + 1 if through else YEAR_BITS)) - 1
+    days, other_days = bitmaps[year] & mask, bitmaps[other] & mask
+    return {"days": days.bit_count(), "other_days": other_days.bit_count(),
+            "both": (days & other_days).bit_count()}
+
+
+if __name__ == "__main__":
+    from database import DB_PATH, configure, get_connection
+
+    parser = argparse.ArgumentParser(description="Maintain medication streaks")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="recompute adherence_state and adherence_days from the medications table")
+    parser.add_argument("--db", default=str(DB_PATH), help="path to the SQLite database")
+    args = parser.parse_args()
+
+    configure(args.db)
+    if args.rebuild:
+        with get_connection() as conn:
+            with conn:
+                count = rebuild_streaks(conn)
+                rebuild_bitmaps(conn)
+        print(f"Rebuilt streaks for {count} users")
+    else:
+        parser.print_help()
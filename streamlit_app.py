@@ -1,172 +1,147 @@
 import streamlit as st
 from datetime import datetime, timedelta, time
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import sqlite3
+import uuid
 from pathlib import Path
-import calendar
-import io
+from adherence import load_adherence, load_patient_adherence, patient_adherence
+from database import execute_write, get_connection, get_pool, run_write
+from dose_outcomes import (LATE, MISSED, ON_TIME, load_day_slots, load_outcome_rates, load_schedule,
+                           record_dose_outcome, save_schedule)
+from glucose_metrics import BAND_LABELS, BANDS, load_agp, load_panel_metrics
+from glucose_series import load_series
+from glucose_summary import hourly_profile, load_daily_summary, window_totals
+from jobs import ACTIVE, CANCELLED, FAILED, SUCCEEDED, cancel_job, list_jobs, submit_job
+from medication_calendar import (CALENDAR_VIEWS, NO_DATA, TAKEN, WEEKDAYS, adherence_grid, calendar_colorscale,
+                                 calendar_grid, calendar_window)
+from queries import (first_dose_date, latest_glucose, load_calendar_days, load_feed_page, load_new_messages,
+                     load_recent_medications, load_recent_messages, since_date)
+from query_cache import cache_stats, cached, cached_many, invalidate_user
+from reminders import (SNOOZE_OPTIONS, delete_user_reminders, dismiss_notification, get_scheduler,
+                       load_inbox, load_reminder_settings, save_reminder_settings, snooze_notification)
+from retention import RETENTION_TABLES
+from streaks import adherent_days, compare_years, current_streak, record_dose
+from triage import BELOW_RANGE_TARGET, TRIAGE_WINDOW_DAYS, load_triage
 
 def admin_functions():
     st.title("Admin Functions")
     
     if st.session_state.get('is_admin', False):  # Add admin check
         with st.expander("Data Management"):
-            # Clear Daily Medication entries
+            # Both run as background jobs; progress is listed below
             if st.button("Clear Daily Medication Entries"):
-                conn = create_database_connection()
-                if conn:
-                    try:
-                        conn.execute("DELETE FROM medications WHERE med_name = 'Daily Medication'")
-                        conn.commit()
-                        st.success("Daily Medication entries cleared!")
-                    finally:
-                        conn.close()
+                submit_job("clear_daily_medication", owner="admin")
             
             # Clear old data
             days_to_keep = st.number_input("Keep data for how many days?", min_value=1, value=30)
+            purge_tables = st.multiselect(
+                "Tables to purge", options=list(RETENTION_TABLES), default=list(RETENTION_TABLES),
+                format_func=lambda table: RETENTION_TABLES[table][0])
+            archive_purged = st.checkbox("Archive purged rows (gzipped CSV in data/archive)")
             if st.button("Clear Old Data"):
-                conn = create_database_connection()
-                if conn:
-                    try:
-                        conn.execute("""
-                            DELETE FROM medications 
-                            WHERE date < date('now', ?)
-                        """, (f'-{days_to_keep} days',))
-                        conn.commit()
-                        st.success("Old data cleared!")
-                    finally:
-                        conn.close()
+                submit_job("purge_old_data", {"days_to_keep": int(days_to_keep), "tables": purge_tables,
+                                              "archive": archive_purged}, owner="admin")
+
+        display_jobs("admin")
+
+        with st.expander("Query Cache"):
+            stats = cache_stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Entries", f"{stats['entries']} / {stats['max_entries']}")
+            col2.metric("Hit Rate", f"{stats['hit_rate']:.0%}")
+            col3.metric("Evictions", stats['evictions'])
+            st.caption(f"{stats['hits']} hits, {stats['misses']} misses")
+
+JOB_LABELS = {"export": "Export", "clear_daily_medication": "Clear Daily Medication Entries",
+              "purge_old_data": "Clear Old Data", "import_readings": "Import Readings"}
+
+@st.fragment(run_every=2)
+def display_jobs(owner, limit=5):
+    # Reruns on its own every two seconds so progress updates without
+    # rerunning the page
+    with get_connection() as conn:
+        jobs = list_jobs(conn, owner, limit)
+    if not jobs:
+        return
+    st.subheader("Background Jobs")
+    for job in jobs:
+        label = f"{JOB_LABELS.get(job['kind'], job['kind'])} #{job['job_id']}"
+        col1, col2 = st.columns([4, 1])
+        if job['status'] in ACTIVE:
+            col1.progress(job['progress'], text=f"{label}: {job['message'] or job['status'].title()}")
+            col2.button("Cancel", key=f"cancel_job_{job['job_id']}", on_click=cancel_job, args=(job['job_id'],))
+        elif job['status'] == SUCCEEDED:
+            col1.success(f"{label}: {job['message'] or 'Done'}")
+            result = job['result'] or {}
+            if result.get('path') and Path(result['path']).exists():
+                with open(result['path'], "rb") as output:
+                    col2.download_button("Download", data=output, file_name=result['file_name'],
+                                         mime=result['mime'], key=f"download_job_{job['job_id']}")
+        elif job['status'] == FAILED:
+            col1.error(f"{label} failed: {job['error']}")
+        elif job['status'] == CANCELLED:
+            col1.info(f"{label} was cancelled")
 
 # Database Functions
-def create_database_connection():
+def log_medication(user_id, med_name, dosage, time_taken, date):
+    def insert(conn):
+        medication_id = conn.execute("""
+            INSERT INTO medications 
+            (user_id, med_name, dosage, time_taken, date)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, med_name, dosage, time_str, date)).lastrowid
+        record_dose(conn, user_id, date)
+        record_dose_outcome(conn, user_id, med_name, date, time_str, medication_id)
+
     try:
-        data_dir = Path("data")
-        data_dir.mkdir(exist_ok=True)
-        db_path = data_dir / "diabetes_app.db"
-        conn = sqlite3.connect(str(db_path))
-        create_tables(conn)
-        return conn
+        # Convert time_taken to string format
+        time_str = time_taken.strftime('%H:%M:%S')
+        run_write(insert)
+        invalidate_user(user_id)
+        return True
     except Exception as e:
-        st.error(f"Database connection error: {e}")
-        return None
+        st.error(f"Error logging medication: {e}")
+        return False
 
-def create_tables(conn):
+def log_glucose(user_id, glucose_level):
     try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS glucose_readings
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      glucose_level REAL,
-                      reading_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS medications
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      med_name TEXT,
-                      dosage REAL,
-                      time_taken TIMESTAMP,
-                      date DATE)''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS user_accounts
-                     (user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      full_name TEXT,
-                      username TEXT UNIQUE,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS provider_messages
-                     (message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      patient_id INTEGER,
-                      provider_id INTEGER,
-                      message_content TEXT,
-                      sender_type TEXT,
-                      sent_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      FOREIGN KEY (patient_id) REFERENCES user_accounts(user_id),
-                      FOREIGN KEY (provider_id) REFERENCES user_accounts(user_id))''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS treatment_plans
-                     (plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      patient_id INTEGER,
-                      provider_id INTEGER,
-                      plan_content TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS community_posts
-                     (post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      content TEXT,
-                      post_type TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      FOREIGN KEY (user_id) REFERENCES user_accounts(user_id))''')
-    
-        conn.execute('''CREATE TABLE IF NOT EXISTS post_comments
-                     (comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      post_id INTEGER,
-                      user_id INTEGER,
-                      content TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      FOREIGN KEY (post_id) REFERENCES community_posts(post_id),
-                      FOREIGN KEY (user_id) REFERENCES user_accounts(user_id))''')
-        conn.commit()
+        execute_write('''
+            INSERT INTO glucose_readings 
+            (user_id, glucose_level, reading_time)
+            VALUES (?, ?, datetime('now'))
+        ''', (user_id, glucose_level))
+        invalidate_user(user_id)
+        return True
     except Exception as e:
-        st.error(f"Error creating/updating tables: {e}")
+        st.error(f"Error logging glucose level: {e}")
+        return False
 
-def log_medication(user_id, med_name, dosage, time_taken, date):
-    conn = create_database_connection()
-    if conn:
-        try:
-            with conn:
-                # Convert time_taken to string format
-                time_str = time_taken.strftime('%H:%M:%S')
-                conn.execute("""
-                    INSERT INTO medications 
-                    (user_id, med_name, dosage, time_taken, date)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, med_name, dosage, time_str, date))
-                conn.commit()
-            return True
-        except Exception as e:
-            st.error(f"Error logging medication: {e}")
-            return False
-        finally:
-            conn.close()
-    return False
+def sign_out():
+    if st.session_state.get('is_anonymous', False):
+        def cleanup(conn, anonymous_id):
+            conn.execute("DELETE FROM medications WHERE user_id = ?", (anonymous_id,))
+            conn.execute("DELETE FROM glucose_readings WHERE user_id = ?", (anonymous_id,))
+            conn.execute("DELETE FROM glucose_blocks WHERE user_id = ?", (anonymous_id,))
+            # Otherwise load_readings() would treat the next visitor's early
+            # days as packed and never read their rows
+            conn.execute("UPDATE user_stats SET packed_through = NULL WHERE user_id = ?", (anonymous_id,))
+            conn.execute("DELETE FROM adherence_state WHERE user_id = ?", (anonymous_id,))
+            conn.execute("DELETE FROM adherence_days WHERE user_id = ?", (anonymous_id,))
+            # Anonymous ids are reused, so the next visitor must not inherit
+            # the schedule or get this one's reminders
+            conn.execute("DELETE FROM medication_schedule WHERE user_id = ?", (anonymous_id,))
+            conn.execute("DELETE FROM dose_outcomes WHERE user_id = ?", (anonymous_id,))
+            return delete_user_reminders(conn, anonymous_id)
 
-def log_glucose(user_id, glucose_level):
-    conn = create_database_connection()
-    if conn:
         try:
-            with conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO glucose_readings 
-                    (user_id, glucose_level, reading_time)
-                    VALUES (?, ?, datetime('now'))
-                ''', (user_id, glucose_level))
-                conn.commit()
-                return True
+            reminders = run_write(cleanup, st.session_state.anonymous_id)
+            get_scheduler().cancel(reminders)
+            invalidate_user(st.session_state.anonymous_id)
         except Exception as e:
-            st.error(f"Error logging glucose level: {e}")
-            return False
-        finally:
-            conn.close()
-    return False
-
-def sign_out():
-    if st.session_state.get('is_anonymous', False):
-        conn = create_database_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM medications WHERE user_id = ?", 
-                             (st.session_state.anonymous_id,))
-                cursor.execute("DELETE FROM glucose_readings WHERE user_id = ?", 
-                             (st.session_state.anonymous_id,))
-                conn.commit()
-            except Exception as e:
-                st.error(f"Error cleaning up anonymous data: {e}")
-            finally:
-                conn.close()
+            st.error(f"Error cleaning up anonymous data: {e}")
 
     # Reset all session state variables
     for key in list(st.session_state.keys()):
@@ -191,46 +166,34 @@ def user_auth():
         with tab1:
             username = st.text_input("Username", key="signin_username")
             if st.button("Sign In"):
-                conn = create_database_connection()
-                if conn:
-                    try:
-                        cursor = conn.cursor()
-                        cursor.execute("SELECT user_id FROM user_accounts WHERE username = ?", 
-                                     (username,))
-                        result = cursor.fetchone()
-                        if result:
-                            cursor.execute("SELECT full_name FROM user_accounts WHERE user_id = ?", (result[0],))
-                            full_name = cursor.fetchone()[0]
-                            st.session_state.authenticated = True
-                            st.session_state.user_id = result[0]
-                            st.session_state.username = username
-                            st.session_state.full_name = full_name  # Store full name in session
-                            st.session_state.is_anonymous = False
-                            st.rerun()
-                        else:
-                            st.error("Invalid username")
-                    finally:
-                        conn.close()
+                with get_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT user_id, full_name FROM user_accounts WHERE username = ?", 
+                                 (username,))
+                    result = cursor.fetchone()
+                if result:
+                    st.session_state.authenticated = True
+                    st.session_state.user_id = result[0]
+                    st.session_state.username = username
+                    st.session_state.full_name = result[1]  # Store full name in session
+                    st.session_state.is_anonymous = False
+                    st.rerun()
+                else:
+                    st.error("Invalid username")
         
         with tab2:
             full_name = st.text_input("Full Name")
             new_username = st.text_input("Username", key="signup_username")
             if st.button("Sign Up"):
-                conn = create_database_connection()
-                if conn:
-                    try:
-                        cursor = conn.cursor()
-                        cursor.execute("""
-                            INSERT INTO user_accounts (full_name, username)
-                            VALUES (?, ?)
-                        """, (full_name, new_username))
-                        conn.commit()
-                        st.session_state.username = new_username  # Set the username
-                        st.success("Account created successfully!")
-                    except sqlite3.IntegrityError:
-                        st.error("Username already exists")
-                    finally:
-                        conn.close()
+                try:
+                    execute_write("""
+                        INSERT INTO user_accounts (full_name, username)
+                        VALUES (?, ?)
+                    """, (full_name, new_username))
+                    st.session_state.username = new_username  # Set the username
+                    st.success("Account created successfully!")
+                except sqlite3.IntegrityError:
+                    st.error("Username already exists")
         
         with tab3:
             st.write("Browse as anonymous user")
@@ -247,37 +210,6 @@ def user_auth():
         return False
     return True
 
-def calculate_streak(conn, user_id):
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT date 
-        FROM medications 
-        WHERE user_id = ? 
-        ORDER BY date DESC
-    """, (user_id,))
-    
-    dates = [row[0] for row in cursor.fetchall()]
-    
-    if not dates:
-        return 0
-    
-    streak = 1
-    current_date = datetime.strptime(dates[0], '%Y-%m-%d').date()
-    yesterday = datetime.now().date() - timedelta(days=1)
-    
-    if current_date < yesterday:
-        return 0
-    
-    for i in range(1, len(dates)):
-        date = datetime.strptime(dates[i], '%Y-%m-%d').date()
-        if (current_date - date).days == 1:
-            streak += 1
-            current_date = date
-        else:
-            break
-    
-    return streak
-
 # Component Functions
 def medication_tracker():
     st.header("Medication Tracker")
@@ -295,6 +227,55 @@ def medication_tracker():
         if success:
             st.success("Medication logged successfully!")
 
+    display_dose_schedule(st.session_state.user_id)
+
+SLOT_LABELS = {ON_TIME: "✅ On time", LATE: "🕒 Late", MISSED: "❌ Missed", "pending": "⏳ Due"}
+
+def display_dose_schedule(user_id):
+    st.subheader("Dosing Schedule")
+    with get_connection() as conn:
+        schedule = load_schedule(conn, user_id)
+        slots = load_day_slots(conn, user_id)
+        rates = load_outcome_rates(conn, [user_id], days=30).get(user_id)
+
+    if slots:
+        st.write("Today's doses")
+        for slot in slots:
+            st.write(f"{slot['scheduled_time']} {slot['med_name']}: {SLOT_LABELS[slot['status']]}")
+    if rates:
+        cols = st.columns(3)
+        cols[0].metric("On Time (30 days)", f"{rates['on_time_rate']:.0%}")
+        cols[1].metric("Late", rates[LATE])
+        cols[2].metric("Missed", rates[MISSED])
+
+    # Doses are on time within an hour of the scheduled time and late up to
+    # four hours after it
+    # Explicit dtypes: an empty schedule would otherwise give a float time
+    # column, which the TimeColumn editor rejects
+    frame = pd.DataFrame({
+        "med_name": pd.Series([entry["med_name"] for entry in schedule], dtype=object),
+        "scheduled_time": pd.Series([datetime.strptime(entry["scheduled_time"], "%H:%M").time()
+                                     for entry in schedule], dtype=object),
+        "dosage": pd.Series([entry["dosage"] for entry in schedule], dtype=float),
+    })
+    edited = st.data_editor(
+        frame,
+        num_rows="dynamic",
+        column_config={
+            "med_name": st.column_config.TextColumn("Medication", required=True),
+            "scheduled_time": st.column_config.TimeColumn("Time", format="HH:mm", step=60, required=True),
+            "dosage": st.column_config.NumberColumn("Dosage (mL)", min_value=0.0),
+        },
+        hide_index=True,
+        key="dose_schedule_editor"
+    )
+    if st.button("Save Schedule"):
+        try:
+            save_schedule(user_id, edited.to_dict("records"))
+            st.success("Schedule saved!")
+        except Exception as e:
+            st.error(f"Error saving schedule: {e}")
+
 def glucose_tracker():
     st.subheader("Glucose Tracker")
     
@@ -302,130 +283,168 @@ def glucose_tracker():
                                   min_value=0, max_value=600)
     
     if st.button("Log Glucose Reading", key="log_glucose_button"):
-        conn = create_database_connection()
-        if conn:
+        try:
+            execute_write("""
+                INSERT INTO glucose_readings 
+                (user_id, glucose_level, reading_time)
+                VALUES (?, ?, ?)
+            """, (st.session_state.user_id, glucose_level, 
+                  datetime.now()))
+            invalidate_user(st.session_state.user_id)
+            st.success("Glucose level logged successfully!")
+        except Exception as e:
+            st.error(f"Error logging glucose level: {e}")
+
+    with st.expander("Import from CGM / Meter"):
+        st.caption("Dexcom Clarity, FreeStyle LibreView or any CSV with timestamp and glucose columns")
+        uploaded = st.file_uploader("CSV export", type=["csv"], key="glucose_import_file")
+        if uploaded is not None and st.button("Import Readings", key="import_glucose_button"):
+            # Runs as a background job; the job deletes the upload when done
             try:
-                with conn:
-                    conn.execute("""
-                        INSERT INTO glucose_readings 
-                        (user_id, glucose_level, reading_time)
-                        VALUES (?, ?, ?)
-                    """, (st.session_state.user_id, glucose_level, 
-                          datetime.now()))
-                st.success("Glucose level logged successfully!")
+                upload_dir = get_pool().db_path.parent / "uploads"
+                upload_dir.mkdir(parents=True, exist_ok=True)
+                path = upload_dir / f"{uuid.uuid4().hex}.csv"
+                path.write_bytes(uploaded.getvalue())
+                submit_job("import_readings", {"path": str(path), "user_id": st.session_state.user_id,
+                                               "remove_source": True},
+                           owner=f"patient:{st.session_state.user_id}")
             except Exception as e:
-                st.error(f"Error logging glucose level: {e}")
-            finally:
-                conn.close()
-def process_glucose_data(df):
-    df['reading_time'] = pd.to_datetime(df['reading_time'])
-    df['hour'] = df['reading_time'].dt.floor('h')
-    hourly_avg = df.groupby('hour')['glucose_level'].mean().reset_index()
-    return hourly_avg
+                st.error(f"Error importing readings: {e}")
+        display_jobs(f"patient:{st.session_state.user_id}")
+
+GLUCOSE_CHART_WINDOWS = [("Last 24 Hours", 1), ("Last 7 Days", 7), ("Last 30 Days", 30),
+                         ("Last 90 Days", 90), ("Last Year", 365), ("All Time", None)]
+
+GLUCOSE_CHART_TITLES = {"raw": "Glucose Readings", "hour": "Hourly Glucose (mean and range)",
+                        "day": "Daily Glucose (mean and range)"}
 
 def display_glucose_chart():
-    conn = create_database_connection()
-    if conn:
-        df = pd.read_sql_query("""
-            SELECT glucose_level, reading_time 
-            FROM glucose_readings 
-            WHERE user_id = ? 
-            ORDER BY reading_time
-        """, conn, params=(st.session_state.user_id,))
+    window = st.selectbox("Chart range", GLUCOSE_CHART_WINDOWS, index=2,
+                          format_func=lambda option: option[0], key="glucose_chart_window")
+    # Windows end now, to the minute so the cached series follows the clock
+    now = datetime.now().replace(second=0, microsecond=0)
+    series, tier = cached(load_series, st.session_state.user_id, window[1], now)
+    latest_glucose_level = cached(latest_glucose, st.session_state.user_id)
+
+    if not series.empty:
+        fig = px.line(series, x='time', y='glucose_level',
+                     title=GLUCOSE_CHART_TITLES[tier])
+        if tier != "raw":
+            # Shaded min-max range of each bucket behind the mean line
+            fig.add_scatter(x=series['time'], y=series['glucose_max'], mode='lines',
+                            line_width=0, showlegend=False, hoverinfo='skip')
+            fig.add_scatter(x=series['time'], y=series['glucose_min'], mode='lines',
+                            line_width=0, fill='tonexty', fillcolor='rgba(99, 110, 250, 0.2)',
+                            showlegend=False, hoverinfo='skip')
+        fig.update_layout(
+            xaxis_title="Time",
+            yaxis_title="Glucose Level (mg/dL)",
+            height=400
+        )
         
-        if not df.empty:
-            hourly_data = process_glucose_data(df)
-            
-            fig = px.line(hourly_data, x='hour', y='glucose_level',
-                         title='Average Hourly Glucose Levels')
-            fig.update_layout(
-                xaxis_title="Time",
-                yaxis_title="Glucose Level (mg/dL)",
-                height=400
-            )
-            
-            # Add danger thresholds
-            fig.add_hline(y=180, line_dash="dash", line_color="red",
-                         annotation_text="High Risk")
-            fig.add_hline(y=70, line_dash="dash", line_color="red",
-                         annotation_text="Low Risk")
-            
-            st.plotly_chart(fig, use_container_width=True)
-            
-            # Warning messages
-            latest_glucose = df['glucose_level'].iloc[-1]
-            if latest_glucose > 180:
-                st.warning("⚠️ High glucose level detected! Please check with your healthcare provider.")
-            elif latest_glucose < 70:
-                st.warning("⚠️ Low glucose level detected! Please take immediate action.")
-        else:
-            st.info("No glucose readings available yet.")
-        conn.close()
+        # Add danger thresholds
+        fig.add_hline(y=180, line_dash="dash", line_color="red",
+                     annotation_text="High Risk")
+        fig.add_hline(y=70, line_dash="dash", line_color="red",
+                     annotation_text="Low Risk")
+        
+        st.plotly_chart(fig, use_container_width=True)
+        
+        # Warning messages
+        if latest_glucose_level > 180:
+            st.warning("⚠️ High glucose level detected! Please check with your healthcare provider.")
+        elif latest_glucose_level < 70:
+            st.warning("⚠️ Low glucose level detected! Please take immediate action.")
+    elif latest_glucose_level is not None:
+        st.info(f"No glucose readings in the {window[0].lower()}.")
+    else:
+        st.info("No glucose readings available yet.")
+
+def calendar_heatmap(grid, by_week=False, height=None):
+    # One Plotly heatmap for a calendar_grid(): weeks as rows with day numbers
+    # for month views, or weeks as columns (GitHub style) for a year
+    z, text, hover = grid["z"], grid["text"], grid["hover"]
+    weeks = [monday.strftime("%b %d") for monday in grid["weeks"]]
+    if by_week:
+        z, text, hover = z.T, None, hover.T
+        x, y = weeks, WEEKDAYS
+    else:
+        x, y = WEEKDAYS, weeks
+    fig = go.Figure(go.Heatmap(
+        z=z, x=x, y=y, text=text, texttemplate="%{text}" if text is not None else None,
+        customdata=hover, hovertemplate="%{customdata}<extra></extra>",
+        colorscale=calendar_colorscale(), zmin=NO_DATA, zmax=TAKEN, showscale=False,
+        xgap=3, ygap=3))
+    fig.update_yaxes(autorange="reversed", showgrid=False)
+    fig.update_xaxes(side="top", showgrid=False)
+    fig.update_layout(height=height or 40 + 32 * len(y), margin=dict(l=0, r=0, t=30, b=0),
+                      plot_bgcolor="rgba(0,0,0,0)")
+    return fig
 
 def display_medication_calendar():
     st.subheader("Medication Calendar")
-    
-    now = datetime.now()
-    cal = calendar.monthcalendar(now.year, now.month)
-    
-    conn = create_database_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT date, med_name, dosage, time_taken 
-                FROM medications 
-                WHERE user_id = ? 
-                AND strftime('%Y-%m', date) = ?
-            """, (st.session_state.user_id, now.strftime('%Y-%m')))
-            
-            med_data = cursor.fetchall()
-            
-            # Display calendar
-            days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-            cols = st.columns(7)
-            
-            for idx, day in enumerate(days):
-                cols[idx].write(day)
-            
-            for week in cal:
-                cols = st.columns(7)
-                for idx, day in enumerate(week):
-                    if day != 0:
-                        date_str = f"{now.year}-{now.month:02d}-{day:02d}"
-                        day_meds = [m for m in med_data if m[0] == date_str]
-                        
-                        if day_meds:
-                            cols[idx].markdown(f"**{day}** ✅")
-                        else:
-                            cols[idx].write(day)             
-        except Exception as e:
-            st.error(f"Error displaying medication calendar: {e}")
-        finally:
-            conn.close()
+    view = st.selectbox("Calendar view", list(CALENDAR_VIEWS), key="calendar_view")
+
+    try:
+        # One grouped query for the whole window, then a single heatmap
+        user_id = st.session_state.user_id
+        start, end = calendar_window(CALENDAR_VIEWS[view])
+        days = cached(load_calendar_days, user_id, start, end)
+        first_dose = cached(first_dose_date, user_id)
+        grid = calendar_grid(days, start, end, first_dose=first_dose)
+        by_week = CALENDAR_VIEWS[view] == 12
+        st.plotly_chart(calendar_heatmap(grid, by_week=by_week), use_container_width=True)
+        st.caption("🟩 Taken · 🟨 Partly taken (scheduled doses missed) · 🟥 Missed · ⬜ No data")
+    except Exception as e:
+        st.error(f"Error displaying medication calendar: {e}")
+
+ADHERENCE_HEATMAP_DAYS = 365
+
+def display_adherence_year(user_id, key):
+    # GitHub-style heatmap of the past year, read from the adherent-day
+    # bitmaps, and this year to date against the same dates last year
+    today = datetime.now().date()
+    start, end = today - timedelta(days=ADHERENCE_HEATMAP_DAYS - 1), today + timedelta(days=1)
+    try:
+        adherent = cached(adherent_days, user_id, start, end)
+        grid = adherence_grid(adherent, start, end, today, cached(first_dose_date, user_id))
+        st.plotly_chart(calendar_heatmap(grid, by_week=True), use_container_width=True, key=key)
+        years = cached(compare_years, user_id, today.year, today.year - 1, today)
+        cols = st.columns(3)
+        cols[0].metric(f"Adherent Days {today.year}", years['days'], years['days'] - years['other_days'])
+        cols[1].metric(f"Same Dates {today.year - 1}", years['other_days'])
+        cols[2].metric("Adherent Both Years", years['both'])
+    except Exception as e:
+        st.error(f"Error displaying adherence heatmap: {e}")
+
+@st.fragment(run_every=30)
+def display_reminder_inbox(user_id):
+    # Reruns on its own so reminders fired by the scheduler show up without
+    # a click
+    with get_connection() as conn:
+        notifications = load_inbox(conn, user_id)
+        _, snooze_options = load_reminder_settings(conn, user_id)
+    for note in notifications:
+        with st.container(border=True):
+            st.write(f"🔔 **{note['message']}** ({note['due_at'][11:16]})")
+            cols = st.columns(1 + len(snooze_options))
+            cols[0].button("Done", key=f"reminder_done_{note['notification_id']}",
+                           on_click=dismiss_notification, args=(note['notification_id'],))
+            for col, minutes in zip(cols[1:], snooze_options):
+                col.button(f"Snooze {minutes} min", key=f"reminder_snooze_{note['notification_id']}_{minutes}",
+                           on_click=snooze_notification, args=(note['notification_id'], minutes))
 
 def display_recent_medications():
-    conn = create_database_connection()
-    if conn:
-        try:
-            med_data = pd.read_sql_query("""
-                SELECT med_name, dosage, time_taken, date 
-                FROM medications 
-                WHERE user_id = ? 
-                AND med_name != 'Daily Medication'
-                ORDER BY date DESC, time_taken DESC
-                LIMIT 10
-            """, conn, params=(st.session_state.user_id,))
+    try:
+        med_data = cached(load_recent_medications, st.session_state.user_id)
+        
+        if not med_data.empty:
+            st.dataframe(med_data)
+        else:
+            st.info("No recent medication records")
             
-            if not med_data.empty:
-                st.dataframe(med_data)
-            else:
-                st.info("No recent medication records")
-                
-        except Exception as e:
-            st.error(f"Error displaying medications: {e}")
-        finally:
-            conn.close()
+    except Exception as e:
+        st.error(f"Error displaying medications: {e}")
 
 def medication_info_pages():
     st.title("Medication Information")
@@ -518,20 +537,13 @@ def create_analytics_charts(patient_id, timeframe, conn):
     st.subheader(f"Analytics for {timeframe[1]}")
     
     try:
-        # Glucose Analysis
-        glucose_data = pd.read_sql_query("""
-            SELECT glucose_level, reading_time, 
-                   strftime('%H', reading_time) as hour,
-                   strftime('%Y-%m-%d', reading_time) as date
-            FROM glucose_readings
-            WHERE user_id = ? 
-            AND reading_time >= datetime('now', ?)
-            ORDER BY reading_time DESC
-        """, conn, params=(patient_id, timeframe[0]))
+        # Glucose Analysis, from the per-day summaries rather than raw readings
+        glucose_data = cached(load_daily_summary, patient_id, since_date(timeframe[0]))
         
         if not glucose_data.empty:
             # Daily Average Chart
-            daily_avg = glucose_data.groupby('date')['glucose_level'].agg(['mean', 'min', 'max']).reset_index()
+            daily_avg = glucose_data.rename(columns={'day': 'date', 'glucose_min': 'min',
+                                                     'glucose_max': 'max'})
             
             fig_daily = px.line(daily_avg, x='date', y='mean',
                                title='Daily Average Glucose Levels',
@@ -543,17 +555,31 @@ def create_analytics_charts(patient_id, timeframe, conn):
             st.plotly_chart(fig_daily)
             
             # Time of Day Analysis
-            hourly_avg = glucose_data.groupby('hour')['glucose_level'].mean().reset_index()
+            hourly_avg = hourly_profile(glucose_data)
             fig_hourly = px.bar(hourly_avg, x='hour', y='glucose_level',
                                title='Average Glucose by Hour of Day',
                                labels={'glucose_level': 'Glucose Level (mg/dL)', 'hour': 'Hour'})
             st.plotly_chart(fig_hourly)
             
             # Statistics
+            totals = window_totals(glucose_data)
             col1, col2, col3 = st.columns(3)
-            col1.metric("Average Glucose", f"{glucose_data['glucose_level'].mean():.1f} mg/dL")
-            col2.metric("High Readings (>180)", len(glucose_data[glucose_data['glucose_level'] > 180]))
-            col3.metric("Low Readings (<70)", len(glucose_data[glucose_data['glucose_level'] < 70]))
+            col1.metric("Average Glucose", f"{totals['mean']:.1f} mg/dL")
+            col2.metric("High Readings (>180)", totals['hyper_count'])
+            col3.metric("Low Readings (<70)", totals['hypo_count'])
+            
+            # Time in range and variability, from the raw readings
+            today = datetime.now().date()
+            metrics = cached_many(load_panel_metrics, [patient_id], timeframe[0], today)[patient_id]
+            if metrics:
+                display_glycemic_metrics(metrics)
+                agp = cached(load_agp, patient_id, timeframe[0], today)
+                fig_agp = px.line(agp, x='slot', y=['p5', 'p25', 'p50', 'p75', 'p95'],
+                                  title='Ambulatory Glucose Profile',
+                                  labels={'value': 'Glucose Level (mg/dL)', 'slot': 'Time of Day',
+                                          'variable': 'Percentile'})
+                fig_agp.add_hrect(y0=70, y1=180, fillcolor="green", opacity=0.1, line_width=0)
+                st.plotly_chart(fig_agp)
         else:
             st.info("No glucose data available for this timeframe")
         
@@ -562,9 +588,9 @@ def create_analytics_charts(patient_id, timeframe, conn):
             SELECT med_name, date, time_taken
             FROM medications
             WHERE user_id = ?
-            AND date >= date('now', ?)
+            AND date >= ?
             ORDER BY date DESC, time_taken DESC
-        """, conn, params=(patient_id, timeframe[0]))
+        """, conn, params=(patient_id, since_date(timeframe[0])))
         
         if not med_data.empty:
             # Medication Adherence Chart
@@ -582,6 +608,49 @@ def create_analytics_charts(patient_id, timeframe, conn):
         st.error(f"Error creating analytics charts: {e}")
         return None, None
 
+def display_glycemic_metrics(metrics):
+    bands = pd.DataFrame({
+        'band': [BAND_LABELS[band] for band in BANDS],
+        'share': [metrics[band] * 100 for band in BANDS],
+    })
+    fig_tir = px.bar(bands, x='share', y=['Time in Range'] * len(bands), color='band',
+                     orientation='h', title='Time in Range',
+                     labels={'share': '% of Readings', 'y': '', 'band': 'mg/dL'},
+                     color_discrete_sequence=['#8B0000', '#FF4B4B', '#2E8B57', '#FFA500', '#FF8C00'])
+    fig_tir.update_layout(height=200)
+    st.plotly_chart(fig_tir, use_container_width=True)
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Time in Range (70-180)", f"{metrics['in_range']:.0%}")
+    col2.metric("GMI", f"{metrics['gmi']:.1f}%")
+    col3.metric("CV", f"{metrics['cv']:.1f}%")
+    col4.metric("MAGE", "n/a" if np.isnan(metrics['mage']) else f"{metrics['mage']:.0f} mg/dL")
+
+def display_adherence_metrics(summary, user_id, columns=3, outcomes=None):
+    # outcomes: the patient's load_outcome_rates() entry, when on a schedule
+    metrics = patient_adherence(summary, user_id)
+    if metrics is None or metrics['dose_count'] == 0:
+        st.info("No medication data available to assess adherence")
+        return
+    
+    deviation = metrics['timing_deviation']
+    values = [
+        ("Days Covered", f"{metrics['pdc']:.0%}"),
+        ("Longest Missed Run", f"{metrics['longest_missed_run']} days"),
+        ("Dose Timing Deviation", "n/a" if np.isnan(deviation) else f"±{deviation:.0f} min"),
+    ]
+    if outcomes:
+        values += [
+            ("Scheduled Doses Taken", f"{outcomes['taken_rate']:.0%}"),
+            ("Scheduled Doses On Time", f"{outcomes['on_time_rate']:.0%}"),
+            ("Scheduled Doses Missed", outcomes[MISSED]),
+        ]
+    cols = st.columns(columns)
+    for idx, (label, value) in enumerate(values):
+        cols[idx % columns].metric(label, value)
+
+EXPORT_FORMAT_LABELS = {"xlsx": "Excel Report", "csv": "CSV", "parquet": "Parquet"}
+
 def detailed_analytics_tab(patient_id):
     if not patient_id:
         st.warning("No patient selected")
@@ -590,10 +659,10 @@ def detailed_analytics_tab(patient_id):
     
     # Timeframe selection
     timeframe_options = [
-        ("-7 days", "Past Week"),
-        ("-30 days", "Past Month"),
-        ("-90 days", "Past 3 Months"),
-        ("-365 days", "Past Year")
+        (7, "Past Week"),
+        (30, "Past Month"),
+        (90, "Past 3 Months"),
+        (365, "Past Year")
     ]
     
     selected_timeframe = st.selectbox(
@@ -602,8 +671,7 @@ def detailed_analytics_tab(patient_id):
         format_func=lambda x: x[1]
     )
     
-    conn = create_database_connection()
-    if conn:
+    with get_connection() as conn:
         try:
             glucose_data, med_data = create_analytics_charts(
                 patient_id, 
@@ -611,90 +679,96 @@ def detailed_analytics_tab(patient_id):
                 conn
             )
             
+            st.subheader("Medication Adherence")
+            adherence_summary = load_adherence(conn, [patient_id], days=selected_timeframe[0])
+            outcomes = load_outcome_rates(conn, [patient_id], days=selected_timeframe[0]).get(patient_id)
+            display_adherence_metrics(adherence_summary, patient_id, outcomes=outcomes)
+            
             # Export Data Option
-            if glucose_data is not None or med_data is not None:
-                if st.button("Export Analytics Report"):
-                    try:
-                        buffer = io.BytesIO()
-                        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                            if glucose_data is not None:
-                                glucose_data.to_excel(writer, sheet_name='Glucose Data', index=False)
-                            if med_data is not None:
-                                med_data.to_excel(writer, sheet_name='Medication Data', index=False)
-                        
-                        buffer.seek(0)
-                        st.download_button(
-                            label="Download Excel Report",
-                            data=buffer,
-                            file_name=f"patient_analytics_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
-                    except Exception as e:
-                        st.error(f"Error creating Excel report: {e}")
+            st.subheader("Export Data")
+            export_cols = st.columns(3)
+            export_format = export_cols[0].selectbox(
+                "Format", options=list(EXPORT_FORMAT_LABELS),
+                format_func=lambda fmt: EXPORT_FORMAT_LABELS[fmt], key="export_format")
+            export_scope = export_cols[1].radio(
+                "Patients", ["This patient", "All patients"], key="export_scope")
+            export_range = export_cols[2].radio(
+                "Range", [selected_timeframe[1], "Full history"], key="export_range")
+            if st.button("Export Analytics Report"):
+                user_ids = [patient_id] if export_scope == "This patient" else None
+                submit_job("export", {
+                    "fmt": export_format,
+                    "datasets": ["glucose", "daily_summary", "medications"],
+                    "user_ids": user_ids,
+                    "days": None if export_range == "Full history" else selected_timeframe[0],
+                    "adherence_days": selected_timeframe[0],
+                    "prefix": f"patient_analytics_{datetime.now().strftime('%Y%m%d')}",
+                }, owner=f"provider:{st.session_state.provider_id}")
+            display_jobs(f"provider:{st.session_state.provider_id}")
                         
         except Exception as e:
             st.error(f"Error in detailed analytics: {e}")
-        finally:
-            conn.close()
-    else:
-        st.error("Database connection failed")
 
 def patient_messages():
     st.subheader("Healthcare Provider Messages")
     
-    conn = create_database_connection()
-    if conn:
-        try:
-            messages = pd.read_sql_query("""
-                SELECT message_content, sent_time, sender_type
-                FROM provider_messages
-                WHERE patient_id = ?
-                ORDER BY sent_time DESC
-            """, conn, params=(st.session_state.user_id,))
-            
-            if not messages.empty:
-                for _, msg in messages.iterrows():
-                    with st.chat_message(msg['sender_type']):
-                        st.write(msg['message_content'])
-                        st.caption(msg['sent_time'])
-            
-            # Allow patients to send messages to their provider
-            new_message = st.text_area("Message to Healthcare Provider")
-            if st.button("Send Message"):
-                if new_message.strip():
-                    conn.execute("""
-                        INSERT INTO provider_messages 
-                        (patient_id, message_content, sender_type)
-                        VALUES (?, ?, 'patient')
-                    """, (st.session_state.user_id, new_message))
-                    conn.commit()
-                    st.success("Message sent!")
-                    st.rerun()
-        finally:
-            conn.close()
+    with get_connection() as conn:
+        messages = pd.read_sql_query("""
+            SELECT message_content, sent_time, sender_type
+            FROM provider_messages
+            WHERE patient_id = ?
+            ORDER BY sent_time DESC
+        """, conn, params=(st.session_state.user_id,))
+        
+        if not messages.empty:
+            for _, msg in messages.iterrows():
+                with st.chat_message(msg['sender_type']):
+                    st.write(msg['message_content'])
+                    st.caption(msg['sent_time'])
+        
+        # Allow patients to send messages to their provider
+        new_message = st.text_area("Message to Healthcare Provider")
+        if st.button("Send Message"):
+            if new_message.strip():
+                execute_write("""
+                    INSERT INTO provider_messages 
+                    (patient_id, message_content, sender_type)
+                    VALUES (?, ?, 'patient')
+                """, (st.session_state.user_id, new_message))
+                invalidate_user(st.session_state.user_id)
+                st.success("Message sent!")
+                st.rerun()
+
+def load_conversation(conn, patient_id):
+    # The thread is cached in session state, so a rerun only fetches messages
+    # newer than the last one already shown
+    key = f"conversation_{patient_id}"
+    thread = st.session_state.get(key)
+    if thread is None or not thread['messages']:
+        messages, has_older = load_recent_messages(conn, patient_id)
+        thread = {'messages': messages, 'has_older': has_older}
+        st.session_state[key] = thread
+    else:
+        last_seen_id = thread['messages'][-1]['message_id']
+        thread['messages'].extend(load_new_messages(conn, patient_id, last_seen_id))
+    return thread
+
+def load_older_messages(conn, thread, patient_id):
+    older, thread['has_older'] = load_recent_messages(
+        conn, patient_id, before_id=thread['messages'][0]['message_id'])
+    thread['messages'] = older + thread['messages']
 
 def display_provider_messages_patient():
     st.subheader("Healthcare Provider Messages")
     
-    conn = create_database_connection()
-    if conn:
+    with get_connection() as conn:
         try:
-            messages = pd.read_sql_query("""
-                SELECT 
-                    pm.message_content, 
-                    pm.sent_time, 
-                    pm.sender_type,
-                    CASE 
-                        WHEN pm.sender_type = 'provider' THEN 
-                            (SELECT full_name FROM user_accounts WHERE user_id = pm.provider_id)
-                        ELSE 'You'
-                    END as sender_name
-                FROM provider_messages pm
-                WHERE pm.patient_id = ?
-                ORDER BY pm.sent_time ASC
-            """, conn, params=(st.session_state.user_id,))
+            thread = load_conversation(conn, st.session_state.user_id)
             
-            if not messages.empty:
+            if thread['messages']:
+                if thread['has_older'] and st.button("Show older messages", key="older_messages_patient"):
+                    load_older_messages(conn, thread, st.session_state.user_id)
+                
                 st.markdown("""
                     <style>
                     .provider-message {
@@ -730,9 +804,11 @@ def display_provider_messages_patient():
                     </style>
                 """, unsafe_allow_html=True)
                 
-                for _, msg in messages.iterrows():
+                # Render the whole thread as a single element
+                bubbles = []
+                for msg in thread['messages']:
                     if msg['sender_type'] == 'provider':
-                        st.markdown(f"""
+                        bubbles.append(f"""
                             <div class="provider-message">
                                 <div class="message-name" style="color: rgba(255, 255, 255, 0.8);">
                                     Dr. {msg['sender_name']}
@@ -740,9 +816,9 @@ def display_provider_messages_patient():
                                 {msg['message_content']}
                                 <div class="message-time provider-time">{msg['sent_time']}</div>
                             </div>
-                        """, unsafe_allow_html=True)
+                        """)
                     else:
-                        st.markdown(f"""
+                        bubbles.append(f"""
                             <div class="patient-message">
                                 <div class="message-name" style="color: #666;">
                                     You
@@ -750,26 +826,25 @@ def display_provider_messages_patient():
                                 {msg['message_content']}
                                 <div class="message-time patient-time">{msg['sent_time']}</div>
                             </div>
-                        """, unsafe_allow_html=True)
+                        """)
+                st.markdown("".join(bubbles), unsafe_allow_html=True)
                 
                 # Message input
                 new_message = st.text_area("Reply to your healthcare provider")
                 if st.button("Send"):
                     if new_message.strip():
-                        conn.execute("""
+                        execute_write("""
                             INSERT INTO provider_messages 
                             (patient_id, message_content, sender_type)
                             VALUES (?, ?, 'patient')
                         """, (st.session_state.user_id, new_message))
-                        conn.commit()
+                        invalidate_user(st.session_state.user_id)
                         st.rerun()
             else:
                 st.info("No messages from your healthcare provider yet.")
                 
         except Exception as e:
             st.error(f"Error displaying messages: {e}")
-        finally:
-            conn.close()
 
 def community_chat():
     st.title("Chat")
@@ -780,92 +855,76 @@ def community_chat():
         post_type = st.selectbox("Post Type", ["General Discussion", "Question", "Support"], key="post_type_select")
         if st.button("Post", key="create_post"):
             if post_content.strip():  # Check if content is not empty
-                conn = create_database_connection()
-                if conn:
-                    try:
-                        conn.execute("""
-                            INSERT INTO community_posts (user_id, content, post_type)
-                            VALUES (?, ?, ?)
-                        """, (st.session_state.user_id, post_content, post_type))
-                        conn.commit()
-                        st.success("Post created successfully!")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Error creating post: {e}")
-                    finally:
-                        conn.close()
+                try:
+                    execute_write("""
+                        INSERT INTO community_posts (user_id, content, post_type)
+                        VALUES (?, ?, ?)
+                    """, (st.session_state.user_id, post_content, post_type))
+                    invalidate_user(st.session_state.user_id)
+                    st.success("Post created successfully!")
+                    st.session_state.feed_cursors = [None]
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error creating post: {e}")
             else:
                 st.warning("Please enter some content for your post")
 
     # Display posts
-    conn = create_database_connection()
-    if conn:
+    with get_connection() as conn:
         try:
-            # Fetch posts with user information
-            posts = pd.read_sql_query("""
-                SELECT p.post_id, p.content, p.created_at, u.username, u.full_name 
-                FROM community_posts p
-                LEFT JOIN user_accounts u ON p.user_id = u.user_id
-                ORDER BY p.created_at DESC
-            """, conn)
+            # Fetch each loaded page of posts together with all of its comments
+            pages = [load_feed_page(conn, cursor) for cursor in st.session_state.feed_cursors]
             
             # Display each post
-            for _, post in posts.iterrows():
-                with st.container():
-                    # Post header
-                    col1, col2 = st.columns([4, 1])
-                    with col1:
-                        st.markdown(f"**{post['full_name']}** (@{post['username']})")
-                    with col2:
-                        st.markdown(f"_{post['created_at']}_")
-                    
-                    # Post content
-                    st.markdown(f"**{post['post_type']}**")
-                    st.write(post['content'])
-                    
-                    # Comments section
-                    with st.expander("Comments"):
-                        # Fetch comments for this post
-                        comments = pd.read_sql_query("""
-                            SELECT 
-                                c.content,
-                                c.created_at,
-                                u.username,
-                                u.full_name
-                            FROM post_comments c
-                            LEFT JOIN user_accounts u ON c.user_id = u.user_id
-                            WHERE c.post_id = ?
-                            ORDER BY c.created_at
-                        """, conn, params=(post['post_id'],))
+            for posts, comments, next_cursor in pages:
+                for post in posts:
+                    with st.container():
+                        # Post header
+                        col1, col2 = st.columns([4, 1])
+                        with col1:
+                            st.markdown(f"**{post['full_name']}** (@{post['username']})")
+                        with col2:
+                            st.markdown(f"_{post['created_at']}_")
                         
-                        # Display existing comments
-                        for _, comment in comments.iterrows():
-                            st.markdown(f"↳ **{comment['full_name']}**: {comment['content']}")
-                            st.caption(comment['created_at'])
+                        # Post content
+                        st.markdown(f"**{post['post_type']}**")
+                        st.write(post['content'])
                         
-                        # Add new comment
-                        new_comment = st.text_input("Add a comment", key=f"comment_{post['post_id']}")
-                        if st.button("Reply", key=f"btn_{post['post_id']}"):
-                            if new_comment.strip():
-                                try:
-                                    conn.execute("""
-                                        INSERT INTO post_comments (post_id, user_id, content)
-                                        VALUES (?, ?, ?)
-                                    """, (post['post_id'], st.session_state.user_id, new_comment))
-                                    conn.commit()
-                                    st.success("Reply added!")
-                                    st.rerun()
-                                except Exception as e:
-                                    st.error(f"Error adding reply: {e}")
-                            else:
-                                st.warning("Please enter a comment before replying")
-                    
-                    st.markdown("---")  # Separator between posts
+                        # Comments section
+                        with st.expander("Comments"):
+                            # Display existing comments
+                            for comment in comments[post['post_id']]:
+                                st.markdown(f"↳ **{comment['full_name']}**: {comment['content']}")
+                                st.caption(comment['created_at'])
+                            
+                            # Add new comment
+                            new_comment = st.text_input("Add a comment", key=f"comment_{post['post_id']}")
+                            if st.button("Reply", key=f"btn_{post['post_id']}"):
+                                if new_comment.strip():
+                                    try:
+                                        execute_write("""
+                                            INSERT INTO post_comments (post_id, user_id, content)
+                                            VALUES (?, ?, ?)
+                                        """, (post['post_id'], st.session_state.user_id, new_comment))
+                                        invalidate_user(st.session_state.user_id)
+                                        st.success("Reply added!")
+                                        st.rerun()
+                                    except Exception as e:
+                                        st.error(f"Error adding reply: {e}")
+                                else:
+                                    st.warning("Please enter a comment before replying")
+                        
+                        st.markdown("---")  # Separator between posts
+            
+            # Older posts are fetched one page at a time
+            next_cursor = pages[-1][2]
+            if next_cursor is not None:
+                if st.button("Load more posts", key="load_more_posts"):
+                    st.session_state.feed_cursors.append(next_cursor)
+                    st.rerun()
                     
         except Exception as e:
             st.error(f"Error loading posts: {e}")
-        finally:
-            conn.close()
 
 def initialize_session_state():
     if 'page' not in st.session_state:
@@ -884,6 +943,8 @@ def initialize_session_state():
         st.session_state.anonymous_id = None
     if 'username' not in st.session_state:
         st.session_state.username = None
+    if 'feed_cursors' not in st.session_state:
+        st.session_state.feed_cursors = [None]
 
 def add_treatment_plan(patient_id, provider_id):
     st.subheader("Create Treatment Plan")
@@ -892,20 +953,16 @@ def add_treatment_plan(patient_id, provider_id):
     follow_up = st.date_input("Follow-up Date")
 
     if st.button("Save Treatment Plan"):
-        conn = create_database_connection()
-        if conn:
-            try:
-                conn.execute("""
-                    INSERT INTO treatment_plans 
-                    (patient_id, provider_id, plan_content, medications, follow_up_date)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (patient_id, provider_id, plan_content, medications, follow_up))
-                conn.commit()
-                st.success("Treatment plan saved!")
-            except Exception as e:
-                st.error(f"Error saving plan: {e}")
-            finally:
-                conn.close()
+        try:
+            execute_write("""
+                INSERT INTO treatment_plans 
+                (patient_id, provider_id, plan_content, medications, follow_up_date)
+                VALUES (?, ?, ?, ?, ?)
+            """, (patient_id, provider_id, plan_content, medications, follow_up))
+            invalidate_user(patient_id)
+            st.success("Treatment plan saved!")
+        except Exception as e:
+            st.error(f"Error saving plan: {e}")
 
 def view_patient_data(patient_id, conn):
     st.subheader("Patient Data Overview")
@@ -934,282 +991,316 @@ def view_patient_data(patient_id, conn):
         st.write("Medication History")
         st.dataframe(med_data)
 
+def display_panel_triage(conn):
+    st.subheader(f"Patients by Risk (last {TRIAGE_WINDOW_DAYS} days)")
+    panel = load_triage(conn)
+    if panel.empty:
+        st.info("No patients found in the database")
+        return
+
+    flagged = panel[panel['reasons'] != '']
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Patients", len(panel))
+    col2.metric("Needing Attention", len(flagged))
+    col3.metric("With Frequent Lows", int((panel['time_below_range'] >= BELOW_RANGE_TARGET).sum()))
+
+    st.dataframe(
+        panel[['full_name', 'username', 'risk_score', 'reasons', 'time_below_range',
+               'time_above_range', 'days_since_dose', 'scheduled_taken', 'days_since_reading']],
+        column_config={
+            'full_name': "Patient",
+            'username': "Username",
+            'risk_score': st.column_config.ProgressColumn("Risk", min_value=0, max_value=100, format="%.0f"),
+            'reasons': "Flags",
+            'time_below_range': st.column_config.NumberColumn("Below 70", format="percent"),
+            'time_above_range': st.column_config.NumberColumn("Above 180", format="percent"),
+            'days_since_dose': st.column_config.NumberColumn("Days Since Dose", format="%d"),
+            'scheduled_taken': st.column_config.NumberColumn("Scheduled Doses Taken", format="percent"),
+            'days_since_reading': st.column_config.NumberColumn("Days Since Reading", format="%d"),
+        },
+        hide_index=True,
+        use_container_width=True
+    )
+    st.caption("Select a patient in the sidebar to open their chart.")
+
 def healthcare_provider_section():
     st.title("Healthcare Provider Portal")
     
-    conn = create_database_connection()
-    if conn is None:
-        st.error("Failed to connect to database")
-        return
-
-    try:
-        # Provider authentication
-        if not st.session_state.get('is_provider', False):
-            col1, col2 = st.columns(2)
+    with get_connection() as conn:
+        try:
+            # Provider authentication
+            if not st.session_state.get('is_provider', False):
+                col1, col2 = st.columns(2)
             
-            with col1:
-                provider_id = st.text_input("Provider ID")
-                provider_code = st.text_input("Access Code", type="password")
+                with col1:
+                    provider_id = st.text_input("Provider ID")
+                    provider_code = st.text_input("Access Code", type="password")
             
-            if st.button("Access Provider Portal"):
-                if provider_code == "provider123":
-                    st.session_state.is_provider = True
-                    st.session_state.provider_id = provider_id
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT full_name FROM user_accounts WHERE user_id = ?", (provider_id,))
-                    provider_name = cursor.fetchone()
-                    if provider_name:
-                        st.session_state.provider_name = provider_name[0]
-                    st.rerun()
-                else:
-                    st.error("Invalid credentials")
-            return
-
-        # Only proceed if provider is authenticated
-        if st.session_state.get('is_provider', False):
-            # Get list of patients
-            patients_query = """
-                SELECT DISTINCT u.user_id, u.full_name, u.username,
-                COALESCE((SELECT COUNT(*) FROM glucose_readings g WHERE g.user_id = u.user_id), 0) as reading_count,
-                COALESCE((SELECT COUNT(*) FROM medications m WHERE m.user_id = u.user_id), 0) as med_count
-                FROM user_accounts u
-                LEFT JOIN glucose_readings g ON u.user_id = g.user_id
-                LEFT JOIN medications m ON u.user_id = m.user_id
-                GROUP BY u.user_id, u.full_name, u.username
-                ORDER BY u.full_name
-            """
-            patients = pd.read_sql_query(patients_query, conn)
-
-            # Create tabs
-            tabs = st.tabs(["Patient Overview", "Detailed Analytics", "Communication", "Treatment Plans"])
-
-            # Patient selection in sidebar
-            with st.sidebar:
-                if len(patients) > 0:  # Check length instead of using .empty
-                    selected_username = st.selectbox(
-                        "Select Patient",
-                        options=patients['username'].tolist(),
-                        format_func=lambda x: f"{patients[patients['username'] == x]['full_name'].iloc[0]} ({x})",
-                        key="provider_patient_select"
-                    )
-                    
-                    # Get patient ID from selection
-                    patient_mask = patients['username'] == selected_username
-                    if any(patient_mask):  # Use any() instead of direct DataFrame evaluation
-                        patient_id = int(patients.loc[patient_mask, 'user_id'].iloc[0])
-                        st.session_state.current_patient_id = patient_id
-                else:
-                    st.warning("No patients found in the database")
-                    return
-            # Proceed with tabs if we have a current patient
-            if st.session_state.get('current_patient_id'):
-                # Tab 1: Patient Overview
+                if st.button("Access Provider Portal"):
+                    if provider_code == "provider123":
+                        st.session_state.is_provider = True
+                        st.session_state.provider_id = provider_id
+                        cursor = conn.cursor()
+                        cursor.execute("SELECT full_name FROM user_accounts WHERE user_id = ?", (provider_id,))
+                        provider_name = cursor.fetchone()
+                        if provider_name:
+                            st.session_state.provider_name = provider_name[0]
+                        st.rerun()
+                    else:
+                        st.error("Invalid credentials")
+                return
+
+            # Only proceed if provider is authenticated
+            if st.session_state.get('is_provider', False):
+                # Get list of patients
+                patients_query = """
+                    SELECT u.user_id, u.full_name, u.username,
+                    COALESCE(s.reading_count, 0) as reading_count,
+                    COALESCE(s.med_count, 0) as med_count,
+                    s.last_reading_at, s.last_med_at
+                    FROM user_accounts u
+                    LEFT JOIN user_stats s ON s.user_id = u.user_id
+                    ORDER BY u.full_name, u.username
+                """
+                patients = pd.read_sql_query(patients_query, conn)
+
+                # Create tabs
+                tabs = st.tabs(["Panel Triage", "Patient Overview", "Detailed Analytics", "Communication",
+                                "Treatment Plans"])
+
+                # Tab 1: Panel Triage, every patient ranked by risk
                 with tabs[0]:
-                    col1, col2 = st.columns([2, 1])
+                    display_panel_triage(conn)
+
+                # Patient selection in sidebar
+                with st.sidebar:
+                    if len(patients) > 0:  # Check length instead of using .empty
+                        selected_username = st.selectbox(
+                            "Select Patient",
+                            options=patients['username'].tolist(),
+                            format_func=lambda x: f"{patients[patients['username'] == x]['full_name'].iloc[0]} ({x})",
+                            key="provider_patient_select"
+                        )
+                    
+                        # Get patient ID from selection
+                        patient_mask = patients['username'] == selected_username
+                        if any(patient_mask):  # Use any() instead of direct DataFrame evaluation
+                            patient_id = int(patients.loc[patient_mask, 'user_id'].iloc[0])
+                            st.session_state.current_patient_id = patient_id
+                    else:
+                        st.warning("No patients found in the database")
+                        return
+                # Proceed with tabs if we have a current patient
+                if st.session_state.get('current_patient_id'):
+                    # Tab 2: Patient Overview
+                    with tabs[1]:
+                        col1, col2 = st.columns([2, 1])
                     
-                    with col1:
-                        st.subheader("Glucose Trends")
-                        glucose_query = """
-                            SELECT glucose_level, reading_time,
-                            CASE 
-                                WHEN glucose_level > 180 THEN 'High'
-                                WHEN glucose_level < 70 THEN 'Low'
-                                ELSE 'Normal'
-                            END as status
-                            FROM glucose_readings
-                            WHERE user_id = ?
-                            AND reading_time >= date('now', '-30 days')
-                            ORDER BY reading_time DESC
-                        """
-                        glucose_data = pd.read_sql_query(glucose_query, conn, params=(st.session_state.current_patient_id,))
+                        with col1:
+                            st.subheader("Glucose Trends")
+                            glucose_query = """
+                                SELECT glucose_level, reading_time,
+                                CASE 
+                                    WHEN glucose_level > 180 THEN 'High'
+                                    WHEN glucose_level < 70 THEN 'Low'
+                                    ELSE 'Normal'
+                                END as status
+                                FROM glucose_readings
+                                WHERE user_id = ?
+                                AND reading_time >= ?
+                                ORDER BY reading_time DESC
+                            """
+                            glucose_data = pd.read_sql_query(glucose_query, conn, params=(st.session_state.current_patient_id,
+                                                                                          since_date(30)))
                         
-                        if not glucose_data.empty:
-                            glucose_data['reading_time'] = pd.to_datetime(glucose_data['reading_time'])
+                            if not glucose_data.empty:
+                                glucose_data['reading_time'] = pd.to_datetime(glucose_data['reading_time'])
+                            
+                                fig = px.line(glucose_data, 
+                                            x='reading_time', 
+                                            y='glucose_level',
+                                            color='status',
+                                            title='30-Day Glucose Trends')
+                                fig.add_hline(y=180, line_dash="dash", line_color="red")
+                                fig.add_hline(y=70, line_dash="dash", line_color="red")
+                                st.plotly_chart(fig, use_container_width=True)
                             
-                            fig = px.line(glucose_data, 
-                                        x='reading_time', 
-                                        y='glucose_level',
-                                        color='status',
-                                        title='30-Day Glucose Trends')
-                            fig.add_hline(y=180, line_dash="dash", line_color="red")
-                            fig.add_hline(y=70, line_dash="dash", line_color="red")
-                            st.plotly_chart(fig, use_container_width=True)
+                                avg_glucose = glucose_data['glucose_level'].mean()
+                                high_readings = len(glucose_data[glucose_data['glucose_level'] > 180])
+                                low_readings = len(glucose_data[glucose_data['glucose_level'] < 70])
                             
-                            avg_glucose = glucose_data['glucose_level'].mean()
-                            high_readings = len(glucose_data[glucose_data['glucose_level'] > 180])
-                            low_readings = len(glucose_data[glucose_data['glucose_level'] < 70])
+                                metrics_col1, metrics_col2, metrics_col3 = st.columns(3)
+                                metrics_col1.metric("Average Glucose", f"{avg_glucose:.1f} mg/dL")
+                                metrics_col2.metric("High Readings", high_readings)
+                                metrics_col3.metric("Low Readings", low_readings)
                             
-                            metrics_col1, metrics_col2, metrics_col3 = st.columns(3)
-                            metrics_col1.metric("Average Glucose", f"{avg_glucose:.1f} mg/dL")
-                            metrics_col2.metric("High Readings", high_readings)
-                            metrics_col3.metric("Low Readings", low_readings)
-                        else:
-                            st.info("No glucose readings available for this patient")
+                                glycemic = cached_many(load_panel_metrics, [st.session_state.current_patient_id],
+                                                       30, datetime.now().date())[st.session_state.current_patient_id]
+                                if glycemic:
+                                    metrics_col1.metric("Time in Range", f"{glycemic['in_range']:.0%}")
+                                    metrics_col2.metric("GMI", f"{glycemic['gmi']:.1f}%")
+                                    metrics_col3.metric("CV", f"{glycemic['cv']:.1f}%")
+                            else:
+                                st.info("No glucose readings available for this patient")
                     
-                    with col2:
-                        st.subheader("Recent Medications")
-                        med_query = """
-                            SELECT med_name, dosage, time_taken, date
-                            FROM medications
-                            WHERE user_id = ?
-                            ORDER BY date DESC, time_taken DESC
-                            LIMIT 10
-                        """
-                        med_data = pd.read_sql_query(med_query, conn, params=(st.session_state.current_patient_id,))
+                        with col2:
+                            st.subheader("Adherence (30 days)")
+                            adherence_summary = load_adherence(conn, [st.session_state.current_patient_id], days=30)
+                            outcomes = load_outcome_rates(conn, [st.session_state.current_patient_id], days=30)
+                            display_adherence_metrics(adherence_summary, st.session_state.current_patient_id, columns=1,
+                                                      outcomes=outcomes.get(st.session_state.current_patient_id))
                         
-                        if not med_data.empty:
-                            st.dataframe(med_data, use_container_width=True)
-                        else:
-                            st.info("No medication records available")
-
-                # Tab 2: Detailed Analytics
-                with tabs[1]:
-                    detailed_analytics_tab(st.session_state.current_patient_id)
-
-                # Tab 3: Communication
-                with tabs[2]:  # Communication tab
-                    st.subheader("Patient Communication")
+                            st.subheader("Recent Medications")
+                            med_query = """
+                                SELECT med_name, dosage, time_taken, date
+                                FROM medications
+                                WHERE user_id = ?
+                                ORDER BY date DESC, time_taken DESC
+                                LIMIT 10
+                            """
+                            med_data = pd.read_sql_query(med_query, conn, params=(st.session_state.current_patient_id,))
+                        
+                            if not med_data.empty:
+                                st.dataframe(med_data, use_container_width=True)
+                            else:
+                                st.info("No medication records available")
+
+                        st.subheader("Adherence (past year)")
+                        display_adherence_year(st.session_state.current_patient_id, key="provider_adherence_year")
+
+                    # Tab 3: Detailed Analytics
+                    with tabs[2]:
+                        detailed_analytics_tab(st.session_state.current_patient_id)
+
+                    # Tab 4: Communication
+                    with tabs[3]:  # Communication tab
+                        st.subheader("Patient Communication")
                     
-                    # Get patient name for display
-                    patient_name = patients[patients['user_id'] == st.session_state.current_patient_id]['full_name'].iloc[0]
-                    st.write(f"Conversation with {patient_name}")
+                        # Get patient name for display
+                        patient_name = patients[patients['user_id'] == st.session_state.current_patient_id]['full_name'].iloc[0]
+                        st.write(f"Conversation with {patient_name}")
                     
-                    # Updated query to properly get provider name
-                    messages = pd.read_sql_query("""
-                        SELECT 
-                            pm.message_content, 
-                            pm.sent_time, 
-                            pm.sender_type,
-                            CASE 
-                                WHEN pm.sender_type = 'provider' THEN 
-                                    (SELECT full_name FROM user_accounts WHERE user_id = pm.provider_id)
-                                WHEN pm.sender_type = 'patient' THEN 
-                                    (SELECT full_name FROM user_accounts WHERE user_id = pm.patient_id)
-                            END as sender_name,
-                            pm.provider_id,
-                            pm.patient_id
-                        FROM provider_messages pm
-                        WHERE pm.patient_id = ?
-                        ORDER BY pm.sent_time ASC
-                    """, conn, params=(st.session_state.current_patient_id,))
+                        thread = load_conversation(conn, st.session_state.current_patient_id)
+                        if thread['has_older'] and st.button("Show older messages", key="older_messages_provider"):
+                            load_older_messages(conn, thread, st.session_state.current_patient_id)
                     
-                    # Create message container with custom CSS
-                    st.markdown("""
-                        <style>
-                        .provider-message {
-                            background-color: #007AFF;
-                            color: white;
-                            padding: 10px;
-                            border-radius: 15px;
-                            margin: 5px 0;
-                            max-width: 80%;
-                            margin-left: auto;
-                        }
-                        .patient-message {
-                            background-color: #E8E8E8;
-                            padding: 10px;
-                            border-radius: 15px;
-                            margin: 5px 0;
-                            max-width: 80%;
-                        }
-                        .message-name {
-                            font-size: 0.8em;
-                            margin-bottom: 2px;
-                        }
-                        .message-time {
-                            font-size: 0.7em;
-                            margin-top: 2px;
-                        }
-                        .provider-time {
-                            color: rgba(255, 255, 255, 0.8);
-                        }
-                        .patient-time {
-                            color: #666;
-                        }
-                        </style>
-                    """, unsafe_allow_html=True)
+                        # Create message container with custom CSS
+                        st.markdown("""
+                            <style>
+                            .provider-message {
+                                background-color: #007AFF;
+                                color: white;
+                                padding: 10px;
+                                border-radius: 15px;
+                                margin: 5px 0;
+                                max-width: 80%;
+                                margin-left: auto;
+                            }
+                            .patient-message {
+                                background-color: #E8E8E8;
+                                padding: 10px;
+                                border-radius: 15px;
+                                margin: 5px 0;
+                                max-width: 80%;
+                            }
+                            .message-name {
+                                font-size: 0.8em;
+                                margin-bottom: 2px;
+                            }
+                            .message-time {
+                                font-size: 0.7em;
+                                margin-top: 2px;
+                            }
+                            .provider-time {
+                                color: rgba(255, 255, 255, 0.8);
+                            }
+                            .patient-time {
+                                color: #666;
+                            }
+                            </style>
+                        """, unsafe_allow_html=True)
                     
-                    # Display messages
-                    for _, msg in messages.iterrows():
-                        # For provider view, reverse the message alignment
-                        if msg['sender_type'] == 'provider':
-                            st.markdown(f"""
-                                <div class="provider-message">
-                                    <div class="message-name" style="color: rgba(255, 255, 255, 0.8);">
-                                        You
+                        # Display messages as a single element
+                        bubbles = []
+                        for msg in thread['messages']:
+                            # For provider view, reverse the message alignment
+                            if msg['sender_type'] == 'provider':
+                                bubbles.append(f"""
+                                    <div class="provider-message">
+                                        <div class="message-name" style="color: rgba(255, 255, 255, 0.8);">
+                                            You
+                                        </div>
+                                        {msg['message_content']}
+                                        <div class="message-time provider-time">{msg['sent_time']}</div>
                                     </div>
-                                    {msg['message_content']}
-                                    <div class="message-time provider-time">{msg['sent_time']}</div>
-                                </div>
-                            """, unsafe_allow_html=True)
-                        else:
-                            st.markdown(f"""
-                                <div class="patient-message">
-                                    <div class="message-name" style="color: #666;">
-                                        {patient_name}
+                                """)
+                            else:
+                                bubbles.append(f"""
+                                    <div class="patient-message">
+                                        <div class="message-name" style="color: #666;">
+                                            {patient_name}
+                                        </div>
+                                        {msg['message_content']}
+                                        <div class="message-time patient-time">{msg['sent_time']}</div>
                                     </div>
-                                    {msg['message_content']}
-                                    <div class="message-time patient-time">{msg['sent_time']}</div>
-                                </div>
-                            """, unsafe_allow_html=True)
+                                """)
+                        if bubbles:
+                            st.markdown("".join(bubbles), unsafe_allow_html=True)
                     
-                    # Message input
-                    new_message = st.text_area("Type your message")
-                    if st.button("Send"):
-                        if new_message.strip():
-                            try:
-                                conn.execute("""
-                                    INSERT INTO provider_messages 
-                                    (patient_id, provider_id, message_content, sender_type, read_status)
-                                    VALUES (?, ?, ?, 'provider', 0)
-                                """, (st.session_state.current_patient_id, 
-                                     st.session_state.provider_id, 
-                                     new_message))
-                                conn.commit()
-                                st.success("Message sent!")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Error sending message: {e}")
-
-                # Tab 4: Treatment Plans
-                with tabs[3]:
-                    st.subheader("Treatment Plan Management")
-                    try:
-                        current_plan_query = """
-                            SELECT plan_content, created_at
-                            FROM treatment_plans
-                            WHERE patient_id = ?
-                            ORDER BY created_at DESC
-                            LIMIT 1
-                        """
-                        current_plan_df = pd.read_sql_query(current_plan_query, conn, params=(patient_id,))
+                        # Message input
+                        new_message = st.text_area("Type your message")
+                        if st.button("Send"):
+                            if new_message.strip():
+                                try:
+                                    execute_write("""
+                                        INSERT INTO provider_messages 
+                                        (patient_id, provider_id, message_content, sender_type, read_status)
+                                        VALUES (?, ?, ?, 'provider', 0)
+                                    """, (st.session_state.current_patient_id, 
+                                         st.session_state.provider_id, 
+                                         new_message))
+                                    invalidate_user(st.session_state.current_patient_id)
+                                    st.success("Message sent!")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Error sending message: {e}")
+
+                    # Tab 5: Treatment Plans
+                    with tabs[4]:
+                        st.subheader("Treatment Plan Management")
+                        try:
+                            current_plan_query = """
+                                SELECT plan_content, created_at
+                                FROM treatment_plans
+                                WHERE patient_id = ?
+                                ORDER BY created_at DESC
+                                LIMIT 1
+                            """
+                            current_plan_df = pd.read_sql_query(current_plan_query, conn, params=(patient_id,))
                         
-                        if not current_plan_df.empty:
-                            st.text_area("Current Treatment Plan", 
-                                       value=current_plan_df['plan_content'].iloc[0],
-                                       height=200,
-                                       key="current_plan")
-                            st.caption(f"Last updated: {current_plan_df['created_at'].iloc[0]}")
+                            if not current_plan_df.empty:
+                                st.text_area("Current Treatment Plan", 
+                                           value=current_plan_df['plan_content'].iloc[0],
+                                           height=200,
+                                           key="current_plan")
+                                st.caption(f"Last updated: {current_plan_df['created_at'].iloc[0]}")
                         
-                        new_plan = st.text_area("New Treatment Plan", height=200, key="new_plan")
-                        if st.button("Update Treatment Plan", key="update_plan"):
-                            if new_plan.strip():
-                                conn.execute("""
-                                    INSERT INTO treatment_plans 
-                                    (patient_id, provider_id, plan_content)
-                                    VALUES (?, ?, ?)
-                                """, (patient_id, st.session_state.provider_id, new_plan))
-                                conn.commit()
-                                st.success("Treatment plan updated!")
-                                st.rerun()
-                    except Exception as e:
-                        st.error(f"Error in treatment plans tab: {str(e)}")
+                            new_plan = st.text_area("New Treatment Plan", height=200, key="new_plan")
+                            if st.button("Update Treatment Plan", key="update_plan"):
+                                if new_plan.strip():
+                                    execute_write("""
+                                        INSERT INTO treatment_plans 
+                                        (patient_id, provider_id, plan_content)
+                                        VALUES (?, ?, ?)
+                                    """, (patient_id, st.session_state.provider_id, new_plan))
+                                    invalidate_user(patient_id)
+                                    st.success("Treatment plan updated!")
+                                    st.rerun()
+                        except Exception as e:
+                            st.error(f"Error in treatment plans tab: {str(e)}")
 
-    except Exception as e:
-        st.error(f"An error occurred: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
 
 # Enhanced settings section
 def settings():
@@ -1219,47 +1310,33 @@ def settings():
     
     with tabs[0]:
         st.header("Reminder Settings")
+        with get_connection() as conn:
+            saved_times, saved_delays = load_reminder_settings(conn, st.session_state.user_id)
         
         # Multiple reminder times
         st.subheader("Set Reminder Times")
-        num_reminders = st.number_input("Number of daily reminders", 1, 10, 3)
+        num_reminders = st.number_input("Number of daily reminders", 1, 10, len(saved_times) or 3)
         
         reminder_times = []
         for i in range(num_reminders):
-            time = st.time_input(f"Reminder {i+1}", key=f"reminder_{i}")
+            saved = datetime.strptime(saved_times[i], "%H:%M").time() if i < len(saved_times) else "now"
+            time = st.time_input(f"Reminder {i+1}", value=saved, key=f"reminder_{i}")
             reminder_times.append(time)
         
-        # Delay options
+        # Delay options, offered as snooze buttons on each reminder
         st.subheader("Reminder Delay Options")
-        delay_options = [5, 10, 15, 30, 60]
+        delay_options = SNOOZE_OPTIONS
         selected_delays = []
         for delay in delay_options:
-            if st.checkbox(f"{delay} minutes"):
+            if st.checkbox(f"{delay} minutes", value=delay in saved_delays, key=f"reminder_delay_{delay}"):
                 selected_delays.append(delay)
         
         if st.button("Save Reminder Settings"):
-            conn = create_database_connection()
-            if conn:
-                try:
-                    # Clear existing reminders
-                    conn.execute("""
-                        DELETE FROM reminder_settings
-                        WHERE user_id = ?
-                    """, (st.session_state.user_id,))
-                    
-                    # Save new reminders
-                    for time in reminder_times:
-                        conn.execute("""
-                            INSERT INTO reminder_settings (user_id, reminder_time)
-                            VALUES (?, ?)
-                        """, (st.session_state.user_id, time.strftime('%H:%M')))
-                    
-                    conn.commit()
-                    st.success("Reminder settings saved!")
-                except Exception as e:
-                    st.error(f"Error saving settings: {e}")
-                finally:
-                    conn.close()
+            try:
+                save_reminder_settings(st.session_state.user_id, reminder_times, selected_delays)
+                st.success("Reminder settings saved!")
+            except Exception as e:
+                st.error(f"Error saving settings: {e}")
     
     with tabs[1]:
         st.header("Profile Settings")
@@ -1302,12 +1379,8 @@ def main():
         layout="wide",
         initial_sidebar_state="expanded"
     )
-    conn = create_database_connection()
-    if conn:
-        create_tables(conn)
-        conn.close()
-
     initialize_session_state()
+    get_scheduler()
 
     if not user_auth():
         return
@@ -1361,17 +1434,21 @@ def main():
             # Timer and Medication Status
             current_time = datetime.now().strftime("%H:%M")
             st.header(f"🕐 {current_time}")
+            if st.session_state.user_id:
+                display_reminder_inbox(st.session_state.user_id)
             
             # Streak Display
-            conn = create_database_connection()
-            if conn:
-                streak = calculate_streak(conn, st.session_state.user_id)
-                st.metric("Current Streak", f"{streak} days", "Keep it up! 🎯")
-                conn.close()
+            today = datetime.now().date()
+            streak = cached(current_streak, st.session_state.user_id, today)
+            adherence_30d = cached(load_patient_adherence, st.session_state.user_id, 30, today)
+            st.metric("Current Streak", f"{streak} days", "Keep it up! 🎯")
+            st.metric("30-Day Adherence", f"{adherence_30d['pdc']:.0%}")
             
             # Calendar View
             if st.session_state.authenticated and st.session_state.user_id:
                 display_medication_calendar()
+                st.subheader("Adherence (past year)")
+                display_adherence_year(st.session_state.user_id, key="home_adherence_year")
             else:
                 st.warning("Please sign in to view medication records")
         
@@ -1561,24 +1638,7 @@ def main():
             """)
     
     elif st.session_state.page == "Settings":
-        st.title("Settings")
-        
-        st.subheader("Notification Settings")
-        notification_time = st.time_input("Set Default Reminder Time")
-        st.checkbox("Enable Daily Reminders")
-        st.checkbox("Enable Low Blood Sugar Alerts")
-        
-        st.subheader("Profile Settings")
-        st.text_input("Name")
-        st.text_input("Email")
-        st.selectbox("Preferred Language", ["English", "Spanish", "French"], key="language_select")
-        
-        st.subheader("Medical Information")
-        st.text_input("Healthcare Provider")
-        st.text_input("Emergency Contact")
-        
-        if st.button("Save Settings", key="save_settings_button"):
-            st.success("Settings saved successfully!")    
+        settings()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
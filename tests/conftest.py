@@ -0,0 +1,18 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from migrations import migrate  # noqa: E402
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    yield conn
+    conn.close()
@@ -0,0 +1,100 @@
+from datetime import date, datetime
+
+import pytest
+
+from dose_outcomes import LATE, MISSED, ON_TIME, close_due_slots, match_doses, record_dose_outcome
+
+DAY = date(2026, 3, 9)
+KEY = ("1", "metformin")
+
+
+def at(hhmm, day=DAY):
+    return datetime.combine(day, datetime.strptime(hhmm, "%H:%M").time())
+
+
+def match(slot_times, dose_times):
+    slots = [(KEY, at(t), t) for t in slot_times]
+    doses = [(KEY, at(t), index) for index, t in enumerate(dose_times)]
+    return {slot: (outcome, medication_id) for slot, outcome, medication_id, _ in match_doses(slots, doses)}
+
+
+@pytest.mark.parametrize("taken, outcome", [("07:00", ON_TIME), ("09:00", ON_TIME), ("09:01", LATE),
+                                            ("12:00", LATE), ("06:59", MISSED), ("12:01", MISSED)])
+def test_single_slot_windows(taken, outcome):
+    assert match(["08:00"], [taken])["08:00"][0] == outcome
+
+
+def test_dose_goes_to_the_slot_it_is_on_time_for():
+    # Late for 08:00 but on time for 10:00
+    assert match(["08:00", "10:00"], ["10:00"]) == {"08:00": (MISSED, None), "10:00": (ON_TIME, 0)}
+
+
+def test_late_dose_kept_when_the_next_dose_covers_the_next_slot():
+    assert match(["08:00", "10:00"], ["09:10", "10:05"]) == {"08:00": (LATE, 0), "10:00": (ON_TIME, 1)}
+
+
+def test_each_dose_claims_one_slot():
+    assert match(["08:00", "08:30"], ["08:10"]) == {"08:00": (ON_TIME, 0), "08:30": (MISSED, None)}
+    assert match(["08:00"], ["08:10", "08:20"]) == {"08:00": (ON_TIME, 0)}
+
+
+def test_keys_do_not_mix():
+    slots = [(("1", "insulin"), at("08:00"), "insulin"), (KEY, at("08:00"), "metformin")]
+    doses = [(KEY, at("08:05"), 7)]
+    outcomes = {slot: outcome for slot, outcome, _, _ in match_doses(slots, doses)}
+    assert outcomes == {"insulin": MISSED, "metformin": ON_TIME}
+
+
+def schedule(conn, *times):
+    conn.executemany("""
+        INSERT INTO medication_schedule (user_id, med_name, scheduled_time, dosage, start_date)
+        VALUES (1, 'Metformin', ?, 500, ?)
+    """, [(t, DAY.isoformat()) for t in times])
+
+
+def log_dose(conn, hhmm, day=DAY):
+    return conn.execute("""
+        INSERT INTO medications (user_id, med_name, dosage, time_taken, date)
+        VALUES (1, 'Metformin', 500, ?, ?)
+    """, (at(hhmm, day).strftime("%Y-%m-%d %H:%M:%S"), day.isoformat())).lastrowid
+
+
+def outcomes(conn):
+    return dict(conn.execute("""
+        SELECT substr(o.due_at, 12, 5), o.status FROM dose_outcomes o ORDER BY o.due_at
+    """).fetchall())
+
+
+def test_close_due_slots_prefers_on_time_match(conn):
+    schedule(conn, "08:00", "10:00")
+    log_dose(conn, "10:00")
+    assert close_due_slots(conn, at("23:00")) == {1}
+    assert outcomes(conn) == {"08:00": MISSED, "10:00": ON_TIME}
+
+
+def test_close_due_slots_only_closes_finished_windows(conn):
+    schedule(conn, "08:00", "18:00")
+    log_dose(conn, "08:30")
+    close_due_slots(conn, at("13:00"))
+    assert outcomes(conn) == {"08:00": ON_TIME}
+    # The next sweep closes 18:00 without touching 08:00 again
+    close_due_slots(conn, at("23:00"))
+    assert outcomes(conn) == {"08:00": ON_TIME, "18:00": MISSED}
+
+
+def test_close_due_slots_skips_doses_already_claimed(conn):
+    schedule(conn, "08:00", "10:00")
+    medication_id = log_dose(conn, "10:00")
+    assert record_dose_outcome(conn, 1, "Metformin", DAY, at("10:00"), medication_id) == ON_TIME
+    close_due_slots(conn, at("23:00"))
+    assert outcomes(conn) == {"08:00": MISSED, "10:00": ON_TIME}
+
+
+def test_record_dose_outcome_prefers_on_time_slot(conn):
+    schedule(conn, "08:00", "10:00")
+    first = log_dose(conn, "09:10")
+    # On time for 10:00 (50 minutes early), only late for 08:00
+    assert record_dose_outcome(conn, 1, "Metformin", DAY, at("09:10"), first) == ON_TIME
+    second = log_dose(conn, "10:05")
+    assert record_dose_outcome(conn, 1, "Metformin", DAY, at("10:05"), second) == LATE
+    assert outcomes(conn) == {"08:00": LATE, "10:00": ON_TIME}
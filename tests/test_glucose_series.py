@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+from glucose_series import load_series
+
+NOW = datetime(2026, 3, 10, 12, 30)
+
+
+def log(conn, user_id, times):
+    conn.executemany("INSERT INTO glucose_readings (user_id, glucose_level, reading_time) VALUES (?, ?, ?)",
+                     [(user_id, 120.0, t.strftime("%Y-%m-%d %H:%M:%S")) for t in times])
+
+
+def test_windows_end_now_not_at_the_latest_reading(conn):
+    # Readings stopped ten days ago
+    log(conn, 1, [NOW - timedelta(days=10, hours=h) for h in range(48)])
+    for days in (1, 7):
+        series, tier = load_series(conn, 1, days, NOW)
+        assert series.empty and tier is None
+    series, tier = load_series(conn, 1, 30, NOW)
+    assert tier == "hour" and len(series) == 48
+    series, _ = load_series(conn, 1, None, NOW)
+    assert len(series) == 48
+
+
+def test_last_day_includes_readings_up_to_now(conn):
+    log(conn, 1, [NOW - timedelta(hours=30), NOW - timedelta(hours=2), NOW])
+    series, tier = load_series(conn, 1, 1, NOW)
+    assert tier == "raw"
+    assert series["time"].tolist() == [NOW - timedelta(hours=2), NOW]
+
+
+def test_no_readings(conn):
+    series, tier = load_series(conn, 1, 1, NOW)
+    assert series.empty and tier is None
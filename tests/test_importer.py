@@ -0,0 +1,85 @@
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import PRAGMAS
+from glucose_series import rebuild_rollups
+from glucose_summary import rebuild_summary
+from importer import SUSPENDED_TRIGGERS, import_readings
+from migrations import migrate
+
+TARGET_RATE = 100_000  # readings per second
+
+
+def write_export(path, readings, start="2024-01-01"):
+    times = pd.date_range(start, periods=readings, freq="5min")
+    levels = np.round(np.random.default_rng(0).uniform(60, 250, readings), 1)
+    pd.DataFrame({"reading_time": times.strftime("%Y-%m-%d %H:%M:%S"),
+                  "glucose_level": levels}).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def file_conn(tmp_path):
+    # A database file with the app's pragmas, as imports run against
+    conn = sqlite3.connect(str(tmp_path / "import.db"))
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def snapshot(conn, table):
+    # Hour histograms parsed and sums rounded, as a rebuild adds readings up
+    # in another order
+    def value(column):
+        if isinstance(column, str) and column.startswith("["):
+            return [value(item) for item in json.loads(column)]
+        return round(column, 6) if isinstance(column, float) else column
+
+    return [tuple(value(column) for column in row)
+            for row in conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3")]
+
+
+def test_import_rate(tmp_path, file_conn):
+    path = write_export(tmp_path / "cgm.csv", 300_000)
+    stats = import_readings(file_conn, path, 1)
+    assert stats["imported"] == 300_000
+    assert stats["imported"] / stats["seconds"] >= TARGET_RATE, stats
+
+
+def test_import_keeps_aggregates_and_triggers(tmp_path, conn):
+    path = write_export(tmp_path / "cgm.csv", 30_000)
+    stats = import_readings(conn, path, 1, chunk_size=4_000, commit_rows=10_000)
+    assert stats["imported"] == 30_000
+    triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert set(SUSPENDED_TRIGGERS) <= triggers
+
+    assert conn.execute("SELECT reading_count FROM user_stats WHERE user_id = 1").fetchone()[0] == 30_000
+    imported = [snapshot(conn, table) for table in ("glucose_rollups", "daily_glucose_summary")]
+    rebuild_rollups(conn)
+    rebuild_summary(conn)
+    conn.commit()
+    assert [snapshot(conn, table) for table in ("glucose_rollups", "daily_glucose_summary")] == imported
+
+    # Importing the file again only finds duplicates
+    again = import_readings(conn, path, 1)
+    assert (again["imported"], again["duplicates"]) == (0, 30_000)
+
+
+def test_failed_import_keeps_committed_transactions(tmp_path, conn):
+    path = write_export(tmp_path / "cgm.csv", 30_000)
+
+    def stop(stats):
+        if stats["rows"] >= 20_000:
+            raise RuntimeError("stop")
+
+    with pytest.raises(RuntimeError):
+        import_readings(conn, path, 1, chunk_size=5_000, commit_rows=10_000, progress=stop)
+    # The transaction of rows 10,000-20,000 was still open and rolled back
+    assert conn.execute("SELECT COUNT(*) FROM glucose_readings").fetchone()[0] == 10_000
+    assert not conn.in_transaction
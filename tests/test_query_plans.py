@@ -0,0 +1,76 @@
+from datetime import date
+
+import pytest
+
+import adherence
+import glucose_metrics
+import glucose_summary
+import queries
+
+# The hot per-user queries must seek into their (user_id, time) index. Each
+# loader is run with the SQL trace on, and every SELECT it issued is put
+# through EXPLAIN QUERY PLAN: a plain SCAN of a table means a full table
+# scan that grows with every user's history.
+
+TODAY = date(2026, 3, 10)
+
+HOT_QUERIES = {
+    "latest_glucose": (lambda conn: queries.latest_glucose(conn, 1),
+                       "idx_glucose_user_time"),
+    "glucose_metrics": (lambda conn: glucose_metrics.load_panel_metrics(conn, [1, 2], 14, TODAY),
+                        "idx_glucose_user_time"),
+    "recent_medications": (lambda conn: queries.load_recent_medications(conn, 1),
+                           "idx_medications_user_date"),
+    "calendar_days": (lambda conn: queries.load_calendar_days(conn, 1, "2026-03-01", "2026-04-01"),
+                      "idx_medications_user_date"),
+    "first_dose_date": (lambda conn: queries.first_dose_date(conn, 1),
+                        "idx_medications_user_date"),
+    "adherence": (lambda conn: adherence.load_adherence(conn, [1], days=30),
+                  "idx_medications_user_date"),
+    "recent_messages": (lambda conn: queries.load_recent_messages(conn, 1),
+                        "idx_provider_messages_patient"),
+    "new_messages": (lambda conn: queries.load_new_messages(conn, 1, 0),
+                     "idx_provider_messages_patient"),
+    "daily_summary": (lambda conn: glucose_summary.load_daily_summary(conn, 1, "2026-01-01"),
+                      "PRIMARY KEY"),
+}
+
+
+def query_plans(conn, load):
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        load(conn)
+    finally:
+        conn.set_trace_callback(None)
+    selects = [sql for sql in statements if sql.lstrip().upper().startswith(("SELECT", "WITH"))]
+    return [[row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)] for sql in selects]
+
+
+def table_scans(plan):
+    # "SCAN medications" is a full scan; "SCAN (subquery-1)", "SCAN CONSTANT
+    # ROW" and ordered index walks ("SCAN p USING INDEX ...") are not
+    return [step for step in plan
+            if step.startswith("SCAN ") and " USING " not in step
+            and not step.startswith(("SCAN (", "SCAN CONSTANT ROW"))]
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(conn, name):
+    load, index = HOT_QUERIES[name]
+    plans = query_plans(conn, load)
+    assert plans, f"{name} ran no SELECT"
+    for plan in plans:
+        assert not table_scans(plan), f"{name} scans a table: {plan}"
+    assert any(index in step for plan in plans for step in plan), f"{name} skips {index}: {plans}"
+
+
+def test_feed_page_walks_the_created_index(conn):
+    # The feed pages through posts newest first: an ordered walk of the
+    # created_at index that stops at the page size, not a sort of every post
+    plans = query_plans(conn, queries.load_feed_page)
+    steps = [step for plan in plans for step in plan]
+    assert any("idx_community_posts_created" in step for step in steps), plans
+    assert not any("TEMP B-TREE FOR ORDER BY" in step for step in steps), plans
+    for plan in plans:
+        assert not table_scans(plan), plans
@@ -0,0 +1,22 @@
+from reminders import TimerWheel
+
+
+def test_keep_retains_ids_added_after_take():
+    wheel = TimerWheel()
+    for reminder_id in (1, 2, 3):
+        wheel.add(480, reminder_id)
+    taken = wheel.take(480)
+    # While the slot is out: a save adds 4 and 5, a sign-out cancels 4 and 1
+    wheel.add(480, 4)
+    wheel.add(480, 5)
+    wheel.discard(480, {4, 1})
+    wheel.keep(480, taken, {1: 7, 2: 7, 3: 8})
+    assert wheel.take(480) == [2, 3, 5]
+
+
+def test_keep_drops_invalid_and_duplicate_ids():
+    wheel = TimerWheel()
+    wheel.extend([(480, 1), (480, 2), (480, 1), (600, 3)])
+    wheel.keep(480, wheel.take(480), {1: 7})
+    assert wheel.take(480) == [1]
+    assert len(wheel) == 1
@@ -0,0 +1,87 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from streaks import adherent_days, get_streaks, rebuild_bitmap, rebuild_streak, record_dose
+
+# Property test: record_dose() applied dose by dose, in random order with
+# duplicates and backfills, must agree with a brute-force recomputation
+# from the set of dosed days. Histories come from a seeded generator, so a
+# failure names the seed that reproduces it.
+
+TODAY = date(2026, 3, 10)
+HISTORIES = 100
+
+
+def brute_force(days, today):
+    # (current, longest) straight from the definition
+    days = sorted(set(days))
+    longest = run = 0
+    for i, day in enumerate(days):
+        run = run + 1 if i and (day - days[i - 1]).days == 1 else 1
+        longest = max(longest, run)
+    if not days or days[-1] < today - timedelta(days=1):
+        run = 0
+    return run, longest
+
+
+def random_history(rng):
+    # Clusters of consecutive days with gaps, spanning a leap day, plus
+    # repeats and out-of-order backfills
+    days, day = [], TODAY - timedelta(days=rng.randint(0, 900))
+    while day <= TODAY:
+        days.extend(day + timedelta(days=i) for i in range(rng.randint(1, 12)))
+        day += timedelta(days=rng.randint(1, 15) + rng.randint(1, 12))
+    days = [day for day in days if day <= TODAY]
+    days += rng.choices(days, k=len(days) // 4)
+    if rng.random() < 0.5:
+        rng.shuffle(days)
+    else:
+        days.sort()
+        for _ in range(len(days) // 10):
+            i = rng.randrange(len(days))
+            days.insert(rng.randrange(i + 1), days.pop(i))
+    return days
+
+
+def log(conn, user_id, day):
+    conn.execute("INSERT INTO medications (user_id, med_name, dosage, time_taken, date) VALUES (?, ?, ?, ?, ?)",
+                 (user_id, "Insulin", 1.0, "08:00:00", day.isoformat()))
+    record_dose(conn, user_id, day)
+
+
+@pytest.mark.parametrize("seed", range(HISTORIES))
+def test_incremental_state_matches_brute_force(conn, seed):
+    rng = random.Random(seed)
+    days = random_history(rng)
+    for day in days:
+        log(conn, 1, day)
+
+    for today in (TODAY, TODAY + timedelta(days=1), TODAY + timedelta(days=2)):
+        assert get_streaks(conn, 1, today) == brute_force(days, today), f"seed {seed}"
+
+    start, end = date(TODAY.year - 3, 1, 1), TODAY + timedelta(days=1)
+    expected = [start + timedelta(days=i) in set(days) for i in range((end - start).days)]
+    assert adherent_days(conn, 1, start, end).tolist() == expected, f"seed {seed}"
+
+
+@pytest.mark.parametrize("seed", range(0, HISTORIES, 10))
+def test_rebuild_matches_incremental(conn, seed):
+    rng = random.Random(seed)
+    for day in random_history(rng):
+        log(conn, 1, day)
+    state = conn.execute("SELECT * FROM adherence_state").fetchall()
+    bitmaps = conn.execute("SELECT * FROM adherence_days ORDER BY year").fetchall()
+    rebuild_streak(conn, 1)
+    rebuild_bitmap(conn, 1)
+    assert conn.execute("SELECT * FROM adherence_state").fetchall() == state
+    assert conn.execute("SELECT * FROM adherence_days ORDER BY year").fetchall() == bitmaps
+
+
+def test_users_are_independent(conn):
+    log(conn, 1, TODAY)
+    log(conn, 2, TODAY - timedelta(days=5))
+    assert get_streaks(conn, 1, TODAY) == (1, 1)
+    assert get_streaks(conn, 2, TODAY) == (0, 1)
+    assert get_streaks(conn, 3, TODAY) == (0, 0)
@@ -0,0 +1,45 @@
+from datetime import date
+
+import pandas as pd
+
+from triage import RISK_WEIGHTS, score_panel
+
+TODAY = date(2026, 3, 10)
+
+
+def panel(**overrides):
+    # Two otherwise identical patients, dosed and measured today with no
+    # lows or highs
+    rows = {
+        "user_id": [1, 2], "full_name": ["A", "B"], "username": ["a", "b"],
+        "last_reading_at": ["2026-03-10 08:00:00"] * 2, "last_adherent_day": ["2026-03-10"] * 2,
+        "readings": [100, 100], "hypos": [0, 0], "hypers": [0, 0],
+        "scheduled_doses": [28, 28], "missed_scheduled": [0, 0],
+    }
+    rows.update(overrides)
+    return pd.DataFrame(rows)
+
+
+def test_weights_sum_to_one():
+    assert abs(sum(RISK_WEIGHTS.values()) - 1) < 1e-9
+
+
+def test_missed_scheduled_doses_raise_risk():
+    # Patient 2 logged a dose today but missed 10 of 28 scheduled slots
+    scored = score_panel(panel(missed_scheduled=[0, 10]), TODAY)
+    assert scored["user_id"].tolist() == [2, 1]
+    top = scored.iloc[0]
+    assert top["risk_score"] == 100 * RISK_WEIGHTS["missed_slots"]
+    assert top["reasons"] == "Missed scheduled doses"
+    assert scored.iloc[1]["risk_score"] == 0
+
+
+def test_missed_share_orders_patients():
+    scored = score_panel(panel(missed_scheduled=[2, 4]), TODAY)
+    assert scored["user_id"].tolist() == [2, 1]
+    assert scored.iloc[0]["risk_score"] > scored.iloc[1]["risk_score"] > 0
+
+
+def test_no_schedule_is_not_missed():
+    scored = score_panel(panel(scheduled_doses=[0, 28], missed_scheduled=[0, 0]), TODAY)
+    assert scored["risk_score"].tolist() == [0, 0]
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Panel-wide risk ranking for the provider portal. Everything it needs is
+# already maintained incrementally on every write (user_stats for last
+# activity, adherence_state for the last dosed day, daily_glucose_summary for
+# hypo/hyper counts, dose_outcomes for scheduled doses), so ranking the whole
+# panel is one grouped query over those rollups plus a NumPy scoring pass,
+# never a scan of raw readings.
+#
+# Each risk factor is scaled to 0..1 against a clinical target and the
+# weighted sum gives a 0..100 score:
+#
+#   hypos          share of readings below 70 in the window vs the 4% target
+#   above_range    share of readings above 180 vs the 25% target
+#   missed_doses   days since the last dose, saturating at a week
+#   missed_slots   share of closed scheduled dose slots missed in the window
+#                  vs the 20% limit (0 without a schedule)
+#   stale          days since the last glucose reading, saturating at a week
+
+TRIAGE_WINDOW_DAYS = 14
+
+BELOW_RANGE_TARGET = 0.04
+ABOVE_RANGE_TARGET = 0.25
+MISSED_SLOTS_LIMIT = 0.2
+SATURATION_DAYS = 7
+
+RISK_WEIGHTS = {"hypos": 0.35, "missed_doses": 0.2, "missed_slots": 0.15, "above_range": 0.15,
+                "stale": 0.15}
+
+RISK_REASONS = {"hypos": "Frequent lows", "missed_doses": "Missed doses",
+                "missed_slots": "Missed scheduled doses", "above_range": "Time above range",
+                "stale": "No recent readings"}
+
+
+def load_panel(conn, days=TRIAGE_WINDOW_DAYS, today=None):
+    # One row per patient account with the raw risk inputs
+    today = today or datetime.now().date()
+    start = (today - timedelta(days=days - 1)).isoformat()
+    end = (today + timedelta(days=1)).isoformat()
+    return pd.read_sql_query("""
+        SELECT u.user_id, u.full_name, u.username,
+               s.last_reading_at, a.last_adherent_day,
+               COALESCE(g.readings, 0) AS readings,
+               COALESCE(g.hypos, 0) AS hypos,
+               COALESCE(g.hypers, 0) AS hypers,
+               COALESCE(d.scheduled, 0) AS scheduled_doses,
+               COALESCE(d.missed, 0) AS missed_scheduled
+        FROM user_accounts u
+        LEFT JOIN user_stats s ON s.user_id = u.user_id
+        LEFT JOIN adherence_state a ON a.user_id = u.user_id
+        LEFT JOIN (
+            SELECT user_id, SUM(reading_count) AS readings,
+                   SUM(hypo_count) AS hypos, SUM(hyper_count) AS hypers
+            FROM daily_glucose_summary
+            WHERE day >= ? AND day < ?
+            GROUP BY user_id
+        ) g ON g.user_id = u.user_id
+        LEFT JOIN (
+            SELECT user_id, COUNT(*) AS scheduled, SUM(status = 'missed') AS missed
+            FROM dose_outcomes
+            WHERE day >= ? AND day < ?
+            GROUP BY user_id
+        ) d ON d.user_id = u.user_id
+    """, conn, params=(start, end, start, end))
+
+
+def _days_since(values, today):
+    # Whole days from each 'YYYY-MM-DD...' value to today; NaN when missing
+    days = pd.to_datetime(values.astype(str).str[:10], format="%Y-%m-%d", errors="coerce")
+    return (pd.Timestamp(today) - days).dt.days.to_numpy(dtype=float)
+
+
+def score_panel(panel, today=None):
+    # Adds the derived factors, a 0..100 risk score and the main reasons,
+    # highest risk first
+    today = today or datetime.now().date()
+    panel = panel.copy()
+    readings = panel["readings"].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        panel["time_below_range"] = np.where(readings > 0, panel["hypos"] / readings, 0.0)
+        panel["time_above_range"] = np.where(readings > 0, panel["hypers"] / readings, 0.0)
+    panel["days_since_dose"] = _days_since(panel["last_adherent_day"], today)
+    # Share of scheduled doses taken; NaN for patients without a schedule
+    scheduled = panel["scheduled_doses"].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        panel["scheduled_taken"] = np.where(scheduled > 0, 1 - panel["missed_scheduled"] / scheduled, np.nan)
+    panel["days_since_reading"] = _days_since(panel["last_reading_at"], today)
+
+    factors = {
+        "hypos": panel["time_below_range"].to_numpy() / BELOW_RANGE_TARGET,
+        "above_range": panel["time_above_range"].to_numpy() / ABOVE_RANGE_TARGET,
+        # Never dosed / never measured counts as the worst case
+        "missed_doses": np.nan_to_num(panel["days_since_dose"].to_numpy(), nan=SATURATION_DAYS) / SATURATION_DAYS,
+        "missed_slots": np.nan_to_num(1 - panel["scheduled_taken"].to_numpy(), nan=0.0) / MISSED_SLOTS_LIMIT,
+        "stale": np.nan_to_num(panel["days_since_reading"].to_numpy(), nan=SATURATION_DAYS) / SATURATION_DAYS,
+    }
+    factors = {name: np.clip(values, 0, 1) for name, values in factors.items()}
+    panel["risk_score"] = 100 * sum(RISK_WEIGHTS[name] * values for name, values in factors.items())
+
+    # Reasons: every factor at or past its target, worst first
+    names = np.array(list(factors))
+    matrix = np.column_stack([factors[name] for name in names])
+    order = np.argsort(-matrix, axis=1)
+    panel["reasons"] = [", ".join(RISK_REASONS[names[i]] for i in row_order if row[i] >= 1)
+                        for row, row_order in zip(matrix, order)]
+
+    return panel.sort_values(["risk_score", "days_since_reading"], ascending=False,
+                             na_position="first").reset_index(drop=True)
+
+
+def load_triage(conn, days=TRIAGE_WINDOW_DAYS, today=None):
+    return score_panel(load_panel(conn, days, today), today)